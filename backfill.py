@@ -0,0 +1,137 @@
+import os
+import time
+import shutil
+import argparse
+import contextlib
+import pandas as pd
+from dataframe_storage import df_append_data, create_append_executor
+from dataframe_treatment import df_filter_data_stream
+from dead_letter import dead_letter_store
+from from_server_to_df import (create_reassembly_buffers, df_assemble_batch, evict_pending_records, load_pending_state, save_pending_state,
+                               remove_stale_pending_states, PENDING_STATE_FILE_PATH)
+from ingest_service import df_iter_dump_file
+
+"""
+*************************************************************************************************************
+This file contains the backfill tool, used to replay historical server dumps (.csv or .parquet files with the
+DeviceId and OriginalMessage columns) and rebuild the df/ directory, e.g. after a schema change:
+
+    python backfill.py dumps/ --rebuild
+
+Dump files are read in chunks (in name order) and go through the same path as from_server_to_parquet_batch:
+decoding, reassembly and filtering (df_filter_data_stream, which keeps the rejection counters across chunks).
+Filtered records are appended every time WRITE_BATCH_ROWS of them have been accumulated, so memory does not
+depend on the size of the dumps. Replay starts from the pending records left by incremental ingest (none with
+--rebuild), pending records are evicted after every chunk like incremental ingest does, and the records that are
+still incomplete at the end are stored as pending records.
+
+Do not run it while an ingest worker is writing to the same df/ directory.
+*************************************************************************************************************
+"""
+
+CHUNK_ROWS = 100000             # Packets read at once from the dump files
+REPORT_INTERVAL = 10.0          # Seconds between progress reports
+WRITE_BATCH_ROWS = 1000000      # Filtered records accumulated before appending them
+
+def backfill(directory:str, chunk_rows:int=CHUNK_ROWS, report_interval:float=REPORT_INTERVAL, write_batch_rows:int=WRITE_BATCH_ROWS, executor=None) -> dict:
+    # Replays every dump file of directory and stores the result in df/
+    #
+    # INPUT:
+    #   - directory: folder containing the dump files
+    #   - chunk_rows: packets read at once
+    #   - report_interval: seconds between progress reports
+    #   - write_batch_rows: filtered records accumulated before appending them
+    #   - executor: pool used by df_append_data to append several months at once (see
+    #     dataframe_storage.create_append_executor), None to append them one after the other
+    #
+    # OUTPUT:
+    #   - stats: totals ('packets', 'completed', 'rejected', 'expired', 'dead_letter'), rows out of bounds
+    #     of every column ('violations'), time spent in every stage ('read', 'assemble', 'filter',
+    #     'write') and the rates ('packets_per_s', 'completed_per_s')
+
+    # Keep the partial records of incremental ingest, they are saved again at the end
+    buffers = create_reassembly_buffers()
+    load_pending_state(buffers)
+    filtered = {'trip': [], 'charge': []}
+    filter_counters = {'trip': {}, 'charge': {}}
+    stats = {'packets': 0, 'completed': 0, 'rejected': 0, 'expired': 0,
+             'read': 0.0, 'assemble': 0.0, 'filter': 0.0, 'write': 0.0}
+
+    started = time.monotonic()
+    last_report = started
+
+    for filename in sorted(os.listdir(directory)):
+        chunks = df_iter_dump_file(os.path.join(directory, filename), chunk_rows)
+        while True:
+            stage_start = time.monotonic()
+            df_chunk = next(chunks, None)
+            stats['read'] += time.monotonic() - stage_start
+            if df_chunk is None:
+                break
+
+            stage_start = time.monotonic()
+            completed = df_assemble_batch(df_chunk, buffers)
+            expired = evict_pending_records(buffers=buffers)
+            stats['expired'] += sum(df_expired.shape[0] for df_expired in expired.values())
+            stats['assemble'] += time.monotonic() - stage_start
+            stats['packets'] += df_chunk.shape[0]
+
+            stage_start = time.monotonic()
+            for type_name, df_completed in completed.items():
+                filtered[type_name] += df_filter_data_stream([df_completed], type_name, counters=filter_counters[type_name])
+            stats['completed'] = sum(counters.get('records', 0) for counters in filter_counters.values())
+            stats['rejected'] = sum(counters.get('rejected', 0) for counters in filter_counters.values())
+            stats['filter'] += time.monotonic() - stage_start
+
+            # Append the filtered records once enough of them have been accumulated
+            stage_start = time.monotonic()
+            for type_name, frames in filtered.items():
+                if sum(df.shape[0] for df in frames) >= write_batch_rows:
+                    df_append_data(pd.concat(frames), type_name, executor)
+                    filtered[type_name] = []
+            stats['write'] += time.monotonic() - stage_start
+
+            if time.monotonic() - last_report > report_interval:
+                print_report(stats, time.monotonic() - started)
+                last_report = time.monotonic()
+
+    # Write the remaining records of every type, then keep the records that are still incomplete
+    stage_start = time.monotonic()
+    for type_name, frames in filtered.items():
+        if frames:
+            df_append_data(pd.concat(frames), type_name, executor)
+
+    save_pending_state(buffers)
+    remove_stale_pending_states([PENDING_STATE_FILE_PATH])
+    dead_letter_store.flush()
+    stats['write'] += time.monotonic() - stage_start
+    stats['dead_letter'] = dead_letter_store.get_counters()
+    stats['violations'] = {type_name: counters.get('violations', {}) for type_name, counters in filter_counters.items()}
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    stats['packets_per_s'] = stats['packets'] / elapsed
+    stats['completed_per_s'] = stats['completed'] / elapsed
+
+    return stats
+
+def print_report(stats:dict, elapsed:float):
+    # Prints the rates and the time spent in every stage
+    elapsed = max(elapsed, 1e-9)
+    print(f"{stats['packets']} packets ({stats['packets']/elapsed:.0f}/s), "
+          f"{stats['completed']} completed ({stats['completed']/elapsed:.0f}/s), {stats['rejected']} rejected | "
+          f"read {stats['read']:.1f}s, assemble {stats['assemble']:.1f}s, filter {stats['filter']:.1f}s, write {stats['write']:.1f}s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay server dumps into the df/ parquet files')
+    parser.add_argument('directory', help='directory of .csv/.parquet dump files')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--rebuild', action='store_true', help='delete the df/ directory before replaying')
+    args = parser.parse_args()
+
+    if args.rebuild and os.path.isdir('df'):
+        shutil.rmtree('df')
+
+    started = time.monotonic()
+    with create_append_executor() or contextlib.nullcontext() as executor:
+        stats = backfill(args.directory, args.chunk_rows, executor=executor)
+    print_report(stats, time.monotonic() - started)
@@ -0,0 +1,196 @@
+import os
+import time
+import argparse
+import pandas as pd
+import pyarrow.parquet as pq
+from dataframe_storage import (DATASET_DIRECTORY, VIN_COLUMN, TIMESTAMP_COLUMNS, concat_part_tables, get_hot_path, get_part_files,
+                               load_manifest, read_part_table, save_manifest, update_manifest, write_sorted_part_file)
+from storage_io import partition_lock
+
+"""
+*************************************************************************************************************
+This file contains the compaction job of the trip/charge dataset. Appends write a new part file per VIN
+bucket every time, so a busy month ends up with many small files. Compaction merges the part files of every
+bucket into a few large ones:
+
+
+    1) The VINs of the small part files of the bucket (less than TARGET_FILE_ROWS/2 rows) are split into
+       groups of at most TARGET_FILE_ROWS rows
+    2) Every group is read, sorted by (VIN, Timestamp), stripped of exact duplicates and written as a new
+       part file with row groups of ROW_GROUP_ROWS rows, indexed by VIN.
+       Part files written before the compact schema existed are rewritten with it. If the bucket fits in a
+       single group every part file is read once, otherwise only the row groups the VIN index of the manifest
+       maps the VINs of the group to are read
+    3) The manifest of the bucket is replaced, swapping the merged part files for the new ones at once
+
+Only one group is in memory at a time, so memory does not depend on the size of the month. Merged part files
+stay in the retired list of the manifest for RETIRED_GRACE_PERIOD seconds, so readers that listed them before
+the swap can still open them, and are deleted by the next compaction. The lock of the bucket is only held to
+swap the manifest, so ingest can keep appending to the bucket while it is being compacted.
+
+    python compaction.py                    # compact every bucket once
+    python compaction.py --interval 3600    # compact every hour
+*************************************************************************************************************
+"""
+
+TARGET_FILE_ROWS = 1000000      # Maximum rows of every compacted part file
+ROW_GROUP_ROWS = 100000         # Rows of every row group of the compacted part files
+MIN_PARTS = 4                   # Buckets with fewer small part files are not compacted
+RETIRED_GRACE_PERIOD = 600      # Seconds merged part files are kept after the swap
+
+def get_vin_groups(vin_counts:pd.Series, target_file_rows:int) -> list:
+    # Splits the (sorted) VINs into consecutive groups of at most target_file_rows rows. A VIN
+    # with more rows than target_file_rows forms a group on its own
+    groups = [[]]
+    num_rows = 0
+    for vin, count in vin_counts.items():
+        if groups[-1] and num_rows + count > target_file_rows:
+            groups.append([])
+            num_rows = 0
+        groups[-1].append(vin)
+        num_rows += count
+
+    return groups if groups[-1] else []
+
+def read_part_vins(file_path:str, vin_row_groups:dict, vins:list):
+    # Reads the rows of vins from a part file. Only the row groups that vin_row_groups (the VIN
+    # index of the part file, see write_sorted_part_file) maps them to are read, the whole file
+    # (filtered) if it has no VIN index
+    #
+    # OUTPUT:
+    #   - table, None if the part file has no rows of vins
+
+    filters = [(VIN_COLUMN, 'in', vins)]
+    if vin_row_groups is None:
+        return read_part_table(file_path, filters=filters)
+
+    row_groups = sorted({row_group for vin in vins if vin in vin_row_groups
+                         for row_group in range(vin_row_groups[vin][0], vin_row_groups[vin][1] + 1)})
+    if not row_groups:
+        return None
+
+    # Row groups can be shared with other VINs
+    return read_part_table(file_path, row_groups=row_groups, filters=filters)
+
+def delete_retired_parts(directory:str, grace_period:float=RETIRED_GRACE_PERIOD) -> int:
+    # Deletes the part files (and their Arrow IPC twins) that have been retired for more than
+    # grace_period seconds
+    #
+    # OUTPUT:
+    #   - number of part files deleted
+
+    with partition_lock(directory):
+        manifest = load_manifest(directory)
+        now = time.time()
+        expired = [filename for filename, retired in manifest['retired'] if now - retired > grace_period]
+        if not expired:
+            return 0
+
+        for filename in expired:
+            file_path = os.path.join(directory, filename)
+            for path in [file_path, get_hot_path(file_path)]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        manifest['retired'] = [[filename, retired] for filename, retired in manifest['retired'] if filename not in expired]
+        save_manifest(directory, manifest)
+
+    return len(expired)
+
+def compact_bucket(directory:str, type_name:str, target_file_rows:int=TARGET_FILE_ROWS, row_group_rows:int=ROW_GROUP_ROWS,
+                   min_parts:int=MIN_PARTS) -> int:
+    # Merges the part files of a VIN bucket
+    #
+    # INPUT:
+    #   - directory: bucket directory (.../vin_bucket=NN)
+    #   - type_name: 'trip' or 'charge'
+    #   - target_file_rows, row_group_rows: size of the new part files and of their row groups
+    #   - min_parts: buckets with fewer small part files are left as they are
+    #
+    # OUTPUT:
+    #   - number of part files merged
+
+    delete_retired_parts(directory)
+
+    # Part files that are already large are left as they are
+    part_files = [file_path for file_path in get_part_files(directory)
+                  if pq.ParquetFile(file_path).metadata.num_rows < target_file_rows // 2]
+    if len(part_files) < max(min_parts, 2):
+        return 0
+
+    # Only the VIN column is read to split the bucket
+    vins = concat_part_tables([read_part_table(file_path, [VIN_COLUMN]) for file_path in part_files]).column(VIN_COLUMN).to_pandas()
+    vin_counts = vins.astype(str).value_counts().sort_index()
+
+    vin_groups = get_vin_groups(vin_counts, target_file_rows)
+    vin_index = load_manifest(directory).get('vin_index', {})
+
+    new_files = []
+    vin_row_groups = []
+    for vin_group in vin_groups:
+        # If the bucket fits in a single group every part file is read once, whole. Otherwise
+        # only the row groups of the VINs of the group are read
+        if len(vin_groups) == 1:
+            tables = [read_part_table(file_path) for file_path in part_files]
+        else:
+            tables = [read_part_vins(file_path, vin_index.get(os.path.basename(file_path)), vin_group) for file_path in part_files]
+        df = concat_part_tables([table for table in tables if table is not None]).to_pandas()
+        df = df.sort_values(by=[VIN_COLUMN, TIMESTAMP_COLUMNS[type_name]], kind='stable')
+        df = df[~df.reset_index().duplicated().to_numpy()]
+        file_path, row_groups = write_sorted_part_file(directory, df, row_group_rows)
+        new_files.append(file_path)
+        vin_row_groups.append(row_groups)
+
+    # Single swap: readers see either the old part files or the new ones. Appends may have added
+    # part files meanwhile, which are kept. If another compaction has already merged any of the
+    # part files, this one is discarded
+    with partition_lock(directory):
+        if not set(map(os.path.basename, part_files)) <= set(load_manifest(directory)['parts']):
+            for file_path in new_files:
+                os.remove(file_path)
+            return 0
+
+        update_manifest(directory, added=new_files, removed=part_files, vin_row_groups=vin_row_groups)
+
+    return len(part_files)
+
+def compact_dataset(directory:str=DATASET_DIRECTORY, target_file_rows:int=TARGET_FILE_ROWS, row_group_rows:int=ROW_GROUP_ROWS,
+                    min_parts:int=MIN_PARTS) -> dict:
+    # Compacts every bucket of the dataset, one at a time
+    #
+    # OUTPUT:
+    #   - stats: {'buckets': buckets compacted, 'parts': part files merged}
+
+    stats = {'buckets': 0, 'parts': 0}
+    if not os.path.isdir(directory):
+        return stats
+
+    for root, directories, _ in os.walk(directory):
+        directories.sort()
+        if not os.path.basename(root).startswith('vin_bucket='):
+            continue
+
+        type_name = [name[5:] for name in root.split(os.sep) if name.startswith('type=')][0]
+        num_parts = compact_bucket(root, type_name, target_file_rows, row_group_rows, min_parts)
+        if num_parts > 0:
+            stats['buckets'] += 1
+            stats['parts'] += num_parts
+
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the part files of the df/ dataset')
+    parser.add_argument('--target-file-rows', type=int, default=TARGET_FILE_ROWS)
+    parser.add_argument('--row-group-rows', type=int, default=ROW_GROUP_ROWS)
+    parser.add_argument('--min-parts', type=int, default=MIN_PARTS)
+    parser.add_argument('--interval', type=float, help='seconds between compactions, compacts once if not given')
+    args = parser.parse_args()
+
+    while True:
+        started = time.monotonic()
+        stats = compact_dataset(target_file_rows=args.target_file_rows, row_group_rows=args.row_group_rows, min_parts=args.min_parts)
+        print(f"{stats['parts']} part files of {stats['buckets']} buckets merged in {time.monotonic() - started:.1f}s")
+
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
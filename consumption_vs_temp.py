@@ -7,6 +7,7 @@ import statsmodels.api as sm
 import os
 
 from plots_generation import *
+from dataframe_storage import df_read_month, get_month_path
 
 """
 Consumo vs temperatura.
@@ -129,7 +130,7 @@ def get_consumption_vs_temp(df):
     
     return fig_filtered
 
-df = pd.read_parquet("df/2023_07_trip.parquet")
+df = df_read_month(get_month_path(2023, 7, 'trip'))
 fig = get_consumption_vs_temp(df)
 fig.show()
 
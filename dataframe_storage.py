@@ -3,9 +3,15 @@ import numpy as np
 import os
 import pyarrow as pa
 import pyarrow.parquet as pq
-from datetime import datetime, timedelta
+import pyarrow.dataset as ds
+import re
+import json
+import time
 import datetime
-import calendar
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from protocol_registry import KEY_FIELDS, STORAGE_DTYPES
+from storage_io import atomic_write, file_lock, partition_lock
 
 
 
@@ -22,6 +28,10 @@ will do as follows:
     3) Generate or append df_new to its corresponding .parquet file
     4) Update month's critical data or generate a new entry if not existing
 
+Months are stored in DATASET_DIRECTORY (df/fleet/type=/year=/month=/vin_bucket=/) as immutable part files, so
+appending only writes the new rows, and df_query reads only the months, buckets and row groups it needs. The
+critical data is derived from the running aggregates of every month (see df_update_month_state).
+
 Another main function is dF_get_last_months_critical_data, this function is quite self-explainatory. It will
 return a dataframe containing the last "n" months that are passed as parameter.
 
@@ -34,7 +44,903 @@ all critical data columns are generated
 # Critical data path
 CRITICAL_DATA_FILE_PATH = 'df/critical_data.parquet'
 
+# Critical data of every vehicle, a file per month ({YYYY}_{MM}.parquet) with a row per VIN.
+# Files written before it was partitioned by month (VEHICLE_CRITICAL_DATA_FILE_PATH) are split
+# by migrate_legacy_months
+VEHICLE_CRITICAL_DATA_DIRECTORY = 'df/vehicle_critical_data'
+VEHICLE_CRITICAL_DATA_FILE_PATH = 'df/vehicle_critical_data.parquet'
+VEHICLE_CRITICAL_DATA_PATTERN = re.compile(r'^(\d{4})_(\d{2})\.parquet$')
+
+# Rows of every row group of the critical data files. The fleet file is sorted by Date and the
+# files of the vehicles by VIN, so the statistics of the row groups let queries skip the
+# months (or VINs) they don't need
+CRITICAL_DATA_ROW_GROUP_ROWS = 12
+VEHICLE_CRITICAL_DATA_ROW_GROUP_ROWS = 10000
+
+# Running aggregates of every month, one file per month indexed by VIN. All columns are
+# sums except Max odometer
+CRITICAL_STATE_DIRECTORY = 'df/critical_state'
+TRIP_STATE_SUMS = ['Total distance', 'City distance', 'Sport distance', 'Total energy', 'Total regen']
+MONTH_STATE_COLUMNS = ['Trips', *TRIP_STATE_SUMS, 'Max odometer', 'Charges', 'Charged SoC', 'Final SoC', 'Shucko charges']
+MONTH_STATE_COUNTS = ['Trips', 'Charges', 'Shucko charges']
+
+# Significant digits of the decimal values stored as float32 that are restored when they are
+# aggregated (see get_exact_values)
+FLOAT32_DIGITS = 7
+
+# Root of the trip and charge dataset and number of VIN buckets of every month
+DATASET_DIRECTORY = 'df/fleet'
+NUM_VIN_BUCKETS = 16
+
+# Column that stores the VIN (index of the dataframes) and timestamp column of every type
+VIN_COLUMN = 'VIN'
+VIN_TYPE = pa.dictionary(pa.int32(), pa.string())
+TIMESTAMP_COLUMNS = {'trip': 'Timestamp CT', 'charge': 'Timestamp CC'}
+
+# Every bucket lists its part files in a manifest, which is replaced atomically. Part files
+# removed from it (e.g. by compaction) are kept in its retired list until they are deleted
+MANIFEST_FILENAME = '_manifest.json'
+
+# Processes of the pool returned by create_append_executor, and minimum number of months and
+# rows df_append_data must receive to use it (smaller inputs are appended one after the other).
+# Every process costs about a second to start (importing pandas and pyarrow), so small inputs
+# are faster in the calling process
+APPEND_WORKERS = min(os.cpu_count() or 1, 8)
+PARALLEL_APPEND_MIN_MONTHS = 3
+PARALLEL_APPEND_MIN_ROWS = 50000
+
+# Hot tier: the part files of the last HOT_TIER_MONTHS months (the current one included) have an
+# uncompressed Arrow IPC twin (.arrow) that readers memory-map instead of decoding the parquet.
+# 0 disables it
+HOT_TIER_MONTHS = 2
+
+# Month (year*12 + month-1) in which this process last pruned the hot tier
+hot_tier_pruned_month = None
+
+# Sorted 64-bit hashes of the keys stored in every bucket
+KEY_INDEX_FILENAME = '_keys.npy'
+
+# Name of the months stored before the dataset was used, e.g. df/2023_07_trip.parquet
+LEGACY_MONTH_PATTERN = re.compile(r'^(\d{4})_(\d{2})_(trip|charge)\.parquet$')
+
+def get_month_path(year:int, month:int, type_name:str) -> str:
+    # Returns the directory of a month of the dataset
+    return f'{DATASET_DIRECTORY}/type={type_name}/year={year}/month={month:02}'
+
+def get_vin_buckets(vins, num_buckets:int=NUM_VIN_BUCKETS) -> np.ndarray:
+    # Returns the bucket of every VIN. The hash does not depend on the process, so a
+    # vehicle always goes to the same bucket
+    hashes = pd.util.hash_pandas_object(pd.Series(vins, dtype=object).astype(str), index=False)
+    return (hashes.to_numpy() % num_buckets).astype(int)
+
+def get_path_type_name(file_path:str) -> str:
+    # Returns the type ('trip' or 'charge') of a dataset path, None if it is not a dataset path
+    match = re.search(r'type=(trip|charge)', file_path)
+    return None if match is None else match[1]
+
+def get_compact_schema(schema:pa.Schema, type_name:str) -> pa.Schema:
+    # Returns schema with the compact type of every column of type_name (see STORAGE_DTYPES)
+    # and the VIN dictionary-encoded. Columns that are not in param_battery.json keep their type
+    compact_types = {column: pa.from_numpy_dtype(dtype) for column, dtype in STORAGE_DTYPES.get(type_name, {}).items()}
+    compact_types[VIN_COLUMN] = VIN_TYPE
+
+    return pa.schema([field.with_type(compact_types.get(field.name, field.type)) for field in schema], metadata=schema.metadata)
+
+def cast_compact_table(table:pa.Table, type_name:str) -> pa.Table:
+    # Casts table to the compact schema of type_name. Columns whose values don't fit in their
+    # compact type (e.g. decimals in an integer column of an Excel import) are left as they are
+    if type_name not in STORAGE_DTYPES:
+        return table
+
+    for i, field in enumerate(get_compact_schema(table.schema, type_name)):
+        column = table.column(i)
+        if field.type == column.type:
+            continue
+        try:
+            # Older pyarrow versions can't cast plain values to a dictionary type
+            if pa.types.is_dictionary(field.type) and not pa.types.is_dictionary(column.type):
+                column = column.cast(field.type.value_type).dictionary_encode()
+            table = table.set_column(i, field, column.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            continue
+
+    return table
+
+def df_apply_compact_schema(df:pd.DataFrame, type_name:str) -> pd.DataFrame:
+    # Returns df (indexed by VIN) with the dtypes it is stored with: the compact dtypes of
+    # type_name and a categorical VIN
+    return cast_compact_table(pa.Table.from_pandas(df), type_name).to_pandas()
+
+def write_part_file(directory:str, df:pd.DataFrame, row_group_rows:int=None) -> str:
+    # Writes df as a new part file of directory. The file is written atomically (see
+    # storage_io.atomic_write), so readers never find a partial file.
+    #
+    # Part files of the dataset are written with the compact schema of their type.
+    #
+    # OUTPUT:
+    #   - file_path of the new part file
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    file_path = os.path.join(directory, f'part-{time.time_ns()}-{os.getpid()}.parquet')
+    table = cast_compact_table(pa.Table.from_pandas(df), get_path_type_name(directory))
+    with atomic_write(file_path) as file:
+        pq.write_table(table, file, row_group_size=row_group_rows)
+
+    # The twin is written before the part file is added to the manifest
+    month_index = get_path_month_index(directory)
+    if month_index is not None and is_hot_month(month_index):
+        write_hot_part_file(file_path, table)
+
+    return file_path
+
+def get_path_month_index(file_path:str) -> int:
+    # Returns year*12 + month-1 of the month a dataset path belongs to, None if it is not a
+    # month (or bucket) path
+    match = re.search(r'year=(\d+)[\\/]month=(\d+)', file_path)
+    return None if match is None else int(match[1]) * 12 + int(match[2]) - 1
+
+def is_hot_month(month_index:int) -> bool:
+    # Checks if a month belongs to the hot tier
+    return month_index > get_month_index(time.time()) - HOT_TIER_MONTHS
+
+def get_hot_path(file_path:str) -> str:
+    # Returns the path of the Arrow IPC twin of a part file
+    return os.path.splitext(file_path)[0] + '.arrow'
+
+def write_hot_part_file(file_path:str, table:pa.Table):
+    # Writes the uncompressed Arrow IPC twin of a part file, with a record batch per row group
+    # of the part file so that the VIN index applies to both
+    metadata = pq.ParquetFile(file_path).metadata
+    table = table.combine_chunks()
+
+    with atomic_write(get_hot_path(file_path)) as file:
+        with pa.ipc.new_file(file, table.schema) as writer:
+            offset = 0
+            for row_group in range(metadata.num_row_groups):
+                num_rows = metadata.row_group(row_group).num_rows
+                writer.write_table(table.slice(offset, num_rows), max_chunksize=max(num_rows, 1))
+                offset += num_rows
+
+def read_part_table(file_path:str, columns:list=None, row_groups:list=None, filters:list=None) -> pa.Table:
+    # Reads a part file, through its memory-mapped Arrow IPC twin if it has one, with the
+    # compact schema of its type. The VIN column (the index) is always read
+    #
+    # INPUT:
+    #   - columns: columns to read, all of them by default
+    #   - row_groups: row groups to read, all of them by default
+    #   - filters: row filters, in pyarrow.parquet format (e.g. [('VIN', 'in', vins)])
+
+    try:
+        reader = pa.ipc.open_file(pa.memory_map(get_hot_path(file_path)))
+        if row_groups is None:
+            table = reader.read_all()
+        else:
+            table = pa.Table.from_batches([reader.get_batch(row_group) for row_group in row_groups], schema=reader.schema)
+
+        if filters is not None:
+            table = table.filter(pq.filters_to_expression(filters))
+        if columns is not None:
+            index_columns = [VIN_COLUMN] if VIN_COLUMN in table.column_names and VIN_COLUMN not in columns else []
+            table = table.select(list(columns) + index_columns)
+
+    # Not in the hot tier (or pruned meanwhile)
+    except FileNotFoundError:
+        if row_groups is None:
+            table = pq.read_table(file_path, columns=columns, filters=filters, use_pandas_metadata=True, partitioning=None)
+        else:
+            table = pq.ParquetFile(file_path).read_row_groups(row_groups, columns=columns, use_pandas_metadata=True)
+            if filters is not None:
+                table = table.filter(pq.filters_to_expression(filters))
+
+    return cast_compact_table(table, get_path_type_name(file_path))
+
+def concat_part_tables(tables:list) -> pa.Table:
+    # Concatenates tables read with read_part_table. Columns left with a wider type in some of
+    # them are cast to a type all of them fit in, and columns missing in some of them are
+    # filled with nulls
+    if all(table.schema.equals(tables[0].schema) for table in tables[1:]):
+        return pa.concat_tables(tables)
+
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            if field.type not in types.setdefault(field.name, []):
+                types[field.name].append(field.type)
+
+    # The first type every column can be cast to, the null type last
+    fields = []
+    for name, column_types in types.items():
+        if len(column_types) == 1:
+            fields.append(pa.field(name, column_types[0]))
+            continue
+        column_types = sorted(column_types, key=lambda column_type: column_type == pa.null())
+        for column_type in column_types:
+            try:
+                tables = [table if name not in table.column_names else
+                          table.set_column(table.column_names.index(name), pa.field(name, column_type), table.column(name).cast(column_type))
+                          for table in tables]
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                continue
+            fields.append(pa.field(name, column_type))
+            break
+        else:
+            raise pa.ArrowInvalid(f'Column {name} has incompatible types {column_types}')
+
+    schema = pa.schema(fields, metadata=tables[0].schema.metadata)
+    tables = [pa.table([table.column(field.name) if field.name in table.column_names else pa.nulls(table.num_rows, field.type)
+                        for field in schema], schema=schema)
+              for table in tables]
+
+    return pa.concat_tables(tables)
+
+def prune_hot_tier(directory:str=DATASET_DIRECTORY) -> int:
+    # Deletes the Arrow IPC twins of the months that don't belong to the hot tier anymore
+    #
+    # OUTPUT:
+    #   - number of twins deleted
+
+    num_deleted = 0
+    for root, directories, filenames in os.walk(directory):
+        month_index = get_path_month_index(root)
+        if month_index is None or is_hot_month(month_index):
+            continue
+        for filename in filenames:
+            if filename.endswith('.arrow'):
+                os.remove(os.path.join(root, filename))
+                num_deleted += 1
+
+    return num_deleted
+
+def write_sorted_part_file(directory:str, df:pd.DataFrame, row_group_rows:int=None) -> tuple:
+    # Writes df sorted by VIN as a new part file of directory (see write_part_file)
+    #
+    # OUTPUT:
+    #   - file_path of the new part file
+    #   - vin_row_groups: {VIN: [first row group, last row group]} of the part file
+
+    df = df.sort_index(kind='stable')
+    file_path = write_part_file(directory, df, row_group_rows)
+
+    # First row of every row group, then the row groups of the first and last row of every VIN
+    metadata = pq.ParquetFile(file_path).metadata
+    row_group_starts = np.cumsum([0] + [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])[:-1]
+    vins = df.index.astype(str).to_numpy()
+    is_first = np.r_[True, vins[1:] != vins[:-1]]
+    first_rows = np.flatnonzero(is_first)
+    last_rows = np.r_[first_rows[1:] - 1, len(vins) - 1]
+
+    first_groups = np.searchsorted(row_group_starts, first_rows, side='right') - 1
+    last_groups = np.searchsorted(row_group_starts, last_rows, side='right') - 1
+    vin_row_groups = {vin: [int(first), int(last)] for vin, first, last in zip(vins[first_rows], first_groups, last_groups)}
+
+    return file_path, vin_row_groups
+
+def load_manifest(directory:str) -> dict:
+    # Returns the manifest of directory: {'parts': [filename], 'retired': [[filename, time]],
+    # 'vin_index': {filename: {VIN: [first row group, last row group]}}}. Directories without
+    # manifest list all their part files
+    manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as file:
+            return json.load(file)
+
+    filenames = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+    return {'parts':     [filename for filename in filenames if filename.startswith('part-') and filename.endswith('.parquet')],
+            'retired':   [],
+            'vin_index': {}}
+
+def save_manifest(directory:str, manifest:dict):
+    # Replaces the manifest of directory atomically
+    with atomic_write(os.path.join(directory, MANIFEST_FILENAME), 'w') as file:
+        json.dump(manifest, file)
+
+def update_manifest(directory:str, added:list=(), removed:list=(), vin_row_groups:list=None) -> dict:
+    # Adds and removes part files from the manifest of directory in a single replacement.
+    # Removed part files are moved to the retired list with the current time. The caller must
+    # hold the lock of the directory (storage_io.partition_lock)
+    #
+    # INPUT:
+    #   - added, removed: paths of the part files
+    #   - vin_row_groups: VIN index of every added part file (see write_sorted_part_file)
+
+    manifest = load_manifest(directory)
+    vin_index = manifest.setdefault('vin_index', {})
+    removed = [os.path.basename(file_path) for file_path in removed]
+
+    manifest['parts'] = [filename for filename in manifest['parts'] if filename not in removed]
+    manifest['parts'] += [os.path.basename(file_path) for file_path in added if os.path.basename(file_path) not in manifest['parts']]
+    manifest['retired'] += [[filename, time.time()] for filename in removed]
+
+    for filename in removed:
+        vin_index.pop(filename, None)
+    for file_path, row_groups in zip(added, vin_row_groups or []):
+        vin_index[os.path.basename(file_path)] = row_groups
+    save_manifest(directory, manifest)
 
+    return manifest
+
+def get_part_files(directory:str) -> list:
+    # Returns the paths of the part files of directory, in the order they were written
+    if not os.path.isdir(directory):
+        return []
+
+    return [os.path.join(directory, filename) for filename in load_manifest(directory)['parts']]
+
+def get_month_part_files(file_path:str) -> list:
+    # Returns the part files of every VIN bucket of a month
+    part_files = []
+    if os.path.isdir(file_path):
+        for bucket_directory in sorted(os.listdir(file_path)):
+            if bucket_directory.startswith('vin_bucket='):
+                part_files += get_part_files(os.path.join(file_path, bucket_directory))
+
+    return part_files
+
+def df_read_bucket_vins(directory:str, vins:list, columns:list=None) -> list:
+    # Reads the rows of the given VINs stored in a bucket. Only the row groups the VIN index
+    # of the manifest maps them to are read (the whole part file, filtered, if it has no VIN
+    # index)
+    #
+    # OUTPUT:
+    #   - frames: rows of every part file that contains any of the VINs
+
+    manifest = load_manifest(directory)
+    vin_index = manifest.get('vin_index', {})
+    vins = [str(vin) for vin in vins]
+
+    frames = []
+    for filename in manifest['parts']:
+        file_path = os.path.join(directory, filename)
+        if filename in vin_index:
+            row_groups = sorted({row_group for vin in vins if vin in vin_index[filename]
+                                 for row_group in range(vin_index[filename][vin][0], vin_index[filename][vin][1] + 1)})
+            if not row_groups:
+                continue
+            table = read_part_table(file_path, columns, row_groups)
+        else:
+            table = read_part_table(file_path, columns, filters=[(VIN_COLUMN, 'in', vins)])
+
+        # Row groups can be shared with other VINs
+        df = table.to_pandas()
+        df = df[df.index.astype(str).isin(vins)]
+        if not df.empty:
+            frames.append(df)
+
+    return frames
+
+def df_read_month(file_path:str, columns:list=None, vins:list=None) -> pd.DataFrame:
+    # Reads all the data stored for a month
+    #
+    # INPUT:
+    #   - file_path: month path (see get_month_path), or a month file of the old layout
+    #     (df/YYYY_MM_type.parquet)
+    #   - columns: columns to read, all of them by default
+    #   - vins: only read these vehicles. Only the row groups of these VINs are read
+    #
+    # OUTPUT:
+    #   - -1 if the month does not exist (or has no rows of vins)
+    #   - df: union of all the part files
+
+    if os.path.isfile(file_path):
+        df = pd.read_parquet(file_path, columns=columns)
+        return df if vins is None else df[df.index.isin(vins)]
+
+    # Only the row groups of the VINs of their buckets are read
+    if vins is not None and os.path.basename(file_path).startswith('month='):
+        frames = []
+        for bucket in np.unique(get_vin_buckets(vins)):
+            frames += df_read_bucket_vins(os.path.join(file_path, f'vin_bucket={bucket:02}'), vins, columns)
+        return pd.concat(frames) if frames else -1
+
+    part_files = get_month_part_files(file_path)
+    if not part_files:
+        return -1
+
+    # Part files of the hot tier are memory-mapped
+    df = concat_part_tables([read_part_table(part_file, columns) for part_file in part_files]).to_pandas()
+    if vins is not None:
+        df = df[df.index.isin(vins)]
+
+    return df
+
+def get_key_hashes(df:pd.DataFrame, type_name:str) -> np.ndarray:
+    # Returns a 64-bit hash of the key (VIN and key fields) of every row of df
+    df_keys = pd.DataFrame({VIN_COLUMN: df.index.astype(str)})
+    for column in KEY_FIELDS[type_name]:
+        df_keys[column] = df[column].to_numpy(dtype=np.float64)
+
+    return pd.util.hash_pandas_object(df_keys, index=False).to_numpy()
+
+def load_key_index(directory:str, type_name:str) -> np.ndarray:
+    # Returns the sorted key hashes of the rows stored in a bucket. If the bucket has no key
+    # index yet (e.g. it was written before key indexes were used), it is built from the key
+    # columns of its part files
+    key_index_path = os.path.join(directory, KEY_INDEX_FILENAME)
+    if os.path.exists(key_index_path):
+        return np.load(key_index_path)
+
+    part_files = get_part_files(directory)
+    if not part_files:
+        return np.empty(0, dtype=np.uint64)
+
+    df_keys = concat_part_tables([read_part_table(part_file, KEY_FIELDS[type_name]) for part_file in part_files]).to_pandas()
+    return np.unique(get_key_hashes(df_keys, type_name))
+
+def save_key_index(directory:str, key_index:np.ndarray):
+    # Replaces the key index of a bucket atomically
+    with atomic_write(os.path.join(directory, KEY_INDEX_FILENAME)) as file:
+        np.save(file, key_index)
+
+def df_append_month_parts(file_path:str, df_new:pd.DataFrame, type_name:str) -> pd.DataFrame:
+    # Appends df_new to a month by writing a new part file in every VIN bucket it has rows
+    # of. Rows whose key is already stored in their bucket are dropped: their hashes are looked
+    # up in the key index of the bucket, so neither the stored rows nor their keys are read
+    #
+    # INPUT:
+    #   - file_path: month path (see get_month_path)
+    #   - df_new: dataframe containing new data to be stored, indexed by VIN
+    #   - type_name: 'trip' or 'charge'
+    #
+    # OUTPUT:
+    #   - df_written: rows that have been stored
+
+    hashes = get_key_hashes(df_new, type_name)
+    is_first = ~pd.Series(hashes).duplicated().to_numpy()
+    df_new, hashes = df_new[is_first], hashes[is_first]
+    buckets = get_vin_buckets(df_new.index)
+
+    written = []
+    for bucket in np.unique(buckets):
+        bucket_path = os.path.join(file_path, f'vin_bucket={bucket:02}')
+        df_bucket, bucket_hashes = df_new[buckets == bucket], hashes[buckets == bucket]
+
+        # The key index and the manifest of the bucket are read and replaced by a single process
+        # at a time
+        with partition_lock(bucket_path):
+            # Vectorized membership test of the new keys in the sorted key index
+            key_index = load_key_index(bucket_path, type_name)
+            is_stored = np.zeros(len(bucket_hashes), dtype=bool)
+            if len(key_index) > 0:
+                positions = np.minimum(np.searchsorted(key_index, bucket_hashes), len(key_index) - 1)
+                is_stored = key_index[positions] == bucket_hashes
+            df_bucket, bucket_hashes = df_bucket[~is_stored], bucket_hashes[~is_stored]
+
+            if not df_bucket.empty:
+                part_file, vin_row_groups = write_sorted_part_file(bucket_path, df_bucket)
+                update_manifest(bucket_path, added=[part_file], vin_row_groups=[vin_row_groups])
+
+                new_hashes = np.sort(bucket_hashes)
+                save_key_index(bucket_path, np.insert(key_index, np.searchsorted(key_index, new_hashes), new_hashes))
+                written.append(df_bucket)
+
+    return pd.concat(written) if written else df_new.iloc[:0]
+
+def migrate_legacy_months(directory:str='df') -> int:
+    # Moves the months stored with the old layout (df/YYYY_MM_type.parquet files) into the
+    # dataset, and splits the critical data of the vehicles by month
+    # (see migrate_legacy_vehicle_critical_data)
+    #
+    # OUTPUT:
+    #   - number of months migrated
+
+    if not os.path.isdir(directory):
+        return 0
+
+    migrate_legacy_vehicle_critical_data()
+
+    num_months = 0
+    for filename in sorted(os.listdir(directory)):
+        match = LEGACY_MONTH_PATTERN.match(filename)
+        if match is None or not os.path.isfile(os.path.join(directory, filename)):
+            continue
+
+        legacy_path = os.path.join(directory, filename)
+        year, month, type_name = int(match[1]), int(match[2]), match[3]
+
+        with month_lock(year, month):
+            # Another process may have migrated it meanwhile
+            if not os.path.exists(legacy_path):
+                continue
+
+            df_legacy = df_read_month(legacy_path)
+            if isinstance(df_legacy, pd.DataFrame):
+                df_append_month_parts(get_month_path(year, month, type_name), df_legacy, type_name)
+
+            # The state of the month is rebuilt the next time it is needed
+            state_path = get_month_state_path(year, month)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+
+            # If the migration is interrupted before this point, it is repeated and the key
+            # indexes drop the rows already migrated
+            os.remove(legacy_path)
+            num_months += 1
+
+    return num_months
+
+def get_dataset_buckets(type_name:str, month_min:int=None, month_max:int=None, buckets:list=None) -> list:
+    # Returns the bucket directories of type_name in the months (year*12 + month-1) between
+    # month_min and month_max and in the given VIN buckets. Other directories are not opened
+    bucket_directories = []
+    type_directory = f'{DATASET_DIRECTORY}/type={type_name}'
+    if not os.path.isdir(type_directory):
+        return bucket_directories
+
+    for year_directory in sorted(os.listdir(type_directory)):
+        if not year_directory.startswith('year='):
+            continue
+        for month_directory in sorted(os.listdir(os.path.join(type_directory, year_directory))):
+            if not month_directory.startswith('month='):
+                continue
+            month_index = int(year_directory[5:]) * 12 + int(month_directory[6:]) - 1
+            if (month_min is not None and month_index < month_min) or (month_max is not None and month_index > month_max):
+                continue
+
+            month_path = os.path.join(type_directory, year_directory, month_directory)
+            for bucket_directory in sorted(os.listdir(month_path)):
+                if bucket_directory.startswith('vin_bucket=') and (buckets is None or int(bucket_directory[11:]) in buckets):
+                    bucket_directories.append(os.path.join(month_path, bucket_directory))
+
+    return bucket_directories
+
+def get_month_index(timestamp:float) -> int:
+    # Returns year*12 + month-1 of a UNIX timestamp (UTC)
+    date = datetime.datetime.utcfromtimestamp(timestamp)
+    return date.year * 12 + date.month - 1
+
+def df_read_vehicle(vin:str, type_name:str, start:float=None, end:float=None, columns:list=None) -> pd.DataFrame:
+    # Reads the records of a single vehicle. Only the bucket of the VIN of every month between
+    # start and end is opened, and only the row groups its VIN index points to are read, so the
+    # cost does not depend on the size of the fleet
+    #
+    # INPUT:
+    #   - vin: VIN of the vehicle
+    #   - type_name: 'trip' or 'charge'
+    #   - start, end: UNIX timestamps, records with start <= timestamp < end are read
+    #   - columns: columns to read, all of them by default
+    #
+    # OUTPUT:
+    #   - -1 if there are no records of the vehicle
+    #   - df: records of the vehicle, indexed by VIN
+
+    timestamp_column = TIMESTAMP_COLUMNS[type_name]
+    read_columns = columns
+    if columns is not None and (start is not None or end is not None) and timestamp_column not in columns:
+        read_columns = list(columns) + [timestamp_column]
+
+    frames = []
+    bucket = int(get_vin_buckets([vin])[0])
+    month_min = None if start is None else get_month_index(start)
+    month_max = None if end is None else get_month_index(end)
+    for bucket_directory in get_dataset_buckets(type_name, month_min, month_max, [bucket]):
+        frames += df_read_bucket_vins(bucket_directory, [vin], read_columns)
+
+    if not frames:
+        return -1
+
+    df = pd.concat(frames)
+    if start is not None:
+        df = df[df[timestamp_column] >= start]
+    if end is not None:
+        df = df[df[timestamp_column] < end]
+
+    return df if columns is None else df[list(columns)]
+
+def df_query(type_name:str, vins:list=None, start:float=None, end:float=None, columns:list=None) -> pd.DataFrame:
+    # Reads the records of type_name that match the filters. Months outside [start, end) and
+    # buckets without the requested VINs are not opened, and the filters are pushed down to the
+    # remaining part files so row groups whose statistics can't match are skipped.
+    #
+    # INPUT:
+    #   - type_name: 'trip' or 'charge'
+    #   - vins: VINs to read, all of them by default
+    #   - start, end: UNIX timestamps, records with start <= timestamp < end are read
+    #   - columns: columns to read, all of them by default
+    #
+    # OUTPUT:
+    #   - -1 if there is no data of type_name
+    #   - df: records indexed by VIN
+
+    timestamp_column = TIMESTAMP_COLUMNS[type_name]
+    month_min = month_max = buckets = None
+    conditions = []
+
+    if vins is not None:
+        buckets = np.unique(get_vin_buckets(vins)).tolist()
+        conditions.append(ds.field(VIN_COLUMN).isin(list(vins)))
+    if start is not None:
+        month_min = get_month_index(start)
+        conditions.append(ds.field(timestamp_column) >= start)
+    if end is not None:
+        month_max = get_month_index(end)
+        conditions.append(ds.field(timestamp_column) < end)
+
+    # Only the part files listed in the manifests are read
+    part_files = [part_file for bucket_directory in get_dataset_buckets(type_name, month_min, month_max, buckets)
+                  for part_file in get_part_files(bucket_directory)]
+    if not part_files:
+        return -1
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    # Part files of the hot tier are read through their Arrow IPC twins
+    hot_files = [get_hot_path(part_file) for part_file in part_files if os.path.exists(get_hot_path(part_file))]
+    cold_files = [part_file for part_file in part_files if not os.path.exists(get_hot_path(part_file))]
+    # Every part file is read with the compact schema, whatever schema it was written with
+    schema = get_compact_schema(pq.read_schema(part_files[0]), type_name)
+    datasets = [ds.dataset(files, schema=schema, format=file_format) for files, file_format in [(cold_files, 'parquet'), (hot_files, 'ipc')] if files]
+    dataset = datasets[0] if len(datasets) == 1 else ds.dataset(datasets)
+    if columns is not None and VIN_COLUMN not in columns:
+        columns = list(columns) + [VIN_COLUMN]
+
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    if VIN_COLUMN in df.columns:
+        df = df.set_index(VIN_COLUMN)
+
+    return df
+
+def get_month_state_path(year:int, month:int) -> str:
+    # Returns the path of the state of a month
+    return f'{CRITICAL_STATE_DIRECTORY}/{year}_{month:02}.parquet'
+
+def month_lock(year:int, month:int):
+    # Returns the lock of a month. It is held while rows are appended to the month and its
+    # state is updated, so the state always matches the stored rows
+    return file_lock(f'{CRITICAL_STATE_DIRECTORY}/{year}_{month:02}.lock')
+
+def merge_month_states(states:list) -> pd.DataFrame:
+    # Merges month states (or deltas of them) VIN by VIN. Empty states are left out of the
+    # concatenation, their missing columns are added back by reindex
+    states = [state for state in states if not state.empty] or states[:1]
+    df_state = pd.concat(states).reindex(columns=MONTH_STATE_COLUMNS).groupby(level=0, observed=True).agg({column: ('max' if column == 'Max odometer' else 'sum')
+                                                      for column in MONTH_STATE_COLUMNS})
+    df_state[MONTH_STATE_COUNTS] = df_state[MONTH_STATE_COUNTS].astype(np.int64)
+
+    return df_state
+
+def get_exact_values(series:pd.Series) -> pd.Series:
+    # Returns series as float64. Values stored as float32 (see STORAGE_DTYPES) are rounded to the
+    # FLOAT32_DIGITS significant digits float32 keeps, so they become the decimal they were
+    # computed as (240.4) instead of its float32 approximation (240.40000915527344)
+    if series.dtype != np.float32:
+        return series.astype(np.float64)
+
+    values = series.to_numpy(dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponents = FLOAT32_DIGITS - 1 - np.floor(np.log10(np.abs(values)))
+    exponents = np.where(np.isfinite(exponents), exponents, 0)
+
+    # Powers of ten are exact in float64 (unlike their inverses), so they are only used to multiply
+    # or divide
+    scales = 10.0 ** np.abs(exponents)
+    values = np.where(exponents >= 0, np.round(values * scales) / scales, np.round(values / scales) * scales)
+
+    return pd.Series(values, index=series.index, name=series.name)
+
+def df_get_month_state(df_trip:pd.DataFrame=None, df_charge:pd.DataFrame=None) -> pd.DataFrame:
+    # Computes the state of the given (filtered) trips and charges
+    #
+    # OUTPUT:
+    #   - df_state: MONTH_STATE_COLUMNS of every VIN
+    
+    states = [pd.DataFrame(columns=MONTH_STATE_COLUMNS, dtype=np.float64)]
+
+    # Stored columns can be float32, aggregates are kept as float64 of their exact values
+    if isinstance(df_trip, pd.DataFrame) and not df_trip.empty:
+        df_trip = df_trip.assign(**{column: get_exact_values(df_trip[column]) for column in [*TRIP_STATE_SUMS, 'End odometer']})
+        grouped_trips = df_trip.groupby(level=0, observed=True)
+        df_trip_state = grouped_trips[TRIP_STATE_SUMS].sum()
+        df_trip_state['Trips'] = grouped_trips.size()
+        df_trip_state['Max odometer'] = grouped_trips['End odometer'].max()
+        states.append(df_trip_state)
+
+    if isinstance(df_charge, pd.DataFrame) and not df_charge.empty:
+        states.append(pd.DataFrame({'Charges':          1,
+                                    'Charged SoC':      get_exact_values(df_charge['uSoC F']) - get_exact_values(df_charge['uSoC I']),
+                                    'Final SoC':        get_exact_values(df_charge['uSoC F']),
+                                    'Shucko charges':   (df_charge['Connector'] == 0).astype(np.int64)},
+                                   index=df_charge.index).groupby(level=0, observed=True).sum())
+
+    return merge_month_states(states)
+
+def df_load_month_state(year:int, month:int) -> pd.DataFrame:
+    # Returns the state of a month, -1 if it has not been stored
+    state_path = get_month_state_path(year, month)
+    if not os.path.exists(state_path):
+        return -1
+
+    return pd.read_parquet(state_path)
+
+def df_save_month_state(df_state:pd.DataFrame, year:int, month:int):
+    # Stores the state of a month. It is written atomically, so readers never find a
+    # partial file
+    with atomic_write(get_month_state_path(year, month)) as file:
+        pq.write_table(pa.Table.from_pandas(df_state), file)
+
+def df_rebuild_month_state(year:int, month:int) -> pd.DataFrame:
+    # Computes the state of a month from all its stored data and stores it
+    df_state = df_get_month_state(df_read_month(get_month_path(year, month, 'trip')),
+                                  df_read_month(get_month_path(year, month, 'charge')))
+    df_save_month_state(df_state, year, month)
+
+    return df_state
+
+def df_update_month_state(df_new:pd.DataFrame, type_name:str, year:int, month:int) -> pd.DataFrame:
+    # Adds the rows just appended to a month to its state. Only df_new is read, unless the
+    # state is missing and has to be rebuilt (df_new is already stored then). The caller must
+    # hold the lock of the month (month_lock)
+    #
+    # OUTPUT:
+    #   - df_state: updated state of the month
+
+    df_state = df_load_month_state(year, month)
+    if not isinstance(df_state, pd.DataFrame):
+        return df_rebuild_month_state(year, month)
+
+    if type_name == 'trip':
+        df_delta = df_get_month_state(df_trip=df_new)
+    else:
+        df_delta = df_get_month_state(df_charge=df_new)
+
+    df_state = merge_month_states([df_state, df_delta])
+    df_save_month_state(df_state, year, month)
+
+    return df_state
+
+def df_generate_month_df_from_state(df_state:pd.DataFrame, year:int, month:int) -> pd.DataFrame:
+    # Generates the critical data of a month from its state. Its cost depends on the number
+    # of vehicles, not on the number of trips and charges of the month
+    #
+    # OUTPUT
+    #   - df_month
+
+    totals = df_state.sum()
+    df_vehicles = df_state[df_state['Trips'] > 0]
+    consumption = (totals['Total energy'] - totals['Total regen']) / totals['Total distance']
+
+    new_row = {
+        'Connected vehicles':           df_vehicles.shape[0],
+        'Total distance':               round(totals['Total distance']),
+        'City percentage':              round(100*totals['City distance']/totals['Total distance']),
+        'Sport percentage':             round(100*totals['Sport distance']/totals['Total distance']),
+        'Flow percentage':              round(100*totals['Sport distance']/totals['Total distance']),
+        'Average trip distance':        round(totals['Total distance']/totals['Trips']),
+        'Average consumption':          round(consumption),
+        'Average range':                round(7500/consumption),
+        'Average charged SoC':          round(totals['Charged SoC']/totals['Charges']),
+        'Average final charging SoC':   round(totals['Final SoC']/totals['Charges']),
+        'Shucko':                       round(totals['Shucko charges']*100/totals['Charges']),
+        'Max km in month':              df_vehicles['Total distance'].idxmax(),
+        'Max km in month VIN':          df_vehicles['Total distance'].max(),
+        'Max km odometer':              df_vehicles['Max odometer'].max(),
+        'Max km odometer VIN':          df_vehicles['Max odometer'].idxmax(),
+        'Trips between charges':        round(totals['Trips']/totals['Charges'],1)
+    }
+
+    df_month = pd.DataFrame([new_row])
+
+    # Generate the date string and update df_month
+    date_string = f'{year}-{month:02}'
+    date = np.datetime64(date_string)
+    df_month['Date'] = [date]
+
+    return df_month
+
+def df_generate_vehicle_month_df_from_state(df_state:pd.DataFrame, year:int, month:int) -> pd.DataFrame:
+    # Generates the critical data of every vehicle of a month from its state, with the same
+    # metrics as df_generate_month_df_from_state. KPIs of vehicles without trips (or without
+    # charges) are NaN
+    #
+    # OUTPUT
+    #   - df_vehicle_month: a row per VIN
+
+    df_state = df_state.astype(np.float64)
+    consumption = (df_state['Total energy'] - df_state['Total regen']) / df_state['Total distance']
+
+    df_vehicle_month = pd.DataFrame({
+        VIN_COLUMN:                     df_state.index.astype(str),
+        'Date':                         np.datetime64(f'{year}-{month:02}', 'ns'),
+        'Trips':                        df_state['Trips'].to_numpy(dtype=np.int64),
+        'Total distance':               df_state['Total distance'].round(),
+        'City percentage':              (100*df_state['City distance']/df_state['Total distance']).round(),
+        'Sport percentage':             (100*df_state['Sport distance']/df_state['Total distance']).round(),
+        'Flow percentage':              (100*df_state['Sport distance']/df_state['Total distance']).round(),
+        'Average trip distance':        (df_state['Total distance']/df_state['Trips']).round(),
+        'Average consumption':          consumption.round(),
+        'Average range':                (7500/consumption).round(),
+        'Charges':                      df_state['Charges'].to_numpy(dtype=np.int64),
+        'Average charged SoC':          (df_state['Charged SoC']/df_state['Charges']).round(),
+        'Average final charging SoC':   (df_state['Final SoC']/df_state['Charges']).round(),
+        'Shucko':                       (df_state['Shucko charges']*100/df_state['Charges']).round(),
+        'Max odometer':                 df_state['Max odometer'],
+        'Trips between charges':        (df_state['Trips']/df_state['Charges']).round(1)
+    }).reset_index(drop=True)
+
+    # Divisions by zero (no distance, no charges)
+    return df_vehicle_month.replace([np.inf, -np.inf], np.nan)
+
+def get_vehicle_critical_data_path(year:int, month:int) -> str:
+    # Returns the path of the critical data of the vehicles of a month
+    return f'{VEHICLE_CRITICAL_DATA_DIRECTORY}/{year}_{month:02}.parquet'
+
+def df_add_month_to_vehicle_critical_data(df_state:pd.DataFrame, year:int, month:int) -> pd.DataFrame:
+    # Replaces the critical data of every vehicle of a month. Only the file of the month is
+    # written, and it is written holding the lock of the month (see month_lock), so months are
+    # refreshed independently
+    #
+    # INPUT:
+    #   - df_state: state of the month (see df_get_month_state)
+    #
+    # OUTPUT:
+    #   - df_vehicle_month: rows that have been stored
+
+    df_vehicle_month = df_generate_vehicle_month_df_from_state(df_state, year, month)
+    df_vehicle_month = df_vehicle_month.sort_values(by=VIN_COLUMN, ignore_index=True)
+
+    table = pa.Table.from_pandas(df_vehicle_month, preserve_index=False)
+    with atomic_write(get_vehicle_critical_data_path(year, month)) as file:
+        pq.write_table(table, file, row_group_size=VEHICLE_CRITICAL_DATA_ROW_GROUP_ROWS)
+
+    return df_vehicle_month
+
+def df_rebuild_vehicle_critical_data() -> pd.DataFrame:
+    # Generates the critical data of every vehicle for all the months of the dataset (e.g. for
+    # months appended before it existed). Month states are rebuilt if they are missing
+    #
+    # OUTPUT:
+    #   - -1 if there are no months stored
+    #   - df_vehicle_critical_data: rows that have been stored
+
+    months = {divmod(get_path_month_index(bucket_directory), 12) for type_name in TIMESTAMP_COLUMNS
+              for bucket_directory in get_dataset_buckets(type_name)}
+    if not months:
+        return -1
+
+    frames = []
+    for year, month in sorted(months):
+        with month_lock(year, month + 1):
+            df_state = df_load_month_state(year, month + 1)
+            if not isinstance(df_state, pd.DataFrame):
+                df_state = df_rebuild_month_state(year, month + 1)
+            frames.append(df_add_month_to_vehicle_critical_data(df_state, year, month + 1))
+
+    return pd.concat(frames, ignore_index=True)
+
+def migrate_legacy_vehicle_critical_data() -> int:
+    # Splits the critical data of the vehicles stored in a single file (VEHICLE_CRITICAL_DATA_FILE_PATH)
+    # into a file per month. Months that already have their own file keep it
+    #
+    # OUTPUT:
+    #   - number of months migrated
+
+    if not os.path.exists(VEHICLE_CRITICAL_DATA_FILE_PATH):
+        return 0
+
+    num_months = 0
+    with file_lock(VEHICLE_CRITICAL_DATA_FILE_PATH + '.lock'):
+        # Another process may have migrated it meanwhile
+        if not os.path.exists(VEHICLE_CRITICAL_DATA_FILE_PATH):
+            return 0
+
+        df_legacy = pd.read_parquet(VEHICLE_CRITICAL_DATA_FILE_PATH)
+        for date, df_vehicle_month in df_legacy.groupby('Date', sort=True):
+            year, month = date.year, date.month
+            with month_lock(year, month):
+                file_path = get_vehicle_critical_data_path(year, month)
+                if os.path.exists(file_path):
+                    continue
+                table = pa.Table.from_pandas(df_vehicle_month.sort_values(by=VIN_COLUMN, ignore_index=True), preserve_index=False)
+                with atomic_write(file_path) as file:
+                    pq.write_table(table, file, row_group_size=VEHICLE_CRITICAL_DATA_ROW_GROUP_ROWS)
+                num_months += 1
+
+        os.remove(VEHICLE_CRITICAL_DATA_FILE_PATH)
+
+    return num_months
 
 def find_max_distance(df):
     
@@ -80,47 +986,22 @@ def df_generate_month_df(file_path_trip:str,file_path_charge:str,year:int,month:
     #   - -1 if no file matches the date
     #   - df_month
 
-    if not (os.path.exists(file_path_trip) and os.path.exists(file_path_charge)):
-        return -1
-    
-    df_trip = pd.read_parquet(file_path_trip)
-    df_charge = pd.read_parquet(file_path_charge)
-
-    # Check if key_user is a VIN and if it is stored in both trip and charge dataframes.
-    # Otherwise, it will proceed calculating the overall critical data.
-    if key_user != '' and key_user in df_trip.index and key_user in df_charge.index:
-        df_trip = df_trip[df_trip.index == key_user]
-        df_charge = df_charge[df_charge.index == key_user]
+    # Check if key_user is a VIN and if it is stored in both trip and charge months, only
+    # its rows are read then. Otherwise, it will proceed calculating the overall critical data.
+    if key_user != '':
+        df_trip = df_read_month(file_path_trip, vins=[key_user])
+        df_charge = df_read_month(file_path_charge, vins=[key_user])
+        if isinstance(df_trip,pd.DataFrame) and isinstance(df_charge,pd.DataFrame):
+            return df_generate_month_df_from_state(df_get_month_state(df_trip, df_charge), year, month)
 
-    # Generate a dictionary with all data of interest, using both df_trip and df_charge
-    # to do so
-    new_row = {
-        'Connected vehicles':           df_trip.index.nunique(),
-        'Total distance':               round(sum(df_trip["Total distance"])),
-        'City percentage':              round(100*sum(df_trip["City distance"])/sum(df_trip['Total distance'])),
-        'Sport percentage':             round(100*sum(df_trip["Sport distance"])/sum(df_trip['Total distance'])),
-        'Flow percentage':              round(100*sum(df_trip["Sport distance"])/sum(df_trip['Total distance'])),  
-        'Average trip distance':        round(df_trip["Total distance"].mean()),
-        'Average consumption':          round(((sum(df_trip["Total energy"]) - sum(df_trip["Total regen"])) / sum(df_trip["Total distance"]))),
-        'Average range':                round(7500/((sum(df_trip["Total energy"]) - sum(df_trip["Total regen"])) / sum(df_trip["Total distance"]))),
-        'Average charged SoC':          round((df_charge['uSoC F']-df_charge['uSoC I']).mean()),
-        'Average final charging SoC':   round(df_charge['uSoC F'].mean()),
-        'Shucko':                       round(len(df_charge["Connector"][df_charge["Connector"] == 0])*100/df_charge.shape[0]),
-        'Max km in month':              find_max_distance(df_trip)[1],
-        'Max km in month VIN':          find_max_distance(df_trip)[0],
-        'Max km odometer':              df_trip['End odometer'].max(),
-        'Max km odometer VIN':          df_trip['End odometer'].idxmax(),
-        'Trips between charges':        round(df_trip.shape[0]/df_charge.shape[0],1)                         
-    }
+    df_trip = df_read_month(file_path_trip)
+    df_charge = df_read_month(file_path_charge)
 
-    df_month = pd.DataFrame([new_row])
-    
-    # Generate the date string and update df_month
-    date_string = f'{year}-{month:02}'
-    date = np.datetime64(date_string)
-    df_month['Date'] = [date]
+    if not (isinstance(df_trip,pd.DataFrame) and isinstance(df_charge,pd.DataFrame)):
+        return -1
 
-    return df_month
+    # Compute all data of interest from the state of df_trip and df_charge
+    return df_generate_month_df_from_state(df_get_month_state(df_trip, df_charge), year, month)
 
 def df_add_df_to_parquet_file(file_path:str,df_new:pd.DataFrame) -> pd.DataFrame:
     # This function will generate and modify a new .parquet given a filename
@@ -138,106 +1019,147 @@ def df_add_df_to_parquet_file(file_path:str,df_new:pd.DataFrame) -> pd.DataFrame
     # 
     # OUTPUT:
     #   - Resulting dataframe
+    #
+    # Months are not stored with this function anymore (see df_append_month_parts), it is
+    # only used for the critical data file
     
-    # If file exists
-    if os.path.exists(file_path):
-        # Read and add new data. Then deletes any duplicated rows
-        # before overwriting the .parquet file
-        df_exist = pd.read_parquet(file_path)
-        df_final = pd.concat([df_exist,df_new])
-        
-
-        # If the file_path corresponds to a critical data type
-        # Erase possible duplicates and sort rows by ascending date
-        if 'Date' in df_final.columns:
-            df_final.drop_duplicates(subset='Date',keep='last',inplace=True)
-            df_final.sort_values(by='Date',ascending=True,inplace=True)
-            df_final.dropna(axis=1,inplace=True)
-        
-        # Otherwise, just check that no duplicates are left in the dataframe
+    # The file is read, modified and replaced by a single process at a time
+    with file_lock(file_path + '.lock'):
+        # If file exists
+        if os.path.exists(file_path):
+            # Read and add new data. Then deletes any duplicated rows
+            # before overwriting the .parquet file
+            df_exist = pd.read_parquet(file_path)
+            df_final = pd.concat([df_exist,df_new])
+
+
+            # If the file_path corresponds to a critical data type
+            # Erase possible duplicates and sort rows by ascending date
+            if 'Date' in df_final.columns:
+                df_final.drop_duplicates(subset='Date',keep='last',inplace=True)
+                df_final.sort_values(by='Date',ascending=True,inplace=True)
+                df_final.dropna(axis=1,inplace=True)
+
+            # Otherwise, just check that no duplicates are left in the dataframe
+            else:
+                df_final.drop_duplicates(inplace=True)
         else:
-            df_final.drop_duplicates(inplace=True)
-        # Overwrite file
+            df_final = df_new
+
+        # Write the file atomically, readers never see a partial file. If there is
+        # not any directory, it is created
         table = pa.Table.from_pandas(df_final)
-        pq.write_table(table,file_path)
-       
-        return df_final
-
-    # If file does not exist, check if there's a folder to add
-    # the new file. If there is not any directory, create one
-    if not (os.path.exists('df') and os.path.isdir('df')):
-       os.makedirs('df')
-
-    # Generate the new file
-    table = pa.Table.from_pandas(df_new)
-    pq.write_table(table,file_path)
-    
-    return df_new
+        with atomic_write(file_path) as file:
+            pq.write_table(table,file,row_group_size=CRITICAL_DATA_ROW_GROUP_ROWS)
+
+    return df_final
     
 def df_add_month_to_critical_data(file_path_trip:str, file_path_charge:str, year:int, month:int) -> pd.DataFrame:
     # This function will either create critical_data.parquet and add this 
     # month's critical data or just add the critical data to an existing file
     # 
     # INPUT:
-    #   - df_file_path: relative path to the .parquet file that contains the month's
-    #                   data
+    #   - file_path_trip, file_path_charge: month paths (see get_month_path), only read if
+    #                                       the state of the month is missing
     # 
     # OUTPUT:
     #   - new_month_df: dataframe that has been stored into a .parquet file
     
-    month_df = df_generate_month_df(file_path_trip,file_path_charge,year,month)
+    df_state = df_load_month_state(year, month)
+    if not isinstance(df_state, pd.DataFrame):
+        df_state = df_get_month_state(df_read_month(file_path_trip), df_read_month(file_path_charge))
+        df_save_month_state(df_state, year, month)
+
+    month_df = df_generate_month_df_from_state(df_state, year, month)
     new_month_df = df_add_df_to_parquet_file(CRITICAL_DATA_FILE_PATH,month_df)
 
     return new_month_df
 
-def df_append_data(df_new:pd.DataFrame, type_name:str) -> int:
+def df_append_month(df_month:pd.DataFrame, type_name:str, year:int, month:int) -> int:
+    # Appends the rows of a single month and refreshes its state and critical data. Months are
+    # independent (every one has its own lock), so several of them can be appended at the same
+    # time by different processes
+    #
+    # OUTPUT:
+    #   - number of rows stored (rows already stored are not appended again)
+
+    filename = get_month_path(year, month, type_name)
+
+    # Check if both months exist and update/create the critical data file
+    filename_trip = get_month_path(year, month, 'trip')
+    filename_charge = get_month_path(year, month, 'charge')
+
+    with month_lock(year, month):
+        df_written = df_append_month_parts(filename, df_month, type_name)
+
+        # Only the new rows are added to the state of the month
+        if not df_written.empty:
+            df_state = df_update_month_state(df_written, type_name, year, month)
+            df_add_month_to_vehicle_critical_data(df_state, year, month)
+            if os.path.exists(filename_trip) and os.path.exists(filename_charge):
+                df_add_month_to_critical_data(filename_trip, filename_charge, year, month)
+
+    return df_written.shape[0]
+
+def create_append_executor(max_workers:int=APPEND_WORKERS) -> ProcessPoolExecutor:
+    # Returns a pool of processes that df_append_data can use to append several months at the
+    # same time, None if max_workers is below 2 (a single process can't be faster than the
+    # caller). The processes are started with spawn, forking a process that has threads (e.g.
+    # the ingest service) is not safe, and only when they are first used, so inputs below
+    # PARALLEL_APPEND_MIN_ROWS don't pay for their start. Create it once (from a script
+    # protected by if __name__ == '__main__') and pass it to every call:
+    #
+    #   with create_append_executor() or contextlib.nullcontext() as executor:
+    #       df_append_data(df_new, type_name, executor)
+    if max_workers < 2:
+        return None
+
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=set_hot_tier_months, initargs=(HOT_TIER_MONTHS,))
+
+def set_hot_tier_months(hot_tier_months:int):
+    # Runs in every process of the append pool, so they use the hot tier of the parent
+    global HOT_TIER_MONTHS
+    HOT_TIER_MONTHS = hot_tier_months
+
+def df_append_data(df_new:pd.DataFrame, type_name:str, executor:ProcessPoolExecutor=None) -> int:
     # Given a dataframe and the type of dataframe that is given ('trip' or 'charge') it will
     # 
-    # 1) Check if there are different months within the dataframe
+    # 1) Split the dataframe into months (UTC), in a single pass over its timestamps
     # 2) Check if there is already an existing file containing data from that month
     # 3) Generate or append df_new to its corresponding .parquet file
     # 4) Update month's critical data or generate a new entry if not existing
-    if type_name == 'trip':
-        TIMESTAMP_COLUMN = 'Timestamp CT'
-    
-    elif type_name == 'charge':
-        TIMESTAMP_COLUMN = 'Timestamp CC'
-   
-    timestamp_max=df_new[TIMESTAMP_COLUMN].max()
-    date_max=datetime.datetime.utcfromtimestamp(timestamp_max)
-    year_max=date_max.year
-    month_max=date_max.month
-    timestamp_min=df_new[TIMESTAMP_COLUMN].min()
-    date_min=datetime.datetime.utcfromtimestamp(timestamp_min)
-    year_min=date_min.year
-    month_min=date_min.month
-
-    date_start = datetime.datetime(year_min, month_min, 1) 
-    date_end = datetime.datetime(year_max, month_max, calendar.monthrange(year_max,month_max)[1])  
-
-    # Iterate through all months
-    current_date = date_start
-    while current_date <= date_end:
-        # Get the timestamps of the beginning and end of each month
-        timestamp_i = datetime.datetime(current_date.year, current_date.month, 1).timestamp()
-        timestamp_f = (datetime.datetime(current_date.year, current_date.month % 12 + 1, 1) - timedelta(days=1)).timestamp()
-
-        # Generate a new dataframe that contains only data from the corresponding month
-        df_month = df_new[(df_new[TIMESTAMP_COLUMN] > timestamp_i) & (df_new[TIMESTAMP_COLUMN] <= timestamp_f)]
-
-        # Get the filename of the month and add the resulting dataframe into the .parquet file
-        filename=f'df/{current_date.year}_{current_date.month:02}_{type_name}.parquet'
-        df_add_df_to_parquet_file(filename,df_month)
-        
-        # Check if both files exist and update/create the critical data file
-        filename_trip = f'df/{current_date.year}_{current_date.month:02}_trip.parquet'
-        filename_charge = f'df/{current_date.year}_{current_date.month:02}_charge.parquet'
-
-        if os.path.exists(filename_trip) and os.path.exists(filename_charge):
-            df_add_month_to_critical_data(filename_trip,filename_charge,current_date.year,current_date.month)
-    
-        # Get to the next month
-        current_date = current_date + timedelta(days=32 - current_date.day)
+    # 5) Update the critical data of every vehicle of the month
+    #
+    # Steps 2 to 5 are done by df_append_month. If an executor (see create_append_executor)
+    # is given and df_new has at least PARALLEL_APPEND_MIN_MONTHS months and
+    # PARALLEL_APPEND_MIN_ROWS rows, they are appended in its processes, otherwise one after
+    # the other in this process
+    TIMESTAMP_COLUMN = TIMESTAMP_COLUMNS[type_name]
+
+    # Rows are appended (and added to the month states) with the values they are stored with
+    df_new = df_apply_compact_schema(df_new, type_name)
+
+    # Months stored with the old layout are moved into the dataset before appending to them
+    migrate_legacy_months()
+
+    # Once a month, the twins of the months that have left the hot tier are deleted
+    global hot_tier_pruned_month
+    if hot_tier_pruned_month != get_month_index(time.time()):
+        prune_hot_tier()
+        hot_tier_pruned_month = get_month_index(time.time())
+
+    # Month of every row (year*12 + month-1), every row belongs to exactly one month
+    month_indexes = df_new[TIMESTAMP_COLUMN].to_numpy(dtype=np.int64).astype('datetime64[s]').astype('datetime64[M]').astype(np.int64) + 1970*12
+    months = [(int(month_index) // 12, int(month_index) % 12 + 1, df_month) for month_index, df_month in df_new.groupby(month_indexes, sort=True)]
+
+    if executor is not None and len(months) >= PARALLEL_APPEND_MIN_MONTHS and df_new.shape[0] >= PARALLEL_APPEND_MIN_ROWS:
+        futures = [executor.submit(df_append_month, df_month, type_name, year, month) for year, month, df_month in months]
+        for future in futures:
+            future.result()
+    else:
+        for year, month, df_month in months:
+            df_append_month(df_month, type_name, year, month)
 
     return 0
 
@@ -257,7 +1179,16 @@ def df_get_last_months_critical_data(num_months:int) -> pd.DataFrame:
     if not os.path.exists(CRITICAL_DATA_FILE_PATH):
         return -1
     
-    aux_df = pd.read_parquet(CRITICAL_DATA_FILE_PATH)
+    # Only the last row groups, which contain the last months, are read
+    parquet_file = pq.ParquetFile(CRITICAL_DATA_FILE_PATH)
+    row_groups = []
+    num_rows = 0
+    for row_group in reversed(range(parquet_file.metadata.num_row_groups)):
+        if num_rows >= num_months:
+            break
+        row_groups.insert(0, row_group)
+        num_rows += parquet_file.metadata.row_group(row_group).num_rows
+    aux_df = parquet_file.read_row_groups(row_groups, use_pandas_metadata=True).to_pandas()
 
     # Get the last "num_months" columns from the critical data file
     # It checks whether num_months is greater than the number of rows available
@@ -266,3 +1197,61 @@ def df_get_last_months_critical_data(num_months:int) -> pd.DataFrame:
 
     return last_months_df
 
+def df_query_critical_data(start=None, end=None, columns:list=None, vins:list=None, vehicles:bool=False) -> pd.DataFrame:
+    # Reads the critical data of a range of months, of the fleet or of every vehicle. The filters
+    # are pushed down to the files: only the row groups of the fleet file whose Date statistics
+    # overlap [start, end] are read, and only the files of the vehicles of the months in
+    # [start, end] (and, within them, the row groups whose VIN statistics contain vins)
+    #
+    # INPUT:
+    #   - start, end: first and last month to read (e.g. '2023-07' or a datetime), all of
+    #                 them by default
+    #   - columns: KPI columns to read, all of them by default. Date (and VIN) are always read
+    #   - vins: VINs to read. The critical data of the vehicles is read if given
+    #   - vehicles: read the critical data of every vehicle (VEHICLE_CRITICAL_DATA_DIRECTORY)
+    #               instead of the one of the fleet
+    #
+    # OUTPUT:
+    #   - -1 if there is no file
+    #   - df: a row per month (and VIN), sorted by date (and VIN)
+
+    vehicles = vehicles or vins is not None
+
+    filters = []
+    if start is not None:
+        filters.append(('Date', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('Date', '<=', pd.Timestamp(end)))
+    if vins is not None:
+        filters.append((VIN_COLUMN, 'in', [str(vin) for vin in vins]))
+
+    if columns is not None:
+        key_columns = ['Date', VIN_COLUMN] if vehicles else ['Date']
+        columns = key_columns + [column for column in columns if column not in key_columns]
+
+    if not vehicles:
+        if not os.path.exists(CRITICAL_DATA_FILE_PATH):
+            return -1
+        table = pq.read_table(CRITICAL_DATA_FILE_PATH, columns=columns, filters=filters or None)
+        return table.to_pandas().reset_index(drop=True)
+
+    # The month of every file is in its name, so the files out of [start, end] are not opened
+    if not os.path.isdir(VEHICLE_CRITICAL_DATA_DIRECTORY):
+        return -1
+
+    month_min = None if start is None else pd.Timestamp(start).year*12 + pd.Timestamp(start).month - 1
+    month_max = None if end is None else pd.Timestamp(end).year*12 + pd.Timestamp(end).month - 1
+    tables = []
+    for filename in sorted(os.listdir(VEHICLE_CRITICAL_DATA_DIRECTORY)):
+        match = VEHICLE_CRITICAL_DATA_PATTERN.match(filename)
+        if match is None:
+            continue
+        month_index = int(match[1])*12 + int(match[2]) - 1
+        if (month_min is not None and month_index < month_min) or (month_max is not None and month_index > month_max):
+            continue
+        tables.append(pq.read_table(os.path.join(VEHICLE_CRITICAL_DATA_DIRECTORY, filename), columns=columns, filters=filters or None))
+
+    if not tables:
+        return -1
+
+    return concat_part_tables(tables).to_pandas().reset_index(drop=True)
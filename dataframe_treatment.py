@@ -1,8 +1,10 @@
 import pandas as pd
+import numpy as np
 import os
 import json
 import pyarrow as pa
 import pyarrow.parquet as pq
+from param_schema import get_type_schema, get_column_vectors
 
 """
 *************************************************************************************************************
@@ -10,10 +12,19 @@ This file contains all functions necessary to assure that the data stored in a d
 contains all information and it is normalised so that future analyses can be done
 
 The main function is df_filter_data, which will return a filtered and depurated dataframe, the rest of
-functions are auxiliary and do not need to be particularily used for external purposes.
+functions are auxiliary and do not need to be particularily used for external purposes. df_filter_data adds
+the secondary columns, sorts, verifies and rescales the data in a single pass (treat_values), which gives the
+same result as add_columns, sort_columns, verify_values and apply_resolution one after the other.
+
+df_filter_data_stream is its streaming version: it filters an iterator of chunks (pandas dataframes or Arrow
+record batches) one at a time and yields the filtered chunks, keeping the counters of records accepted and
+rejected across them, so memory does not depend on the size of the input.
 
 df_get_colum_tags_dictionary returns a vector containing all the names of the columns given the type_name
 ('trip' or 'charge). It is useful if it is needed to list all the variables conained in the dataframe.
+
+The parameters are taken from the compiled schema of param_battery.json (see param_schema.py), which is only
+parsed again when the file changes, so filtering a record does not open the json.
 *************************************************************************************************************
 """
 
@@ -27,16 +38,12 @@ def df_get_column_tags_dictionary(type_name:str):
     #   - column_tags
     #   - -1 if type_name not supported
  
-    # Open the json containing all parameters
-    with open('param_battery.json', 'r') as file:
-        parameters = json.load(file)
-
     # Check type_name
     if type_name != 'trip' and type_name != 'charge':
         return -1
 
-    # Get column tags
-    column_tags = [key for key, value in parameters.items() if value.get("Type Chart Variables") == type_name]
+    # Get column tags from the compiled schema
+    column_tags = list(get_type_schema(type_name).columns)
 
     return column_tags
 
@@ -76,21 +83,13 @@ def add_columns(df:pd.DataFrame,type_name:str):
     #_NOTE THAT THE COLUMNS MUST HAVE BEEN RENAMED BEFORE THE EXECUTION OF THIS FUNCTION
 
     
-    if type_name == 'trip':
-        df['Mins'] = (df['End'] - df['Start'])/60
-        df['Total distance'] = (df['City distance'] + df['Sport distance'] + df['Flow distance'])/10
-        df['Total energy'] = df['City energy'] + df['Sport energy'] + df['Flow energy']
-        df['Total regen'] = df['City regen'] + df['Sport regen']
-        df['Regen'] = 100 * df['Total regen'] / df['Total energy']
-        df['SoC delta'] = (df['Start SoC'] - df['End SoC'])/100
-        df['Temp general delta'] = (df['Max temp CT'] - df['Max delta'])/10
-        
-    elif type_name == 'charge':
-        df['Delta V I'] = (df['Vmax I'] - df['Vmin I'])*0.001
-
-    else:
+    if type_name not in DERIVED_COLUMNS:
         return -1
 
+    # Same formulas as treat_values (see DERIVED_COLUMNS)
+    for column, function in DERIVED_COLUMNS[type_name].items():
+        df[column] = function(df.__getitem__)
+
     return df
 
 def sort_columns(df:pd.DataFrame,type_name:str):
@@ -108,31 +107,54 @@ def sort_columns(df:pd.DataFrame,type_name:str):
 
     return df
 
-def verify_values(df:pd.DataFrame):
+def validate_values(df:pd.DataFrame, row_ids:bool=False) -> tuple:
+    # This function checks every value of the df against the bounds of its column at once: the
+    # frame is converted to a single 2D array and compared with the Value_MIN and Value_MAX
+    # vectors of its columns, so no intermediate frames are created
+    #
+    # INPUTS:
+    #   - df
+    #   - row_ids: also return the index of the rows that break the bounds of every column
+    #
+    # OUTPUTS:
+    #   - keep: boolean array, True for the rows whose values are all within bounds
+    #   - violations: pd.Series with the number of rows out of bounds of every column
+    #   - rows: {column: index of the rows out of its bounds}, only if row_ids
+
+    vector_min, vector_max, _ = get_column_vectors(df.columns)
+    values = df.to_numpy(dtype=np.float64)
+
+    # NaN values are out of bounds
+    in_bounds = (values >= vector_min) & (values <= vector_max)
+    keep = in_bounds.all(axis=1)
+    violations = pd.Series((~in_bounds).sum(axis=0), index=df.columns, dtype=np.int64)
+
+    if not row_ids:
+        return keep, violations
+
+    rows = {column: df.index[~in_bounds[:, position]] for position, column in enumerate(df.columns) if violations[column] > 0}
+    return keep, violations, rows
+
+def verify_values(df:pd.DataFrame, violations:dict=None):
     # This function values whether the columns in the df store possible values,
     # if not, the row is eliminated from the dataframe
     # 
     # INPUTS:
     #   - df
+    #   - violations: if given, the number of rows out of bounds of every column is added to it
     # 
     # OUTPUTS:
     #   - df filtered
     #   - -1 if df is empty (which means that either the df is corrupted or the dictionary
     #     is not updated)
 
-    with open('param_battery.json', 'r') as json_file:
-        parameters = json.load(json_file)
+    # All the columns are checked in a single pass (see validate_values)
+    keep, column_violations = validate_values(df)
+    if violations is not None:
+        for column, count in column_violations.items():
+            violations[column] = violations.get(column, 0) + int(count)
 
-    # Check for each column the maximum and minimum value allowed and empty the rows that do
-    # not meet the condition
-    for column in df:
-        value_max = parameters[column]["Value_MAX"]
-        value_min = parameters[column]["Value_MIN"]
-
-        condicion = (df[column] >= value_min) & (df[column] <= value_max)
-        df = df.loc[condicion]
-    
-    return df
+    return df.loc[keep]
 
 def apply_resolution(df:pd.DataFrame):
     # Function in charge of reescalating all columns depending on their resolution 
@@ -147,17 +169,90 @@ def apply_resolution(df:pd.DataFrame):
     # PROPERLY
 
 
-    # Open the json containing all parameters
-    with open('param_battery.json', 'r') as file:
-        parameters = json.load(file)
+    _, _, vector_resolution = get_column_vectors(df.columns)
 
-    # Multiply each column by its resolution
-    for column in df:
-        df[column] *= parameters[column]["Resolution"]
+    # Multiply each column by its resolution. Integer resolutions keep integer columns as
+    # integers
+    for column, resolution in zip(df.columns, vector_resolution):
+        df[column] *= int(resolution) if resolution.is_integer() else resolution
 
     return df
 
-def df_filter_data(df:pd.DataFrame, type_name:str, from_excel:bool=False):
+# Rows of the chunks df_iter_chunks splits a dataframe into
+FILTER_CHUNK_ROWS = 100000
+
+# Secondary columns of every type: {column: function of a column getter}. They are computed in this order, so
+# a column can use the ones before it. add_columns applies them to pandas columns and treat_values to numpy
+# arrays, integer columns give integer results
+DERIVED_COLUMNS = {
+    'trip': {
+        'Mins':                 lambda c: (c('End') - c('Start'))/60,
+        'Total distance':       lambda c: (c('City distance') + c('Sport distance') + c('Flow distance'))/10,
+        'Total energy':         lambda c: c('City energy') + c('Sport energy') + c('Flow energy'),
+        'Total regen':          lambda c: c('City regen') + c('Sport regen'),
+        'Regen':                lambda c: 100 * c('Total regen') / c('Total energy'),
+        'SoC delta':            lambda c: (c('Start SoC') - c('End SoC'))/100,
+        'Temp general delta':   lambda c: (c('Max temp CT') - c('Max delta'))/10
+    },
+    'charge': {
+        'Delta V I':            lambda c: (c('Vmax I') - c('Vmin I'))*0.001
+    }
+}
+
+def treat_values(df:pd.DataFrame, type_name:str, violations:dict=None) -> pd.DataFrame:
+    # This function does steps 2 to 5 of df_filter_data in a single pass over numpy arrays: the
+    # secondary columns are derived from the primary ones (integer columns are used without
+    # copies), every column is checked against its bounds, and only the valid rows are taken and
+    # multiplied by the resolution. The result is the same as the one of add_columns,
+    # sort_columns, verify_values and apply_resolution, dtypes included: integer columns with an
+    # integer resolution are returned as integers
+    #
+    # INPUTS:
+    #   - df: renamed primary columns (other columns are ignored)
+    #   - type_name: 'trip' or 'charge'
+    #   - violations: if given, the number of rows out of bounds of every column is added to it
+    #
+    # OUTPUT:
+    #   - df filtered (it can be empty)
+    #   - -1 if type_name not supported
+
+    if type_name not in DERIVED_COLUMNS:
+        return -1
+
+    type_schema = get_type_schema(type_name)
+    derived = DERIVED_COLUMNS[type_name]
+
+    # Primary columns, then the secondary ones
+    arrays = {}
+    for column in type_schema.columns:
+        if column not in derived:
+            series = df[column]
+            if pd.api.types.is_integer_dtype(series.dtype) and not series.hasnans:
+                arrays[column] = series.to_numpy(dtype=np.int64)
+            else:
+                arrays[column] = series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for column, function in derived.items():
+            arrays[column] = function(arrays.__getitem__)
+
+    # Bounds (NaN values are out of bounds)
+    keep = np.ones(df.shape[0], dtype=bool)
+    for column, value_min, value_max in zip(type_schema.columns, type_schema.value_min, type_schema.value_max):
+        in_bounds = (arrays[column] >= value_min) & (arrays[column] <= value_max)
+        keep &= in_bounds
+        if violations is not None:
+            violations[column] = violations.get(column, 0) + int(in_bounds.size - np.count_nonzero(in_bounds))
+
+    # Resolution. Integer columns stay integers if their resolution is an integer
+    rows = np.flatnonzero(keep)
+    treated = {}
+    for column, resolution in zip(type_schema.columns, type_schema.resolution):
+        treated[column] = arrays[column][rows] * (int(resolution) if resolution.is_integer() else resolution)
+
+    return pd.DataFrame(treated, index=df.index[rows], copy=False)
+
+def df_filter_data(df:pd.DataFrame, type_name:str, from_excel:bool=False, violations:dict=None):
     # This function has to be used before appending a dataframe to a definitive .parquet
     # file
     # 
@@ -174,6 +269,8 @@ def df_filter_data(df:pd.DataFrame, type_name:str, from_excel:bool=False):
     # 
     # INPUTS:
     #   - df
+    #   - violations: if given, the number of rows out of bounds of every column (step 4) is
+    #     added to it
     # 
     # OUTPUT:
     #   - df filtered
@@ -184,25 +281,58 @@ def df_filter_data(df:pd.DataFrame, type_name:str, from_excel:bool=False):
         df = update_column_tags(df,type_name)
         if  not isinstance(df,pd.DataFrame):
             return -1
-    else:
+    elif 'Start odometer' in df.columns:
         del df['Start odometer']
 
-    # Step 2
-    df = add_columns(df,type_name)
+    # Steps 2 to 5 are done in a single pass (see treat_values)
+    df = treat_values(df,type_name,violations)
     if not isinstance(df,pd.DataFrame):
         return -2
     
-    # Step 3
-    df = sort_columns(df,type_name)
-    if not isinstance(df,pd.DataFrame):        
-        return -3
-    
-    # Step 4
-    df = verify_values(df)
     if df.empty:
         return -4
     
-    # Step 5 (it does not return any error if previous steps are ok)
-    df == apply_resolution(df)
-    
     return df
+
+def df_iter_chunks(df:pd.DataFrame, chunk_rows:int=FILTER_CHUNK_ROWS):
+    # Generator that splits a dataframe into chunks of chunk_rows rows (views, not copies)
+    for start in range(0, df.shape[0], chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+def df_filter_data_stream(batches, type_name:str, from_excel:bool=False, counters:dict=None):
+    # Generator version of df_filter_data: every chunk is filtered on its own and the filtered
+    # chunks are yielded as they are ready, so only one chunk is in memory at a time
+    #
+    # INPUTS:
+    #   - batches: iterator of pandas dataframes or Arrow record batches/tables (indexed by VIN
+    #     or with a VIN column)
+    #   - type_name: 'trip' or 'charge'
+    #   - from_excel: see df_filter_data
+    #   - counters: dict updated after every chunk with the totals 'records', 'accepted',
+    #     'rejected' and 'violations' ({column: rows out of bounds})
+    #
+    # OUTPUT:
+    #   - filtered chunks (chunks without any valid record are not yielded)
+
+    if counters is None:
+        counters = {}
+    for key in ['records', 'accepted', 'rejected']:
+        counters.setdefault(key, 0)
+    counters.setdefault('violations', {})
+
+    for batch in batches:
+        if isinstance(batch, (pa.RecordBatch, pa.Table)):
+            batch = batch.to_pandas()
+            if 'VIN' in batch.columns:
+                batch = batch.set_index('VIN')
+        if batch.empty:
+            continue
+
+        df_filtered = df_filter_data(batch, type_name, from_excel, counters['violations'])
+        num_accepted = df_filtered.shape[0] if isinstance(df_filtered, pd.DataFrame) else 0
+
+        counters['records'] += batch.shape[0]
+        counters['accepted'] += num_accepted
+        counters['rejected'] += batch.shape[0] - num_accepted
+        if num_accepted > 0:
+            yield df_filtered
@@ -0,0 +1,108 @@
+import os
+import pandas as pd
+from collections import Counter
+from dataframe_storage import write_part_file, get_part_files
+
+"""
+*************************************************************************************************************
+This file contains the dead letter store, where the packets that can't be used are kept instead of stopping
+the ingest or being silently lost. Every packet is stored with a reason code:
+
+    - malformed:        the packet has no "type:payload" structure, or (from_server_to_parquet) its payload does
+                        not have the fields of its message type
+    - unknown_type:     the message type is not in the protocol registry
+    - invalid_field:    some field is not an integer or does not fit its dtype (the packet is still assembled,
+                        so its record will be rejected by df_filter_data, but it is copied here)
+    - missing_key:      the VIN or a key field (Timestamp CT, Id, Timestamp CC) is missing
+    - out_of_order:     the message type had already been received for that pending record
+    - expired:          records that never got all their message types (see evict_pending_records)
+    - ingest_error:     the chunk the packet arrived in raised an error while being processed
+    - write_error:      filtered records that could not be appended to the dataset
+
+Packets are kept in memory and written as immutable part files (append-only) in DEAD_LETTER_DIRECTORY,
+expired records in DEAD_LETTER_DIRECTORY/expired_{type_name} and records that could not be written in
+DEAD_LETTER_DIRECTORY/unwritten_{type_name}. get_counters() returns how many packets have
+been routed to every reason, so the loss rate can be measured.
+*************************************************************************************************************
+"""
+
+DEAD_LETTER_DIRECTORY = 'df/dead_letter'
+FLUSH_ROWS = 10000              # Packets kept in memory before writing a part file
+
+REASON_MALFORMED = 'malformed'
+REASON_UNKNOWN_TYPE = 'unknown_type'
+REASON_INVALID_FIELD = 'invalid_field'
+REASON_MISSING_KEY = 'missing_key'
+REASON_OUT_OF_ORDER = 'out_of_order'
+REASON_EXPIRED = 'expired'
+REASON_INGEST_ERROR = 'ingest_error'
+REASON_WRITE_ERROR = 'write_error'
+
+class DeadLetterStore:
+
+    def __init__(self, directory:str=DEAD_LETTER_DIRECTORY, flush_rows:int=FLUSH_ROWS):
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.counters = Counter()
+        self.frames = []
+        self.num_rows = 0
+
+    def add(self, device_ids, messages, reason:str):
+        # Routes packets to the dead letter store
+        #
+        # INPUTS:
+        #   - device_ids, messages: DeviceId and OriginalMessage of every packet
+        #   - reason: reason code
+
+        num_packets = len(messages)
+        if num_packets == 0:
+            return
+
+        self.frames.append(pd.DataFrame({'DeviceId':        pd.Series(device_ids, dtype=object).astype(str).to_numpy(),
+                                         'OriginalMessage': pd.Series(messages, dtype=object).astype(str).to_numpy(),
+                                         'Reason':          reason,
+                                         'Received':        pd.Timestamp.now(tz='UTC')}))
+        self.counters[reason] += num_packets
+        self.num_rows += num_packets
+
+        if self.num_rows >= self.flush_rows:
+            self.flush()
+
+    def add_expired(self, df_expired:pd.DataFrame, type_name:str):
+        # Stores the records evicted from a reassembly buffer
+        if df_expired.empty:
+            return
+
+        write_part_file(os.path.join(self.directory, f'expired_{type_name}'), df_expired)
+        self.counters[REASON_EXPIRED] += df_expired.shape[0]
+
+    def add_unwritten(self, df_records:pd.DataFrame, type_name:str):
+        # Stores filtered records that could not be appended, so they can be appended again
+        if df_records.empty:
+            return
+
+        write_part_file(os.path.join(self.directory, f'unwritten_{type_name}'), df_records)
+        self.counters[REASON_WRITE_ERROR] += df_records.shape[0]
+
+    def flush(self):
+        # Writes the packets kept in memory as a new part file
+        if self.frames:
+            write_part_file(self.directory, pd.concat(self.frames, ignore_index=True))
+        self.frames = []
+        self.num_rows = 0
+
+    def get_counters(self) -> dict:
+        # Returns {reason: number of packets/records} since the store was created
+        return dict(self.counters)
+
+# Dead letter store of this process
+dead_letter_store = DeadLetterStore()
+
+def df_read_dead_letters(directory:str=DEAD_LETTER_DIRECTORY) -> pd.DataFrame:
+    # Returns every packet stored in the dead letter store, -1 if there is none
+    part_files = get_part_files(directory)
+
+    if not part_files:
+        return -1
+
+    return pd.concat([pd.read_parquet(file_path) for file_path in part_files], ignore_index=True)
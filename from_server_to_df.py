@@ -1,30 +1,52 @@
 import pandas as pd
+import numpy as np
+import os
+import time
+import glob
+import atexit
 from dataframe_storage import df_append_data
 from dataframe_treatment import df_filter_data
+from reassembly_buffer import ReassemblyBuffer
+from dead_letter import (DeadLetterStore, dead_letter_store, REASON_MALFORMED, REASON_UNKNOWN_TYPE, REASON_INVALID_FIELD,
+                         REASON_MISSING_KEY, REASON_OUT_OF_ORDER)
+from protocol_registry import protocol_dict, PROTOCOL_REGISTRY, TYPE_MESSAGES, KEY_FIELDS, get_field_dtypes
 
 
-#Protocol Dictionary
-protocol_dict={"G1":["Timestamp CT", "Start", "End", "Start odometer", "Id"],
-                   "G2":["Timestamp CT", "End odometer", "Max speed", "Id"],
-                   "C2":["Timestamp CT", "City distance", "Sport distance","Flow distance","Sail distance","Regen distance","Id"],
-                   "C3":["Timestamp CT", "City energy", "Sport energy","Flow energy","City regen","Sport regen","Map changes","Id"],
-                   "IE":["Timestamp CT", "Inv max T", "Inv avg T", "Inv min T","Motor max T","Motor avg T","Motor min T","Id"],
-                   "B1":["Timestamp CT", "Start SoC", "End SoC","Max discharge","Max regen","Id"],
-                   "B2":["Timestamp CT", "Avg current", "Thermal current","Max V","Id"],
-                   "B3":["Timestamp CT", "Average V", "Min V","Max cell V","Min cell V","Id"],
-                   "B4":["Timestamp CT", "Cell V diff", "Max temp CT","Avg temp","Min temp CT","Max delta","Avg delta","Id"],
-                   "H2":["Timestamp CC", "SoC i", "SoC f","Vmin I","Vavg I","Vmax I","Vmin F"],
-                   "H3":["Timestamp CC", "Avg final V", "Max final V","Max BMS current","Max charger current"], 
-                   "H4":["Timestamp CC", "Charger max P", "Min temp I","Avg temp I","Max temp I","Min temp F"],
-                   "H5":["Timestamp CC", "Avg temp F","Max temp F","Min temp CC","Max temp CC","Cycles","Age"],
-                   "H8":["Timestamp CC", "uSoC I", "uSoC F","Connector"]}
-
-df_dict_trip = {}
-df_dict_charge = {}
-
 VIN_COLUMN = 'DeviceId'
 DATA_COLUMN = 'OriginalMessage'
 
+# Limits of the pending records: maximum age (seconds since their first packet) and maximum
+# number of records per type. Expired records are either stored in the dead letter store
+# ('dead_letter') or returned as null-masked rows ('emit')
+PENDING_MAX_AGE = 7*24*3600
+PENDING_MAX_ENTRIES = 100000
+EXPIRED_POLICY = 'dead_letter'
+
+# Dead letter reason of the packets rejected by ReassemblyBuffer.add_packet
+LEGACY_REJECTED_REASONS = {'unmatched': REASON_MALFORMED, 'missing_key': REASON_MISSING_KEY, 'out_of_order': REASON_OUT_OF_ORDER}
+
+# Path of the pending records snapshot, formatted with type_name. Every snapshot of a type
+# (this one and the ones of the shards of sharded_ingest.py) matches PENDING_STATE_FILE_PATTERN
+PENDING_STATE_FILE_PATH = 'df/pending_{type_name}.npz'
+PENDING_STATE_FILE_PATTERN = 'df/pending_*{type_name}.npz'
+
+# Seconds between the snapshots of the module buffers taken by from_server_to_parquet and
+# from_server_to_parquet_batch. A last one is taken when the process exits
+PENDING_STATE_SAVE_INTERVAL = 60.0
+
+def create_reassembly_buffers() -> dict:
+    # Returns a new, empty reassembly buffer for each type. Records are keyed by
+    # (VIN, Timestamp CT, Id) for trips and (VIN, Timestamp CC) for charges
+    return {type_name: ReassemblyBuffer({message_type: list(PROTOCOL_REGISTRY[message_type].fields) for message_type in message_types},
+                                        KEY_FIELDS[type_name], dtypes=get_field_dtypes(type_name),
+                                        max_age=PENDING_MAX_AGE, max_entries=PENDING_MAX_ENTRIES)
+            for type_name, message_types in TYPE_MESSAGES.items()}
+
+# Pending records of this process. They are empty until start_pending_state loads the snapshot
+reassembly_buffers = create_reassembly_buffers()
+pending_state_loaded = False
+pending_state_saved = 0.0
+
 def df_create(string:str, param_order)->pd.DataFrame:
     # Split the string into its components
     components = string.split(':')
@@ -42,7 +64,7 @@ def df_create(string:str, param_order)->pd.DataFrame:
 
     # Convert the values to integers or leave as None if they can't be converted
     for part in payload_parts:
-        if part.isdigit() or (part[0] == '-' and part[1:].isdigit()):
+        if part.isdigit() or (part[:1] == '-' and part[1:].isdigit()):
             param_values.append(int(part))
         else:
             param_values.append(None)
@@ -57,149 +79,264 @@ def df_create(string:str, param_order)->pd.DataFrame:
 
 def df_from_string_to_df(string:str)-> (pd.DataFrame,str):
 
+    if not isinstance(string, str):
+        return (None, -1)
+
     components = string.split(':')
     message_type = components[0][1:]
-    type_name=check_type(message_type)
-
-    if message_type == 'G1':
-        param_order = protocol_dict["G1"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'G2':
-        param_order = protocol_dict["G2"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'C2':
-        param_order = protocol_dict["C2"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'C3':
-        param_order = protocol_dict["C3"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'IE':
-        param_order = protocol_dict["IE"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'B1':
-        param_order = protocol_dict["B1"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'B2':
-        param_order = protocol_dict["B2"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'B3':
-        param_order = protocol_dict["B3"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'B4':
-        param_order = protocol_dict["B4"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'H2':
-        param_order = protocol_dict["H2"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'H3':
-        param_order = protocol_dict["H3"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'H4':
-        param_order = protocol_dict["H4"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'H5':
-        param_order = protocol_dict["H5"]
-        df_str=df_create(string, param_order)
-    elif message_type == 'H8':
-        param_order = protocol_dict["H8"]
-        df_str=df_create(string, param_order)
-    
-    return (df_str, type_name)
+
+    # Malformed packets and unknown message types can't be decoded
+    spec = PROTOCOL_REGISTRY.get(message_type)
+    if spec is None or len(components) < 2:
+        return (None, -1)
+
+    df_str = df_create(string, spec.fields)
+
+    # Values that don't fit in the dtype of their field are None, like in df_decode_batch
+    for param, dtype in zip(df_str.columns, spec.dtypes):
+        value = df_str.at[0, param]
+        info = np.iinfo(dtype)
+        if value is not None and not pd.isna(value) and not info.min <= value <= info.max:
+            df_str[param] = pd.Series([None], dtype=object)
+
+    return (df_str, spec.type_name)
+
+def df_decode_batch(messages:pd.Series, vins:pd.Series=None, dead_letters:DeadLetterStore=None) -> dict:
+    # Vectorized counterpart of df_from_string_to_df. Instead of building one dataframe
+    # per packet, the whole OriginalMessage column is split at once and grouped by message
+    # type, so that every message type is decoded in a single pass.
+    #
+    # Fields follow the same semantics as df_create: integers (optionally negative) are
+    # kept, anything else becomes None (pd.NA). Every field uses the dtype of the protocol
+    # registry, values that do not fit in it are also None (they would be out of the bounds
+    # of param_battery.json anyway).
+    #
+    # INPUT:
+    #   - messages: OriginalMessage column, one packet per row
+    #   - vins: DeviceId column aligned with messages (optional)
+    #   - dead_letters: optional store where malformed packets, unknown message types and
+    #     packets with invalid fields are routed
+    #
+    # OUTPUT:
+    #   - blocks: dictionary {message_type: df_block}, where df_block is indexed by the
+    #     position of the packets in messages, has one nullable integer column per protocol
+    #     field and, if vins is given, a 'VIN' column. Packets without payload or with an
+    #     unknown type are skipped
+
+    # An empty split has no columns
+    if messages.empty:
+        return {}
+
+    messages = messages.astype(str).reset_index(drop=True)
+    if vins is not None:
+        vins = vins.reset_index(drop=True)
+
+    # Split header and payload of every packet at once
+    components = messages.str.split(':', n=1, expand=True)
+    if components.shape[1] < 2:
+        components[1] = None
+    message_types = components[0].str[1:]
+
+    # Remove the "End of Message Character" and the trailing blank spaces
+    payloads = components[1].str.removesuffix(',#&').str.strip()
+    is_known = message_types.isin(PROTOCOL_REGISTRY.keys()).to_numpy()
+    is_malformed = payloads.isna().to_numpy()
+    decodable = ~is_malformed & is_known
+
+    if dead_letters is not None:
+        route_dead_letters(dead_letters, messages, vins, is_malformed, REASON_MALFORMED)
+        route_dead_letters(dead_letters, messages, vins, ~is_malformed & ~is_known, REASON_UNKNOWN_TYPE)
+
+    blocks = {}
+    for message_type, payload_group in payloads[decodable].groupby(message_types[decodable], sort=False):
+        spec = PROTOCOL_REGISTRY[message_type]
+        payload_parts = payload_group.str.split(',', expand=True)
+
+        block = pd.DataFrame(index=payload_group.index)
+        if vins is not None:
+            block['VIN'] = vins.loc[payload_group.index]
+
+        # Convert each field to integer, or leave it as None if it can't be converted
+        has_invalid_field = np.zeros(len(block), dtype=bool)
+        for position, (param, dtype) in enumerate(zip(spec.fields, spec.dtypes)):
+            if position not in payload_parts.columns:
+                block[param] = pd.arrays.IntegerArray(np.zeros(len(block), dtype=dtype), np.ones(len(block), dtype=bool))
+                has_invalid_field[:] = True
+                continue
+            part = payload_parts[position]
+            is_integer = part.str.fullmatch(r'-?\d{1,18}').fillna(False).astype(bool).to_numpy()
+            values = part.where(is_integer, '0').astype('int64').to_numpy()
+            info = np.iinfo(dtype)
+            is_valid = is_integer & (values >= info.min) & (values <= info.max)
+            block[param] = pd.arrays.IntegerArray(np.where(is_valid, values, 0).astype(dtype), ~is_valid)
+            has_invalid_field |= ~is_valid
+
+        # Packets with invalid fields are still assembled (their record will be rejected when
+        # filtered), but a copy is kept in the dead letter store
+        if dead_letters is not None and has_invalid_field.any():
+            positions = block.index[has_invalid_field]
+            dead_letters.add(vins[positions] if vins is not None else None, messages[positions], REASON_INVALID_FIELD)
+
+        blocks[message_type] = block
+
+    return blocks
+
+def route_dead_letters(dead_letters:DeadLetterStore, messages:pd.Series, vins:pd.Series, mask:np.ndarray, reason:str):
+    # Adds the packets selected by mask to the dead letter store
+    if mask.any():
+        dead_letters.add(vins[mask] if vins is not None else None, messages[mask], reason)
 
 def check_type(string:str)-> str:
-    
-    trip =['G1','G2','C2','C3','IE','B1','B2','B3','B4']
-    charge=['H2','H3','H4','H5','H8']
-    if string in trip:
-        return 'trip'
-    elif string in charge:
-        return 'charge'
-
-    return -1
-
-def create_df_dict(VIN:str,dataframes:pd.DataFrame, type_name:str)->pd.DataFrame:
-
-    all_columns_trip = ['Timestamp CT','Id','Start','End','Start odometer','End odometer','Max speed','City distance','Sport distance','Flow distance','Sail distance','Regen distance','City energy', 
-                   'Sport energy','Flow energy','City regen','Sport regen','Map changes','Inv max T', 'Inv avg T', 'Inv min T','Motor max T','Motor avg T','Motor min T',
-                   'Start SoC', 'End SoC','Max discharge','Max regen','Avg current', 'Thermal current','Max V','Average V', 'Min V','Max cell V','Min cell V',
-                   'Cell V diff', 'Max temp CT','Avg temp','Min temp CT','Max delta','Avg delta']
-
-    all_columns_charge = ['Timestamp CC', 'SoC i', 'SoC f','Vmin I','Vavg I','Vmax I','Vmin F','Avg final V', 'Max final V','Max BMS current','Max charger current',
-                        'Charger max P', 'Min temp I','Avg temp I','Max temp I','Min temp F', 'Avg temp F','Max temp F','Min temp CC','Max temp CC','Cycles','Age','uSoC I',
-                        'uSoC F','Connector']
-
-    if type_name == 'trip':
-
-        for df in dataframes:
-            timestamp_column_name = 'Timestamp CT'
-            id_column_name = 'Id'
-            
-            timestamp = df[timestamp_column_name].iloc[0]
-            identifier = df[id_column_name].iloc[0]
-
-            if (timestamp, identifier) in df_dict_trip:
-                # Actualizar los valores existentes en el DataFrame correspondiente
-                existing_df = df_dict_trip[(timestamp, identifier)]
-                for col in df.columns:
-                    if col not in [timestamp_column_name, id_column_name]:
-                        existing_df.loc[0, col] = df[col].iloc[0]
-                
-                # Verificar si todas las columnas están completas
-                if all(existing_df.notnull().all()):
-                    # Retornar el DataFrame y eliminarlo del diccionario
-                    del df_dict_trip[(timestamp, identifier)]
-                    existing_df['VIN']=VIN
-                    existing_df.set_index('VIN',inplace=True)
-                    return existing_df
-            else:
-                # Si no existe, crear una nueva entrada con el DataFrame vacío y luego asignar los datos
-                df_dict_trip[(timestamp, identifier)] = pd.DataFrame(columns=all_columns_trip)
-                
-                # Asignar valores a las columnas de timestamp y JI
-                df_dict_trip[(timestamp, identifier)].at[0, timestamp_column_name] = timestamp
-                df_dict_trip[(timestamp, identifier)].at[0, id_column_name] = identifier
-                
-                # Asignar valores a las otras columnas
-                for col in df.columns:
-                    if col not in [timestamp_column_name, id_column_name]:
-                        df_dict_trip[(timestamp, identifier)].loc[0, col] = df[col].iloc[0]
-        return df_dict_trip
-
-    elif type_name == 'charge':
-        for df in dataframes:
-            timestamp_column_name = 'Timestamp CC'
-            
-            timestamp = df[timestamp_column_name].iloc[0]
-
-            if timestamp in df_dict_charge:
-                # Actualizar los valores existentes en el DataFrame correspondiente
-                existing_df = df_dict_charge[timestamp]
-                for col in df.columns:
-                    if col != timestamp_column_name:
-                        existing_df.loc[0, col] = df[col].iloc[0]
-                
-                # Verificar si todas las columnas están completas
-                if all(existing_df.notnull().all()):
-                    # Retornar el DataFrame y eliminarlo del diccionario
-                    del df_dict_charge[timestamp]
-                    return existing_df
-            else:
-                # Si no existe, crear una nueva entrada con el DataFrame vacío y luego asignar los datos
-                df_dict_charge[timestamp] = pd.DataFrame(columns=all_columns_charge)
-                
-                # Asignar valores a las columnas de timestamp y JI
-                df_dict_charge[timestamp].at[0, timestamp_column_name] = timestamp
-                
-                # Asignar valores a las otras columnas
-                for col in df.columns:
-                    if col != timestamp_column_name:
-                        df_dict_charge[timestamp].loc[0, col] = df[col].iloc[0]
-
-        return df_dict_charge
-
-
-    return -1
 
+    spec = PROTOCOL_REGISTRY.get(string)
+    if spec is None:
+        return -1
+
+    return spec.type_name
+
+def create_df_dict(VIN:str,dataframes:pd.DataFrame, type_name:str, rejected:dict=None)->pd.DataFrame:
+    # Adds the packets (one-row dataframes) of a vehicle to the reassembly buffer of
+    # type_name. A record is completed when all its message types have been received, also
+    # if some field is None (it is returned as NaN and rejected by df_filter_data).
+    #
+    # INPUT:
+    #   - rejected: optional dictionary where the packets not stored are added, under
+    #     'unmatched', 'missing_key' and 'out_of_order' (see ReassemblyBuffer.add_packet)
+    #
+    # OUTPUT:
+    #   - df_completed: dataframe (indexed by VIN) if any record has been completed
+    #   - the reassembly buffer, if all records are still pending
+    #   - -1 if type_name not supported
+
+    if type_name not in reassembly_buffers:
+        return -1
+
+    buffer = reassembly_buffers[type_name]
+    num_completed = 0
+    for df in dataframes:
+        num_completed += max(buffer.add_packet(VIN, df, rejected), 0)
+
+    if num_completed > 0:
+        return buffer.drain()
+
+    return buffer
+
+
+def load_pending_state(buffers:dict=None, state_file_path:str=PENDING_STATE_FILE_PATH, vin_filter=None) -> int:
+    # Recovers the pending records stored by save_pending_state (e.g. after a restart).
+    # The module buffers are loaded by start_pending_state.
+    #
+    # Every snapshot of the type is read, not only state_file_path, so the records saved by a
+    # different number of shards (or by the single-process ingest) are not stranded. Records
+    # stored in more than one snapshot are only recovered once.
+    #
+    # INPUTS:
+    #   - buffers: reassembly buffers to fill (the ones of this module by default)
+    #   - state_file_path: snapshot path, formatted with type_name
+    #   - vin_filter: optional function that receives an array of VINs and returns a boolean
+    #     mask of the records to recover (e.g. the ones of a shard)
+    #
+    # OUTPUT:
+    #   - number of records recovered
+
+    if buffers is None:
+        buffers = reassembly_buffers
+
+    num_recovered = 0
+    for type_name, buffer in buffers.items():
+        for file_path in get_pending_state_files(type_name, state_file_path):
+            num_recovered += max(buffer.load(file_path, vin_filter), 0)
+
+    return num_recovered
+
+def get_pending_state_files(type_name:str, state_file_path:str=PENDING_STATE_FILE_PATH) -> list:
+    # Returns the snapshots of type_name: state_file_path (first) and every file matching
+    # PENDING_STATE_FILE_PATTERN
+    own_file_path = state_file_path.format(type_name=type_name)
+    file_paths = sorted(glob.glob(PENDING_STATE_FILE_PATTERN.format(type_name=type_name)))
+
+    return [own_file_path] + [file_path for file_path in file_paths if os.path.normpath(file_path) != os.path.normpath(own_file_path)]
+
+def remove_stale_pending_states(state_file_paths:list, type_names:list=TYPE_MESSAGES):
+    # Deletes the snapshots that are not in state_file_paths (formatted with type_name). It
+    # is called once their records have been loaded and saved again by their new owner
+    for type_name in type_names:
+        keep = {os.path.normpath(state_file_path.format(type_name=type_name)) for state_file_path in state_file_paths}
+        for file_path in glob.glob(PENDING_STATE_FILE_PATTERN.format(type_name=type_name)):
+            if os.path.normpath(file_path) not in keep:
+                os.remove(file_path)
+
+def save_pending_state(buffers:dict=None, state_file_path:str=PENDING_STATE_FILE_PATH):
+    # Stores the pending records of every type so that they survive a restart
+    if buffers is None:
+        buffers = reassembly_buffers
+
+    for type_name, buffer in buffers.items():
+        buffer.save(state_file_path.format(type_name=type_name))
+
+def start_pending_state() -> int:
+    # Loads the snapshot into the module buffers and registers a last snapshot when the process
+    # exits. Entry points call it before using the module buffers (from_server_to_parquet and
+    # from_server_to_parquet_batch do it), only the first call of the process loads the snapshot.
+    #
+    # OUTPUT:
+    #   - number of records recovered (0 if the snapshot was already loaded)
+
+    global pending_state_loaded, pending_state_saved
+
+    if pending_state_loaded:
+        return 0
+
+    # The records of every snapshot now belong to this process
+    num_recovered = load_pending_state()
+    save_pending_state()
+    remove_stale_pending_states([PENDING_STATE_FILE_PATH])
+    pending_state_loaded = True
+    pending_state_saved = time.monotonic()
+    atexit.register(save_pending_state)
+
+    return num_recovered
+
+def checkpoint_pending_state(interval:float=PENDING_STATE_SAVE_INTERVAL) -> bool:
+    # Saves the module buffers if the last snapshot is older than interval seconds
+    #
+    # OUTPUT:
+    #   - True if the snapshot has been saved
+
+    global pending_state_saved
+
+    if time.monotonic() - pending_state_saved < interval:
+        return False
+
+    save_pending_state()
+    pending_state_saved = time.monotonic()
+
+    return True
+
+def evict_pending_records(policy:str=EXPIRED_POLICY, buffers:dict=None, dead_letters:DeadLetterStore=None) -> dict:
+    # Removes the pending records that exceed PENDING_MAX_AGE or PENDING_MAX_ENTRIES
+    #
+    # INPUT:
+    #   - policy: 'dead_letter' to store the expired records in the dead letter store,
+    #     'emit' to only return them
+    #
+    # OUTPUT:
+    #   - expired: {type_name: df_expired}, the fields of the message types never received
+    #     are NaN and the 'Missing' column lists those message types
+
+    if buffers is None:
+        buffers = reassembly_buffers
+    if dead_letters is None:
+        dead_letters = dead_letter_store
+
+    expired = {}
+    for type_name, buffer in buffers.items():
+        df_expired = buffer.evict()
+        if policy == 'dead_letter':
+            dead_letters.add_expired(df_expired, type_name)
+        expired[type_name] = df_expired
+
+    return expired
 
 def from_server_to_parquet(df_server:pd.DataFrame):
 # This function will append to the existing parquet, given a dataframe fetched from Ray's
@@ -211,11 +348,26 @@ def from_server_to_parquet(df_server:pd.DataFrame):
 # OUTPUT
 # - df_appended if any row has been completed, otherwise returns None
 
+    start_pending_state()
     df_server = df_server.sort_values(by=VIN_COLUMN, ascending=True)
+    df_appended = None
 
     for unused,row in df_server.iterrows():
         df_packet,type_name=df_from_string_to_df(row[DATA_COLUMN])
-        df_created = create_df_dict(row[VIN_COLUMN],[df_packet],type_name)
+        if type_name == -1:
+            is_malformed = not isinstance(row[DATA_COLUMN],str) or ':' not in row[DATA_COLUMN]
+            dead_letter_store.add([row[VIN_COLUMN]],[row[DATA_COLUMN]],REASON_MALFORMED if is_malformed else REASON_UNKNOWN_TYPE)
+            continue
+
+        # Packets that are not stored go to the dead letter store, and so does a copy of the
+        # packets with invalid fields, like in from_server_to_parquet_batch
+        rejected = {}
+        df_created = create_df_dict(row[VIN_COLUMN],[df_packet],type_name,rejected)
+        for key, reason in LEGACY_REJECTED_REASONS.items():
+            if key in rejected:
+                dead_letter_store.add([row[VIN_COLUMN]],[row[DATA_COLUMN]],reason)
+        if not rejected and df_packet.isna().any(axis=None):
+            dead_letter_store.add([row[VIN_COLUMN]],[row[DATA_COLUMN]],REASON_INVALID_FIELD)
         
         # The returned value can be a dataframe if it has been completed or a dictionary
         # if else.
@@ -224,6 +376,100 @@ def from_server_to_parquet(df_server:pd.DataFrame):
             if isinstance(df_filtered,pd.DataFrame):
                 df_appended=df_append_data(df_filtered,type_name)
 
+            evict_pending_records()
+            checkpoint_pending_state()
+            dead_letter_store.flush()
             return df_appended
     
-    return
\ No newline at end of file
+    # The pending records are bounded like in from_server_to_parquet_batch
+    evict_pending_records()
+    checkpoint_pending_state()
+    dead_letter_store.flush()
+    return
+
+def df_assemble_batch(df_server:pd.DataFrame, buffers:dict=None, dead_letters:DeadLetterStore=None) -> dict:
+    # Decodes all the packets of df_server at once, adds them to the reassembly buffers and
+    # returns every record completed (not yet filtered). Packets that can't be used are
+    # routed to the dead letter store instead of raising.
+    #
+    # INPUT:
+    #   - df_server: containing two columns: DeviceId, and OriginalMessage
+    #   - buffers: reassembly buffers to use (the ones of this module by default)
+    #   - dead_letters: dead letter store to use (the one of this process by default)
+    #
+    # OUTPUT:
+    #   - completed: {type_name: df_completed} for 'trip' and 'charge'
+
+    if buffers is None:
+        buffers = reassembly_buffers
+    if dead_letters is None:
+        dead_letters = dead_letter_store
+
+    messages = df_server[DATA_COLUMN].reset_index(drop=True)
+    vins = df_server[VIN_COLUMN].reset_index(drop=True)
+    blocks = df_decode_batch(messages, vins, dead_letters)
+
+    rejected = {}
+    for message_type, block in blocks.items():
+        buffers[check_type(message_type)].add_block(message_type, block, rejected)
+
+    for reason, positions in [(REASON_MISSING_KEY, rejected.get('missing_key', [])), (REASON_OUT_OF_ORDER, rejected.get('out_of_order', []))]:
+        for position in positions:
+            dead_letters.add(vins[position], messages[position], reason)
+
+    completed = {type_name: buffer.drain() for type_name, buffer in buffers.items()}
+
+    return completed
+
+
+def from_server_to_parquet_batch(df_server:pd.DataFrame) -> dict:
+# Batch version of from_server_to_parquet. The whole server dataframe is consumed: all
+# packets are decoded at once, every record completed in this pull is collected and then
+# each type is filtered once and appended once, so that every affected month file is
+# written a single time.
+#
+# INPUT
+# - df_server: containing two columns: DeviceId, and OriginalMessage, containing one packet info
+#
+# OUTPUT
+# - summary: {type_name: {'completed': n, 'rejected': n, 'expired': n, 'pending': n}} for 'trip'
+#   and 'charge', plus {'dead_letter': {reason: n}} with the packets routed to the dead
+#   letter store in this pull
+
+    start_pending_state()
+    counters_before = dead_letter_store.get_counters()
+
+    completed = df_assemble_batch(df_server)
+    expired = evict_pending_records()
+
+    summary = {}
+    for type_name, buffer in reassembly_buffers.items():
+        df_completed = completed[type_name]
+        num_completed = df_completed.shape[0]
+        num_accepted = 0
+
+        if num_completed > 0:
+            df_filtered = df_filter_data(df_completed, type_name)
+            if isinstance(df_filtered, pd.DataFrame):
+                num_accepted = df_filtered.shape[0]
+                df_append_data(df_filtered, type_name)
+
+        summary[type_name] = {'completed': num_completed,
+                              'rejected':  num_completed - num_accepted,
+                              'expired':   expired[type_name].shape[0],
+                              'pending':   len(buffer)}
+
+    checkpoint_pending_state()
+    dead_letter_store.flush()
+
+    counters = dead_letter_store.get_counters()
+    summary['dead_letter'] = {reason: count - counters_before.get(reason, 0) for reason, count in counters.items()
+                              if count > counters_before.get(reason, 0)}
+
+    return summary
+
+def get_dead_letter_counters() -> dict:
+    # Returns {reason: number of packets/records} routed to the dead letter store by this
+    # process since it started
+    return dead_letter_store.get_counters()
+
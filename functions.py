@@ -1,5 +1,6 @@
 import pandas as pd
 import os
+from dataframe_storage import df_read_month
 
 #Protocol Dictionary
 protocol_dict={"G1":["Timestamp CT", "Start", "End", "Start odometer", "Id"],
@@ -582,9 +583,9 @@ def df_from_xlsx_vehicle(file_route, rack_number, index='VIN', check_columns=['I
 def df_from_parquet_elements(file_path:str,elements:tuple=None, samples:int=None) -> pd.DataFrame:
     # Read and save the data file (.parquet) into a dataframe. If the file_path is not found,
     # return -1
-    if not os.path.exists(file_path):
+    df = df_read_month(file_path)
+    if not isinstance(df,pd.DataFrame):
         return -1
-    df = pd.read_parquet(file_path)
     
     # Copy desired columns onto custom_df. If samples is None, that means that all rows need
     # to be copied. Only "samples" number of rows copied if otherwise.
@@ -623,9 +624,10 @@ def df_from_parquet_vehicle(file_path:str, rack_number:int) -> pd.DataFrame:
     
     # Read and save the data file (.parquet) into a dataframe. If the file_path is not found,
     # return -1
-    if not os.path.exists(file_path):
+    # Only the row groups that contain rack_number are read
+    df = df_read_month(file_path, vins=[rack_number])
+    if not isinstance(df,pd.DataFrame):
         return -1
-    df = pd.read_parquet(file_path)
     
     # Filter by rack_number, which in this case, is the index of the dataframe
     custom_df = df.loc[rack_number]
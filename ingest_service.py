@@ -0,0 +1,311 @@
+import asyncio
+import argparse
+import os
+import time
+import signal
+import pandas as pd
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from dataframe_storage import df_append_data
+from dataframe_treatment import df_filter_data
+from dead_letter import dead_letter_store, REASON_INGEST_ERROR
+from from_server_to_df import df_assemble_batch, evict_pending_records, save_pending_state, start_pending_state, VIN_COLUMN, DATA_COLUMN
+
+"""
+*************************************************************************************************************
+This file contains the asyncio ingest service, which keeps parsing, filtering and parquet I/O from blocking
+each other. Records (DeviceId, OriginalMessage) are accepted from a local TCP socket (one "DeviceId,Message"
+per line) or from a directory of dump files (.csv or .parquet) and go through three stages:
+
+    1) Sources put chunks of packets into a bounded queue. When the queue is full the sources wait, so a
+       burst of uploads slows down the readers instead of dropping packets
+    2) The assembler decodes every chunk, feeds the reassembly buffers and filters the completed records
+    3) The writer groups the filtered records and appends them with df_append_data in an executor
+
+A chunk that raises an error is logged and routed to the dead letter store, and so are the records that can't
+be appended, so one bad chunk does not stop the stages (which would block the sources on the full queues).
+When the service is stopped (also by Ctrl-C or SIGTERM) the queued chunks are processed, the pending records
+are written and the reassembly buffers are saved.
+
+stats() returns the queue depths, the throughput and the lag of the service.
+*************************************************************************************************************
+"""
+
+QUEUE_SIZE = 100                # Maximum number of chunks waiting in each queue
+CHUNK_ROWS = 1000               # Packets per chunk read from TCP connections and dump files
+WRITE_BATCH_ROWS = 10000        # Filtered records accumulated before writing them
+FLUSH_INTERVAL = 5.0            # Maximum seconds a chunk/record waits before being processed/written
+STATE_INTERVAL = 60.0           # Seconds between evictions and snapshots of the pending records
+
+def df_iter_dump_file(file_path:str, chunk_rows:int=CHUNK_ROWS):
+    # Generator that reads a dump file (.csv or .parquet) containing the DeviceId and
+    # OriginalMessage columns in chunks of chunk_rows packets
+
+    if file_path.endswith('.parquet'):
+        parquet_file = pq.ParquetFile(file_path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=[VIN_COLUMN, DATA_COLUMN]):
+            yield batch.to_pandas()
+
+    elif file_path.endswith('.csv'):
+        for df_chunk in pd.read_csv(file_path, usecols=[VIN_COLUMN, DATA_COLUMN], dtype=str, chunksize=chunk_rows):
+            yield df_chunk
+
+class IngestService:
+
+    def __init__(self, queue_size:int=QUEUE_SIZE, write_batch_rows:int=WRITE_BATCH_ROWS, flush_interval:float=FLUSH_INTERVAL):
+        self.packet_queue = asyncio.Queue(maxsize=queue_size)
+        self.write_queue = asyncio.Queue(maxsize=queue_size)
+        self.write_batch_rows = write_batch_rows
+        self.flush_interval = flush_interval
+
+        # The reassembly buffers are not thread-safe, so decoding, assembling and filtering run
+        # in a single thread. Parquet writes use a different one.
+        self.assembler_executor = ThreadPoolExecutor(max_workers=1)
+        self.writer_executor = ThreadPoolExecutor(max_workers=1)
+
+        self.started = time.monotonic()
+        self.counters = {'packets': 0, 'completed': 0, 'rejected': 0, 'written': 0, 'errors': 0}
+        self.lag = 0.0
+        self.oldest_unwritten = None
+        self.tasks = []
+
+    def stats(self) -> dict:
+        # Returns the current state of the service:
+        #   - packet_queue / write_queue: chunks waiting in each queue
+        #   - packets_per_s / records_per_s: packets received and records written per second
+        #   - lag: seconds between the reception of the last chunk assembled and its assembly
+        #   - write_lag: seconds the oldest record not written yet has been waiting
+        #   - packets, completed, rejected, written: totals since the service started
+        #   - errors: chunks and write batches that raised an error
+        #   - dead_letter: {reason: n} packets routed to the dead letter store
+
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        write_lag = 0.0 if self.oldest_unwritten is None else time.monotonic() - self.oldest_unwritten
+
+        return {
+            'packet_queue':     self.packet_queue.qsize(),
+            'write_queue':      self.write_queue.qsize(),
+            'packets_per_s':    self.counters['packets'] / elapsed,
+            'records_per_s':    self.counters['written'] / elapsed,
+            'lag':              self.lag,
+            'write_lag':        write_lag,
+            **self.counters,
+            'dead_letter':      dead_letter_store.get_counters()
+        }
+
+    async def submit(self, df_chunk:pd.DataFrame):
+        # Puts a chunk of packets (DeviceId, OriginalMessage) into the packet queue, waiting
+        # if the queue is full
+        if not df_chunk.empty:
+            await self.packet_queue.put((time.monotonic(), df_chunk))
+
+    async def start(self):
+        # Loads the pending records snapshot and starts the assembler and writer stages
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.assembler_executor, start_pending_state)
+        self.tasks = [asyncio.create_task(self._assembler()), asyncio.create_task(self._writer())]
+
+    async def stop(self):
+        # Processes every chunk still queued, writes the remaining records and stores the
+        # pending records
+        await self.packet_queue.put(None)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.assembler_executor, self._maintain_state)
+        self.assembler_executor.shutdown()
+        self.writer_executor.shutdown()
+
+    async def serve_tcp(self, host:str, port:int):
+        # Accepts "DeviceId,OriginalMessage" lines from local TCP connections
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        rows = []
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                line = None
+
+            if line:
+                device_id, separator, message = line.decode(errors='replace').rstrip('\r\n').partition(',')
+                if separator:
+                    rows.append((device_id, message))
+
+            # Submit the chunk if it is full, the connection is idle or it has been closed
+            if rows and (line is None or line == b'' or len(rows) >= CHUNK_ROWS):
+                await self.submit(pd.DataFrame(rows, columns=[VIN_COLUMN, DATA_COLUMN]))
+                rows = []
+
+            if line == b'':
+                break
+
+        writer.close()
+
+    async def ingest_directory(self, directory:str, chunk_rows:int=CHUNK_ROWS):
+        # Submits every dump file (.csv or .parquet) of directory, in name order
+        loop = asyncio.get_running_loop()
+
+        for filename in sorted(os.listdir(directory)):
+            chunks = df_iter_dump_file(os.path.join(directory, filename), chunk_rows)
+            while True:
+                # Files are read in the writer executor so that reading does not block the loop
+                df_chunk = await loop.run_in_executor(self.writer_executor, next, chunks, None)
+                if df_chunk is None:
+                    break
+                await self.submit(df_chunk)
+
+    def _assemble_chunk(self, df_chunk:pd.DataFrame) -> list:
+        # Decodes and assembles a chunk, returns the filtered records of each type. If it
+        # raises, the packets of the chunk are routed to the dead letter store
+        filtered = []
+
+        try:
+            for type_name, df_completed in df_assemble_batch(df_chunk).items():
+                if df_completed.empty:
+                    continue
+                self.counters['completed'] += df_completed.shape[0]
+                df_filtered = df_filter_data(df_completed, type_name)
+
+                num_accepted = df_filtered.shape[0] if isinstance(df_filtered, pd.DataFrame) else 0
+                self.counters['rejected'] += df_completed.shape[0] - num_accepted
+                if num_accepted > 0:
+                    filtered.append((type_name, df_filtered))
+        except Exception as error:
+            print(f'Ingest service: chunk of {df_chunk.shape[0]} packets failed ({error!r}), routed to the dead letter store')
+            self.counters['errors'] += 1
+            dead_letter_store.add(df_chunk[VIN_COLUMN], df_chunk[DATA_COLUMN], REASON_INGEST_ERROR)
+
+        return filtered
+
+    def _maintain_state(self):
+        try:
+            evict_pending_records()
+            save_pending_state()
+            dead_letter_store.flush()
+        except Exception as error:
+            print(f'Ingest service: could not store the pending records ({error!r})')
+            self.counters['errors'] += 1
+
+    def _append_batch(self, df_batch:pd.DataFrame, type_name:str) -> bool:
+        # Appends a batch of filtered records. If it raises, the records are routed to the
+        # dead letter store
+        try:
+            df_append_data(df_batch, type_name)
+            return True
+        except Exception as error:
+            print(f'Ingest service: could not append {df_batch.shape[0]} {type_name} records ({error!r}), routed to the dead letter store')
+            self.counters['errors'] += 1
+            dead_letter_store.add_unwritten(df_batch, type_name)
+            return False
+
+    async def _assembler(self):
+        loop = asyncio.get_running_loop()
+        last_maintenance = time.monotonic()
+
+        while True:
+            item = await self.packet_queue.get()
+            if item is None:
+                await self.write_queue.put(None)
+                return
+
+            received, df_chunk = item
+            filtered = await loop.run_in_executor(self.assembler_executor, self._assemble_chunk, df_chunk)
+            self.counters['packets'] += df_chunk.shape[0]
+            self.lag = time.monotonic() - received
+
+            for type_name, df_filtered in filtered:
+                await self.write_queue.put((received, type_name, df_filtered))
+
+            if time.monotonic() - last_maintenance > STATE_INTERVAL:
+                await loop.run_in_executor(self.assembler_executor, self._maintain_state)
+                last_maintenance = time.monotonic()
+
+    async def _write_batches(self, batches:dict):
+        # Blocking parquet writes are done in the writer executor
+        loop = asyncio.get_running_loop()
+
+        for type_name, frames in batches.items():
+            if frames:
+                df_batch = pd.concat(frames)
+                if await loop.run_in_executor(self.writer_executor, self._append_batch, df_batch, type_name):
+                    self.counters['written'] += df_batch.shape[0]
+            frames.clear()
+        self.oldest_unwritten = None
+
+    async def _writer(self):
+        batches = {'trip': [], 'charge': []}
+        last_flush = time.monotonic()
+        finished = False
+
+        try:
+            while not finished:
+                try:
+                    item = await asyncio.wait_for(self.write_queue.get(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    item = ()
+
+                if item is None:
+                    finished = True
+                elif item:
+                    received, type_name, df_filtered = item
+                    batches[type_name].append(df_filtered)
+                    if self.oldest_unwritten is None:
+                        self.oldest_unwritten = received
+
+                num_rows = sum(df.shape[0] for frames in batches.values() for df in frames)
+                if num_rows == 0:
+                    continue
+                if not finished and num_rows < self.write_batch_rows and time.monotonic() - last_flush < self.flush_interval:
+                    continue
+
+                await self._write_batches(batches)
+                last_flush = time.monotonic()
+        except asyncio.CancelledError:
+            # The records already taken out of the reassembly buffers would be lost
+            await self._write_batches(batches)
+            raise
+
+async def run_service(host:str=None, port:int=None, directory:str=None, stats_interval:float=10.0):
+    # Runs the ingest service with the given sources. If only a directory is given, the service
+    # stops once all its files have been ingested
+    service = IngestService()
+    await service.start()
+
+    # SIGTERM stops the service like Ctrl-C: the sources are cancelled and the service is
+    # stopped, so the queued chunks are written and the pending records saved
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except (NotImplementedError, AttributeError):
+        pass
+
+    async def report():
+        while True:
+            await asyncio.sleep(stats_interval)
+            print(service.stats())
+
+    reporter = asyncio.create_task(report())
+
+    try:
+        if directory is not None:
+            await service.ingest_directory(directory)
+        if port is not None:
+            await service.serve_tcp(host, port)
+    finally:
+        await service.stop()
+        reporter.cancel()
+        print(service.stats())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest server packets into the df/ parquet files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='local TCP port to accept "DeviceId,OriginalMessage" lines')
+    parser.add_argument('--directory', help='directory of .csv/.parquet dump files to ingest')
+    parser.add_argument('--stats-interval', type=float, default=10.0)
+    args = parser.parse_args()
+
+    asyncio.run(run_service(args.host, args.port, args.directory, args.stats_interval))
@@ -0,0 +1,92 @@
+import os
+import json
+import numpy as np
+from collections import namedtuple
+
+"""
+*************************************************************************************************************
+This file contains the compiled parameter schema. param_battery.json is parsed once and compiled into a
+TypeSchema for every type ('trip' and 'charge'):
+    - columns:      column tags of the type, in the order of the json (the order of the stored columns)
+    - value_min:    numpy vector of the Value_MIN of every column, aligned with columns
+    - value_max:    numpy vector of the Value_MAX of every column
+    - resolution:   numpy vector of the Resolution of every column
+    - positions:    {column: position in columns}
+
+The compiled schema is cached and only rebuilt when the modification time of the file changes, so the
+treatment functions (and the protocol registry) get the parameters without opening nor parsing the json.
+*************************************************************************************************************
+"""
+
+PARAM_FILE_PATH = 'param_battery.json'
+
+TypeSchema = namedtuple('TypeSchema', ['type_name', 'columns', 'value_min', 'value_max', 'resolution', 'positions'])
+
+# {file path: (modification time, parameters, {type_name: TypeSchema})}
+compiled_schemas = {}
+
+def get_param_file_path(param_file_path:str=PARAM_FILE_PATH) -> str:
+    # Returns param_file_path, or the one next to this file if it is not found
+    if not os.path.exists(param_file_path):
+        param_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), PARAM_FILE_PATH)
+
+    return param_file_path
+
+def compile_type_schemas(parameters:dict) -> dict:
+    # Builds the TypeSchema of every type of the parameters
+    #
+    # OUTPUT:
+    #   - schemas: {type_name: TypeSchema}
+
+    schemas = {}
+    for type_name in ['trip', 'charge']:
+        columns = tuple(key for key, value in parameters.items() if value.get("Type Chart Variables") == type_name)
+        schemas[type_name] = TypeSchema(type_name, columns,
+                                        np.array([parameters[column]["Value_MIN"] for column in columns], dtype=np.float64),
+                                        np.array([parameters[column]["Value_MAX"] for column in columns], dtype=np.float64),
+                                        np.array([parameters[column]["Resolution"] for column in columns], dtype=np.float64),
+                                        {column: position for position, column in enumerate(columns)})
+
+    return schemas
+
+def load_compiled_schema(param_file_path:str=PARAM_FILE_PATH) -> tuple:
+    # Returns (parameters, {type_name: TypeSchema}) of the file, compiling it again only if it
+    # has been modified since it was last compiled
+    param_file_path = get_param_file_path(param_file_path)
+    modified = os.stat(param_file_path).st_mtime_ns
+
+    cached = compiled_schemas.get(param_file_path)
+    if cached is None or cached[0] != modified:
+        with open(param_file_path, 'r') as file:
+            parameters = json.load(file)
+        cached = (modified, parameters, compile_type_schemas(parameters))
+        compiled_schemas[param_file_path] = cached
+
+    return cached[1], cached[2]
+
+def get_parameters(param_file_path:str=PARAM_FILE_PATH) -> dict:
+    # Returns the parsed param_battery.json: {column: {"Value_MIN", "Value_MAX", "Resolution"...}}.
+    # It is shared, do not modify it
+    return load_compiled_schema(param_file_path)[0]
+
+def get_type_schema(type_name:str, param_file_path:str=PARAM_FILE_PATH) -> TypeSchema:
+    # Returns the TypeSchema of type_name, -1 if type_name is not supported
+    return load_compiled_schema(param_file_path)[1].get(type_name, -1)
+
+def get_column_vectors(columns, param_file_path:str=PARAM_FILE_PATH) -> tuple:
+    # Returns the (value_min, value_max, resolution) vectors aligned with the given columns,
+    # which can belong to any type
+    parameters, schemas = load_compiled_schema(param_file_path)
+    vectors = []
+    for column in columns:
+        type_schema = schemas.get(parameters[column].get("Type Chart Variables"))
+        if type_schema is None:
+            vectors.append((parameters[column]["Value_MIN"], parameters[column]["Value_MAX"], parameters[column]["Resolution"]))
+        else:
+            position = type_schema.positions[column]
+            vectors.append((type_schema.value_min[position], type_schema.value_max[position], type_schema.resolution[position]))
+
+    if not vectors:
+        return np.empty(0), np.empty(0), np.empty(0)
+
+    return tuple(np.array(vector, dtype=np.float64) for vector in zip(*vectors))
@@ -0,0 +1,132 @@
+import math
+import numpy as np
+from collections import namedtuple
+from param_schema import PARAM_FILE_PATH, get_parameters
+
+"""
+*************************************************************************************************************
+This file contains the protocol registry, which is compiled once when the module is imported.
+
+For every message type (G1...B4 for trips, H2...H8 for charges) it stores a MessageSpec with:
+    - fields:       order of the fields in the payload
+    - dtypes:       numpy dtype of every field, the narrowest integer that holds the raw values allowed by
+                    param_battery.json (Value_MIN..Value_MAX). Key fields and fields not found in the json
+                    are int64
+    - type_name:    'trip' or 'charge'
+    - key_fields:   fields (besides the VIN) that identify the record the packet belongs to
+    - bit:          bit of the message type in the presence bitmask of its record
+
+Decoding a packet only needs PROTOCOL_REGISTRY[message_type], no if/elif chain nor type checks.
+
+STORAGE_DTYPES holds the compact dtype every stored (filtered) column is kept with, {type_name: {column: dtype}}:
+    - columns whose stored values are integers (decoded fields with an integer resolution) use the narrowest
+      signed integer that holds Value_MIN..Value_MAX times the resolution. Signed, so that differences
+      between columns (End - Start...) never wrap around
+    - the rest use float32 when it represents every resolution step of the column exactly (less than 2^24
+      steps from 0 to the bound), float64 otherwise
+*************************************************************************************************************
+"""
+
+#Protocol Dictionary
+protocol_dict={"G1":["Timestamp CT", "Start", "End", "Start odometer", "Id"],
+                   "G2":["Timestamp CT", "End odometer", "Max speed", "Id"],
+                   "C2":["Timestamp CT", "City distance", "Sport distance","Flow distance","Sail distance","Regen distance","Id"],
+                   "C3":["Timestamp CT", "City energy", "Sport energy","Flow energy","City regen","Sport regen","Map changes","Id"],
+                   "IE":["Timestamp CT", "Inv max T", "Inv avg T", "Inv min T","Motor max T","Motor avg T","Motor min T","Id"],
+                   "B1":["Timestamp CT", "Start SoC", "End SoC","Max discharge","Max regen","Id"],
+                   "B2":["Timestamp CT", "Avg current", "Thermal current","Max V","Id"],
+                   "B3":["Timestamp CT", "Average V", "Min V","Max cell V","Min cell V","Id"],
+                   "B4":["Timestamp CT", "Cell V diff", "Max temp CT","Avg temp","Min temp CT","Max delta","Avg delta","Id"],
+                   "H2":["Timestamp CC", "SoC i", "SoC f","Vmin I","Vavg I","Vmax I","Vmin F"],
+                   "H3":["Timestamp CC", "Avg final V", "Max final V","Max BMS current","Max charger current"],
+                   "H4":["Timestamp CC", "Charger max P", "Min temp I","Avg temp I","Max temp I","Min temp F"],
+                   "H5":["Timestamp CC", "Avg temp F","Max temp F","Min temp CC","Max temp CC","Cycles","Age"],
+                   "H8":["Timestamp CC", "uSoC I", "uSoC F","Connector"]}
+
+# Message types that form every record and the fields that identify it
+TYPE_MESSAGES = {'trip':   ['G1','G2','C2','C3','IE','B1','B2','B3','B4'],
+                 'charge': ['H2','H3','H4','H5','H8']}
+KEY_FIELDS = {'trip':   ['Timestamp CT','Id'],
+              'charge': ['Timestamp CC']}
+
+# Integers up to 2^24 are exactly representable in float32
+FLOAT32_MAX_STEPS = 2**24
+
+INTEGER_DTYPES = [np.dtype(np.uint8), np.dtype(np.int8), np.dtype(np.uint16), np.dtype(np.int16),
+                  np.dtype(np.uint32), np.dtype(np.int32), np.dtype(np.int64)]
+
+MessageSpec = namedtuple('MessageSpec', ['message_type', 'type_name', 'fields', 'dtypes', 'key_fields', 'bit'])
+
+def narrowest_int_dtype(value_min:float, value_max:float) -> np.dtype:
+    # Returns the narrowest integer dtype that can hold every value in [value_min, value_max]
+    for dtype in INTEGER_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= math.floor(value_min) and math.ceil(value_max) <= info.max:
+            return dtype
+
+    return np.dtype(np.int64)
+
+def narrowest_signed_int_dtype(value_min:float, value_max:float) -> np.dtype:
+    # Returns the narrowest signed integer dtype that can hold every value in [value_min, value_max]
+    return narrowest_int_dtype(min(value_min, -1), max(value_max, 0))
+
+def compile_protocol_registry(param_file_path:str=PARAM_FILE_PATH) -> dict:
+    # Builds a MessageSpec for every message type of protocol_dict
+    #
+    # OUTPUT:
+    #   - registry: {message_type: MessageSpec}
+
+    parameters = get_parameters(param_file_path)
+
+    registry = {}
+    for type_name, message_types in TYPE_MESSAGES.items():
+        key_fields = tuple(KEY_FIELDS[type_name])
+        for bit, message_type in enumerate(message_types):
+            fields = tuple(protocol_dict[message_type])
+            dtypes = []
+            for field in fields:
+                if field in key_fields or field not in parameters:
+                    dtypes.append(np.dtype(np.int64))
+                else:
+                    dtypes.append(narrowest_int_dtype(parameters[field]["Value_MIN"], parameters[field]["Value_MAX"]))
+
+            registry[message_type] = MessageSpec(message_type, type_name, fields, tuple(dtypes), key_fields, 1 << bit)
+
+    return registry
+
+def get_field_dtypes(type_name:str) -> dict:
+    # Returns {field: dtype} of every field of the records of type_name
+    return {field: dtype for message_type in TYPE_MESSAGES[type_name]
+            for field, dtype in zip(PROTOCOL_REGISTRY[message_type].fields, PROTOCOL_REGISTRY[message_type].dtypes)}
+
+def compile_storage_dtypes(param_file_path:str=PARAM_FILE_PATH) -> dict:
+    # Builds the compact dtype of every column of param_battery.json (see STORAGE_DTYPES)
+    #
+    # OUTPUT:
+    #   - storage_dtypes: {type_name: {column: dtype}}, columns in the order of the json
+
+    parameters = get_parameters(param_file_path)
+
+    storage_dtypes = {type_name: {} for type_name in TYPE_MESSAGES}
+    for column, parameter in parameters.items():
+        type_name = parameter.get("Type Chart Variables")
+        if type_name not in storage_dtypes:
+            continue
+
+        resolution = parameter["Resolution"]
+        value_min = parameter["Value_MIN"] * resolution
+        value_max = parameter["Value_MAX"] * resolution
+        is_decoded = any(column in protocol_dict[message_type] for message_type in TYPE_MESSAGES[type_name])
+
+        if is_decoded and float(resolution).is_integer():
+            dtype = narrowest_signed_int_dtype(value_min, value_max)
+        elif max(abs(parameter["Value_MIN"]), abs(parameter["Value_MAX"])) < FLOAT32_MAX_STEPS:
+            dtype = np.dtype(np.float32)
+        else:
+            dtype = np.dtype(np.float64)
+        storage_dtypes[type_name][column] = dtype
+
+    return storage_dtypes
+
+PROTOCOL_REGISTRY = compile_protocol_registry()
+STORAGE_DTYPES = compile_storage_dtypes()
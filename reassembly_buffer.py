@@ -0,0 +1,358 @@
+import pandas as pd
+import numpy as np
+import os
+import time
+from storage_io import atomic_write
+
+"""
+*************************************************************************************************************
+This file contains the reassembly buffer used to rebuild complete trip and charge records from the packets
+received from the server.
+
+Every pending record (identified by its key: VIN, Timestamp CT and Id for trips or VIN and Timestamp CC for
+charges) is stored as one row of preallocated numpy columns (typed with the dtypes given, usually the ones of
+the protocol registry). Each message type that has been received for a record sets one bit of the presence
+bitmask of its row, so a record is complete when its bitmask equals the complete mask. Fields that could not
+be converted to an integer (None) are tracked in a second bitmask.
+
+
+Unlike the previous dictionary of dataframes, a record is completed as soon as every message type has been
+received, even if some of its fields are None: those fields are returned as NaN, so df_filter_data rejects the
+record (NaN is out of bounds) and the packets with invalid fields are already kept in the dead letter store.
+Holding such records until they expire would only keep them in memory, no later packet can complete them.
+
+Completed rows are kept aside until drain() is called, which returns all of them at once as a single
+dataframe indexed by VIN.
+
+Pending records can be bounded by age (max_age, in seconds since the first packet was received) and by
+number (max_entries). evict() removes the records that exceed those limits and returns them with the fields
+of the missing message types set to NaN. The state can be stored with save() and recovered with load() so
+that a restart does not lose the records that are still incomplete.
+*************************************************************************************************************
+"""
+
+INITIAL_CAPACITY = 1024
+
+class ReassemblyBuffer:
+
+    def __init__(self, param_orders:dict, key_columns:list, dtypes:dict=None, capacity:int=INITIAL_CAPACITY, max_age:float=None, max_entries:int=None):
+        # INPUTS:
+        #   - param_orders: {message_type: [fields]} of all the message types that form a record
+        #   - key_columns: fields (besides the VIN) that identify a record
+        #   - dtypes: {field: integer dtype} used to store every field (int64 by default)
+        #   - capacity: number of rows preallocated (at least 1), it grows automatically when needed
+        #   - max_age: seconds a record can stay pending before being evicted (None: no limit)
+        #   - max_entries: maximum number of pending records (None: no limit)
+
+        # The buffer grows by doubling its capacity, so it can't start empty
+        if capacity < 1:
+            raise ValueError(f'capacity must be a positive number of rows, got {capacity}')
+
+        self.param_orders = param_orders
+        self.key_columns = key_columns
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.message_bits = {message_type: 1 << i for i, message_type in enumerate(param_orders)}
+        self.complete_mask = (1 << len(param_orders)) - 1
+
+        # All fields of the record, in order of appearance in the protocol
+        self.columns = []
+        for param_order in param_orders.values():
+            for param in param_order:
+                if param not in self.columns:
+                    self.columns.append(param)
+        self.column_bits = {column: np.uint64(1 << i) for i, column in enumerate(self.columns)}
+        self.dtypes = {column: np.dtype((dtypes or {}).get(column, np.int64)) for column in self.columns}
+
+        # Lookup used to know the message type of a single packet given its columns
+        self.message_types_by_columns = {tuple(param_order): message_type for message_type, param_order in param_orders.items()}
+
+        self.capacity = 0
+        self.free_rows = []
+        self.values = {column: np.zeros(0, dtype=self.dtypes[column]) for column in self.columns}
+        self.nulls = np.zeros(0, dtype=np.uint64)
+        self.presence = np.zeros(0, dtype=np.uint16)
+        self.vins = np.empty(0, dtype=object)
+        self.keys = np.empty(0, dtype=object)
+        self.created = np.zeros(0, dtype=np.float64)
+        self._grow(capacity)
+
+        self.slots = {}
+        self.completed_rows = []
+
+    def __len__(self):
+        # Number of records still waiting for some message type
+        return len(self.slots)
+
+    def _grow(self, capacity:int):
+        # Enlarge every column up to the given capacity, keeping the current content
+        new_rows = range(self.capacity, capacity)
+
+        for column in self.columns:
+            self.values[column] = np.concatenate([self.values[column], np.zeros(len(new_rows), dtype=self.dtypes[column])])
+        self.nulls = np.concatenate([self.nulls, np.zeros(len(new_rows), dtype=np.uint64)])
+        self.presence = np.concatenate([self.presence, np.zeros(len(new_rows), dtype=np.uint16)])
+        self.vins = np.concatenate([self.vins, np.empty(len(new_rows), dtype=object)])
+        self.keys = np.concatenate([self.keys, np.empty(len(new_rows), dtype=object)])
+        self.created = np.concatenate([self.created, np.zeros(len(new_rows), dtype=np.float64)])
+
+        self.free_rows.extend(reversed(new_rows))
+        self.capacity = capacity
+
+    def _get_rows(self, keys:list) -> np.ndarray:
+        # Returns the row of every key, allocating a new row for the keys not yet pending. VINs
+        # are kept as strings, the type save() stores them with, so that a record whose DeviceId
+        # is not a string still matches its packets after a restart
+        rows = np.empty(len(keys), dtype=np.int64)
+        now = time.time()
+
+        for i, key in enumerate(keys):
+            key = (str(key[0]),) + key[1:]
+            row = self.slots.get(key)
+            if row is None:
+                if not self.free_rows:
+                    self._grow(2 * self.capacity)
+                row = self.free_rows.pop()
+                self.slots[key] = row
+                self.keys[row] = key
+                self.vins[row] = key[0]
+                self.presence[row] = 0
+                self.nulls[row] = 0
+                self.created[row] = now
+            rows[i] = row
+
+        return rows
+
+    def add_block(self, message_type:str, block:pd.DataFrame, rejected:dict=None) -> int:
+        # Stores a block of packets of the same message type (as returned by df_decode_batch).
+        # Packets without a valid key, and packets whose message type had already been received
+        # for their record (out of order), are not stored.
+        #
+        # INPUTS:
+        #   - message_type: 'G1', 'G2', ..., 'H8'
+        #   - block: dataframe with a 'VIN' column and one column per protocol field
+        #   - rejected: optional dictionary where the index of the packets not stored is added,
+        #     under 'missing_key' and 'out_of_order'
+        #
+        # OUTPUT:
+        #   - number of records completed by this block
+        #   - -1 if message_type does not belong to this buffer
+
+        if message_type not in self.message_bits:
+            return -1
+
+        # Packets without a valid key can't be assigned to any record
+        has_key = block[['VIN'] + self.key_columns].notna().all(axis=1)
+        if rejected is not None and not has_key.all():
+            rejected.setdefault('missing_key', []).append(block.index[~has_key.to_numpy()])
+        block = block[has_key]
+        if block.empty:
+            return 0
+
+        key_frame = block[['VIN'] + self.key_columns].astype(object)
+        keys = list(key_frame.itertuples(index=False, name=None))
+        rows = self._get_rows(keys)
+
+        # Only the first packet of every record is stored, and only if its message type had not
+        # been received yet
+        message_bit = self.message_bits[message_type]
+        is_new = ((self.presence[rows] & message_bit) == 0) & ~pd.Series(rows).duplicated().to_numpy()
+        if not is_new.all():
+            if rejected is not None:
+                rejected.setdefault('out_of_order', []).append(block.index[~is_new])
+            block = block[is_new]
+            rows = rows[is_new]
+
+        # Write all the fields of the block at once
+        for column in self.param_orders[message_type]:
+            if column not in block.columns:
+                continue
+            # Values that do not fit in the dtype of the column are stored as None
+            info = np.iinfo(self.dtypes[column])
+            values = block[column].astype('Int64')
+            raw_values = values.to_numpy(dtype=np.int64, na_value=0)
+            is_null = values.isna().to_numpy() | (raw_values < info.min) | (raw_values > info.max)
+            column_bit = self.column_bits[column]
+            self.values[column][rows] = np.where(is_null, 0, raw_values).astype(self.dtypes[column])
+            self.nulls[rows] = (self.nulls[rows] & ~column_bit) | np.where(is_null, column_bit, np.uint64(0))
+
+        self.presence[rows] |= message_bit
+
+        # A record is complete when every message type has been received, also if some of
+        # its fields are None (they are returned as NaN and rejected by df_filter_data)
+        completed = rows[self.presence[rows] == self.complete_mask]
+        for row in completed:
+            del self.slots[self.keys[row]]
+            self.completed_rows.append(row)
+
+        return len(completed)
+
+    def add_packet(self, VIN:str, df_packet:pd.DataFrame, rejected:dict=None) -> int:
+        # Stores a single packet, as returned by df_from_string_to_df
+        #
+        # INPUTS:
+        #   - rejected: optional dictionary where the index of the packet is added if it is not
+        #     stored, under 'unmatched' (its columns are not the fields of any message type, e.g.
+        #     a payload too short), 'missing_key' or 'out_of_order'
+        #
+        # OUTPUT:
+        #   - number of records completed (0 or 1)
+        #   - -1 if the packet does not belong to this buffer
+
+        message_type = self.message_types_by_columns.get(tuple(df_packet.columns))
+        if message_type is None:
+            if rejected is not None:
+                rejected.setdefault('unmatched', []).append(df_packet.index)
+            return -1
+
+        block = df_packet.astype('Int64')
+        block.insert(0, 'VIN', VIN)
+
+        return self.add_block(message_type, block, rejected)
+
+    def drain(self) -> pd.DataFrame:
+        # Returns all completed records as a single dataframe (indexed by VIN) and frees their
+        # rows. Columns that contain None values are returned as float (NaN), the rest as int64
+        # (so that the arithmetic done afterwards can't overflow the compact dtypes).
+        #
+        # OUTPUT:
+        #   - df_completed: empty dataframe if no record has been completed
+
+        rows = np.array(self.completed_rows, dtype=np.int64)
+        self.completed_rows = []
+
+        df_completed = self._rows_to_df(rows)
+        self._release_rows(rows)
+
+        return df_completed
+
+    def evict(self, now:float=None) -> pd.DataFrame:
+        # Removes the pending records older than max_age and, if there are still more than
+        # max_entries, the oldest ones until the limit is met.
+        #
+        # INPUTS:
+        #   - now: reference time (time.time() by default)
+        #
+        # OUTPUT:
+        #   - df_expired: evicted records (indexed by VIN), the fields of the message types
+        #     that were never received are NaN and the 'Missing' column lists those types
+
+        if now is None:
+            now = time.time()
+
+        pending_rows = np.fromiter(self.slots.values(), dtype=np.int64, count=len(self.slots))
+        expired = np.zeros(len(pending_rows), dtype=bool)
+
+        if self.max_age is not None:
+            expired |= (now - self.created[pending_rows]) > self.max_age
+
+        if self.max_entries is not None and (~expired).sum() > self.max_entries:
+            # Keep only the newest max_entries records
+            alive = np.flatnonzero(~expired)
+            oldest_first = alive[np.argsort(self.created[pending_rows[alive]], kind='stable')]
+            expired[oldest_first[:len(alive) - self.max_entries]] = True
+
+        rows = pending_rows[expired]
+        for row in rows:
+            del self.slots[self.keys[row]]
+
+        # Null-mask the fields of the message types that are missing
+        presence = self.presence[rows]
+        for message_type, message_bit in self.message_bits.items():
+            is_missing = (presence & message_bit) == 0
+            for column in self.param_orders[message_type]:
+                if column not in self.key_columns:
+                    self.nulls[rows[is_missing]] |= self.column_bits[column]
+
+        df_expired = self._rows_to_df(rows)
+        df_expired['Missing'] = [','.join(message_type for message_type, message_bit in self.message_bits.items() if not (row_presence & message_bit))
+                                 for row_presence in presence]
+        self._release_rows(rows)
+
+        return df_expired
+
+    def save(self, file_path:str):
+        # Stores every occupied row (pending or completed but not drained) into a compressed
+        # .npz file. The file is written atomically (see storage_io.atomic_write), so that an
+        # interrupted save never leaves a corrupted state behind.
+
+        rows = np.array(list(self.slots.values()) + self.completed_rows, dtype=np.int64)
+        state = {f'values_{i}': self.values[column][rows] for i, column in enumerate(self.columns)}
+        state['vins'] = self.vins[rows].astype(str)
+        state['nulls'] = self.nulls[rows]
+        state['presence'] = self.presence[rows]
+        state['created'] = self.created[rows]
+
+        with atomic_write(file_path) as file:
+            np.savez_compressed(file, **state)
+
+    def load(self, file_path:str, vin_filter=None) -> int:
+        # Recovers the rows stored by save(). The rows are added to the current content of
+        # the buffer, records that are already in it are not added again.
+        #
+        # INPUTS:
+        #   - vin_filter: optional function that receives the array of VINs of the file and
+        #     returns a boolean mask of the rows to recover
+        #
+        # OUTPUT:
+        #   - number of rows recovered
+        #   - -1 if the file does not exist
+
+        if not os.path.exists(file_path):
+            return -1
+
+        with np.load(file_path, allow_pickle=False) as state:
+            vins = state['vins']
+            values = {column: state[f'values_{i}'] for i, column in enumerate(self.columns)}
+            nulls = state['nulls']
+            presence = state['presence']
+            created = state['created']
+
+        keep = np.ones(len(vins), dtype=bool) if vin_filter is None else np.asarray(vin_filter(vins), dtype=bool)
+        stored_keys = set(self.slots).union(self.keys[row] for row in self.completed_rows)
+        keys = [(vin,) + tuple(int(values[column][i]) for column in self.key_columns) for i, vin in enumerate(vins.tolist())]
+        for i, key in enumerate(keys):
+            keep[i] = keep[i] and key not in stored_keys
+            stored_keys.add(key)
+
+        positions = np.flatnonzero(keep)
+        num_rows = len(positions)
+        while len(self.free_rows) < num_rows:
+            self._grow(2 * self.capacity)
+
+        rows = np.array([self.free_rows.pop() for _ in range(num_rows)], dtype=np.int64)
+        for column in self.columns:
+            self.values[column][rows] = values[column][positions]
+        self.vins[rows] = vins[positions].tolist()
+        self.nulls[rows] = nulls[positions]
+        self.presence[rows] = presence[positions]
+        self.created[rows] = created[positions]
+
+        for row, position in zip(rows, positions):
+            self.keys[row] = keys[position]
+            if self.presence[row] == self.complete_mask:
+                self.completed_rows.append(row)
+            else:
+                self.slots[keys[position]] = row
+
+        return num_rows
+
+    def _rows_to_df(self, rows:np.ndarray) -> pd.DataFrame:
+        # Builds a dataframe (indexed by VIN) with the given rows
+        data = {}
+        nulls = self.nulls[rows]
+        for column in self.columns:
+            values = self.values[column][rows].astype(np.int64)
+            is_null = (nulls & self.column_bits[column]) != 0
+            if is_null.any():
+                values = np.where(is_null, np.nan, values)
+            data[column] = values
+
+        return pd.DataFrame(data, index=pd.Index(self.vins[rows], name='VIN'))
+
+    def _release_rows(self, rows:np.ndarray):
+        # Release the rows so that they can be reused by new records
+        self.vins[rows] = None
+        self.keys[rows] = None
+        self.presence[rows] = 0
+        self.free_rows.extend(rows.tolist())
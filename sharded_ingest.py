@@ -0,0 +1,189 @@
+import os
+import time
+import queue
+import multiprocessing
+import pandas as pd
+from collections import Counter
+from dataframe_storage import df_append_data
+from dataframe_treatment import df_filter_data
+from dead_letter import DeadLetterStore
+from from_server_to_df import (create_reassembly_buffers, df_assemble_batch, evict_pending_records, load_pending_state,
+                               save_pending_state, remove_stale_pending_states, VIN_COLUMN)
+
+"""
+*************************************************************************************************************
+This file contains the VIN-sharded ingest mode. Decoding and reassembling packets is pure CPU work and every
+record belongs to a single vehicle, so packets are partitioned by a stable hash of their DeviceId across N
+worker processes. Every worker owns its own reassembly buffers (and its own pending records snapshot) and
+returns its completed records already filtered. When it starts, every worker loads the records of its VINs
+from all the snapshots (the ones of any previous number of shards and the one of the single-process ingest),
+and the snapshots that no current shard owns are deleted once all workers have saved theirs. The parent
+process is the only writer: it gathers the records of all workers and appends them with df_append_data, so
+the stored data is the same as with from_server_to_parquet_batch. Dead letter part files are append-only, so
+every worker writes its own.
+
+Usage (workers are started with spawn, so from a script protected by if __name__ == '__main__'):
+    with ShardedIngest(num_shards=4) as ingest:
+        summary = ingest.ingest(df_server)
+*************************************************************************************************************
+"""
+
+# Snapshot of the pending records of every shard, formatted with shard and type_name
+SHARD_STATE_FILE_PATH = 'df/pending_shard{shard}_{{type_name}}.npz'
+
+# Seconds between the checks of the workers while waiting for their results, and maximum
+# seconds to wait for the results of a chunk
+WORKER_POLL_INTERVAL = 1.0
+RESULT_TIMEOUT = 3600.0
+
+def get_shards(device_ids:pd.Series, num_shards:int) -> pd.Series:
+    # Returns the shard of every DeviceId. The hash does not depend on the process, so a
+    # vehicle always goes to the same shard
+    hashes = pd.util.hash_pandas_object(device_ids.astype(str), index=False)
+    return (hashes % num_shards).astype(int)
+
+def _shard_worker(shard:int, num_shards:int, input_queue, output_queue):
+    # Worker process: assembles and filters the packets of its shard until None is received.
+    # It reports (shard, None) once its pending records have been loaded and saved
+
+    state_file_path = SHARD_STATE_FILE_PATH.format(shard=shard)
+    buffers = create_reassembly_buffers()
+    dead_letters = DeadLetterStore()
+    load_pending_state(buffers, state_file_path, vin_filter=lambda vins: get_shards(pd.Series(vins), num_shards).to_numpy() == shard)
+    save_pending_state(buffers, state_file_path)
+    output_queue.put((shard, None))
+
+    while True:
+        df_chunk = input_queue.get()
+        if df_chunk is None:
+            break
+
+        counters_before = dead_letters.get_counters()
+        completed = df_assemble_batch(df_chunk, buffers, dead_letters)
+        expired = evict_pending_records(buffers=buffers, dead_letters=dead_letters)
+
+        result = {}
+        for type_name, df_completed in completed.items():
+            df_filtered = None
+            if not df_completed.empty:
+                df_filtered = df_filter_data(df_completed, type_name)
+                if not isinstance(df_filtered, pd.DataFrame):
+                    df_filtered = None
+
+            result[type_name] = {'completed': df_completed.shape[0],
+                                 'filtered':  df_filtered,
+                                 'expired':   expired[type_name].shape[0],
+                                 'pending':   len(buffers[type_name])}
+
+        save_pending_state(buffers, state_file_path)
+        dead_letters.flush()
+        result['dead_letter'] = Counter(dead_letters.get_counters()) - Counter(counters_before)
+        output_queue.put((shard, result))
+
+class ShardedIngest:
+
+    def __init__(self, num_shards:int=None, timeout:float=RESULT_TIMEOUT):
+        # INPUT:
+        #   - num_shards: number of worker processes (number of CPUs by default)
+        #   - timeout: maximum seconds to wait for the workers to process a chunk
+
+        self.num_shards = num_shards or os.cpu_count()
+        self.timeout = timeout
+        # Like dataframe_storage.create_append_executor, workers are started with spawn: forking
+        # a process that has threads is not safe
+        context = multiprocessing.get_context('spawn')
+        self.input_queues = [context.Queue() for _ in range(self.num_shards)]
+        self.output_queue = context.Queue()
+        self.workers = [context.Process(target=_shard_worker, args=(shard, self.num_shards, self.input_queues[shard], self.output_queue), daemon=True)
+                        for shard in range(self.num_shards)]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        # Starts the workers and, once all of them have taken over their pending records,
+        # deletes the snapshots that no shard owns
+        for worker in self.workers:
+            worker.start()
+
+        self._get_results()
+        remove_stale_pending_states([SHARD_STATE_FILE_PATH.format(shard=shard) for shard in range(self.num_shards)])
+
+    def close(self):
+        # Stops the workers, which store their pending records before exiting
+        for input_queue in self.input_queues:
+            input_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def ingest(self, df_server:pd.DataFrame) -> dict:
+        # Sharded version of from_server_to_parquet_batch
+        #
+        # INPUT
+        #   - df_server: containing two columns: DeviceId, and OriginalMessage
+        #
+        # OUTPUT
+        #   - summary: {type_name: {'completed': n, 'rejected': n, 'expired': n, 'pending': n}},
+        #     plus {'dead_letter': {reason: n}}
+
+        # Shards without packets also get their (empty) chunk, so their pending records are
+        # still evicted and counted
+        shards = get_shards(df_server[VIN_COLUMN], self.num_shards)
+        for shard, input_queue in enumerate(self.input_queues):
+            input_queue.put(df_server[shards.to_numpy() == shard])
+
+        results = self._get_results()
+
+        # Single writer: every type is appended once with the records of all shards
+        summary = {}
+        for type_name in ['trip', 'charge']:
+            type_results = [result[type_name] for result in results]
+            frames = [type_result['filtered'] for type_result in type_results if type_result['filtered'] is not None]
+
+            num_completed = sum(type_result['completed'] for type_result in type_results)
+            num_accepted = 0
+            if frames:
+                df_filtered = pd.concat(frames)
+                num_accepted = df_filtered.shape[0]
+                df_append_data(df_filtered, type_name)
+
+            summary[type_name] = {'completed': num_completed,
+                                  'rejected':  num_completed - num_accepted,
+                                  'expired':   sum(type_result['expired'] for type_result in type_results),
+                                  'pending':   sum(type_result['pending'] for type_result in type_results)}
+
+        summary['dead_letter'] = dict(sum((result['dead_letter'] for result in results), Counter()))
+
+        return summary
+
+    def _get_results(self) -> list:
+        # Waits for a message of every worker
+        #
+        # OUTPUT:
+        #   - results: message of every worker, in shard order
+        #   - raises RuntimeError if a worker exits and TimeoutError if the messages do not
+        #     arrive within the timeout
+
+        results = [None] * self.num_shards
+        pending = set(range(self.num_shards))
+        deadline = time.monotonic() + self.timeout
+
+        while pending:
+            try:
+                shard, result = self.output_queue.get(timeout=WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                dead_shards = [shard for shard in sorted(pending) if not self.workers[shard].is_alive()]
+                if dead_shards:
+                    raise RuntimeError(f'Shard workers {dead_shards} exited unexpectedly')
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Shard workers {sorted(pending)} did not answer within {self.timeout} s')
+                continue
+
+            results[shard] = result
+            pending.discard(shard)
+
+        return results
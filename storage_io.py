@@ -0,0 +1,105 @@
+import os
+import time
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+"""
+*************************************************************************************************************
+This file contains the write protocol of the df/ directory, which allows several ingest processes and
+dashboards to use it at the same time:
+
+    - atomic_write: files are written with a temporary name in the same directory, flushed to disk (fsync) and
+      renamed over the final name. Readers see either the previous file or the new one, never a partial file
+    - file_lock / partition_lock: advisory lock (fcntl on POSIX, msvcrt on Windows) that every process takes
+      before a read-modify-write of a partition (the manifest and key index of a bucket, the month states,
+      the critical data file...). Readers don't take it
+
+Readers get snapshot isolation from the manifests: a bucket is read through the part files listed in the
+manifest they loaded, which is replaced atomically, and part files removed from it are kept for a grace period.
+*************************************************************************************************************
+"""
+
+LOCK_FILENAME = '_lock'
+
+def get_temp_path(file_path:str) -> str:
+    # Returns a temporary path next to file_path, unique for every process and call. It starts
+    # with '.', so readers listing part files ignore it
+    directory, filename = os.path.split(file_path)
+    return os.path.join(directory, f'.{filename}.{os.getpid()}.{time.time_ns()}.tmp')
+
+def fsync_directory(directory:str):
+    # Flushes a directory so that renames inside it are durable. Not possible on Windows
+    if fcntl is None:
+        return
+
+    descriptor = os.open(directory or '.', os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+@contextlib.contextmanager
+def atomic_write(file_path:str, mode:str='wb'):
+    # Context manager that yields a file object to write file_path. When the block ends without
+    # errors, the temporary file is flushed to disk and renamed to file_path. Otherwise it is
+    # deleted and file_path is left as it was
+    #
+    # Usage:
+    #   with atomic_write('df/file.parquet') as file:
+    #       pq.write_table(table, file)
+
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    temp_path = get_temp_path(file_path)
+    try:
+        with open(temp_path, mode) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    fsync_directory(directory)
+
+@contextlib.contextmanager
+def file_lock(lock_path:str):
+    # Context manager that holds an exclusive advisory lock on lock_path, waiting for other
+    # processes (or threads) that hold it. It is not reentrant
+    directory = os.path.dirname(lock_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(lock_path, 'a+b') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            # msvcrt gives up after 10 seconds, keep waiting
+            while True:
+                try:
+                    file.seek(0)
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def partition_lock(directory:str):
+    # Returns the lock of a partition directory (see file_lock)
+    return file_lock(os.path.join(directory, LOCK_FILENAME))
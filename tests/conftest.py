@@ -0,0 +1,81 @@
+import os
+import sys
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRECTORY)
+
+import from_server_to_df
+from dead_letter import DeadLetterStore
+from dataframe_storage import df_query
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Runs the test in an empty directory (df/ is relative) with fresh module buffers and dead
+    # letter store. The snapshot of the module buffers is saved and loaded explicitly by the
+    # tests, so none is loaded nor registered at exit by the ingest functions
+    shutil.copy(os.path.join(REPO_DIRECTORY, 'param_battery.json'), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(from_server_to_df, 'reassembly_buffers', from_server_to_df.create_reassembly_buffers())
+    monkeypatch.setattr(from_server_to_df, 'dead_letter_store', DeadLetterStore())
+    monkeypatch.setattr(from_server_to_df, 'pending_state_loaded', True)
+
+    return tmp_path
+
+def trip_packets(vin:str, timestamp:int, trip_id:int, odometer:int, rng) -> list:
+    # Returns the (DeviceId, OriginalMessage) of the 9 packets of a trip, with values within the
+    # bounds of param_battery.json
+    city = [int(x) for x in rng.integers(1, 400, 3)]
+    energy = [int(x) for x in rng.integers(100, 1500, 3)]
+    payloads = {'G1': [timestamp, timestamp, timestamp + int(rng.integers(600, 5000)), odometer - 100, trip_id],
+                'G2': [timestamp, odometer, int(rng.integers(10, 150)), trip_id],
+                'C2': [timestamp, *city, 5, 5, trip_id],
+                'C3': [timestamp, *energy, 100, 50, 2, trip_id],
+                'IE': [timestamp, 50, 400, 30, 80, 600, 40, trip_id],
+                'B1': [timestamp, 9000, int(rng.integers(2000, 8000)), -1000, 5000, trip_id],
+                'B2': [timestamp, -5000, 100, 80000, trip_id],
+                'B3': [timestamp, 90000, 80000, 4000, 3000, trip_id],
+                'B4': [timestamp, 100, 300, 2500, 200, 100, 100, trip_id]}
+
+    return [(vin, f"#{message_type}:{','.join(map(str, payload))},#&") for message_type, payload in payloads.items()]
+
+def charge_packets(vin:str, timestamp:int, rng) -> list:
+    # Returns the (DeviceId, OriginalMessage) of the 5 packets of a charge
+    payloads = {'H2': [timestamp, 2000, 9000, 3000, 3500, 3800, 3900],
+                'H3': [timestamp, 4000, 4100, 1000, 1000],
+                'H4': [timestamp, 1000, 200, 3000, 300, 200],
+                'H5': [timestamp, 3000, 300, 100, 300, 100, 0],
+                'H8': [timestamp, int(rng.integers(1000, 4000)), int(rng.integers(8000, 10000)), int(rng.integers(0, 2))]}
+
+    return [(vin, f"#{message_type}:{','.join(map(str, payload))},#&") for message_type, payload in payloads.items()]
+
+def make_server_df(num_vins:int=6, num_trips:int=12, start:int=1690000000, seed:int=0) -> pd.DataFrame:
+    # Returns a shuffled server dataframe (DeviceId, OriginalMessage) with the trips and charges
+    # of num_vins vehicles, spread over a few months
+    rng = np.random.default_rng(seed)
+    rows = []
+    for vin_number in range(num_vins):
+        vin = f'VIN{vin_number:04d}'
+        odometer = 10000
+        for trip in range(num_trips):
+            odometer += int(rng.integers(10, 200))
+            rows += trip_packets(vin, start + trip*400000 + vin_number*7, trip % 100, odometer, rng)
+        for charge in range(num_trips // 3):
+            rows += charge_packets(vin, start + charge*1200000 + vin_number*11 + 5, rng)
+
+    df_server = pd.DataFrame(rows, columns=[from_server_to_df.VIN_COLUMN, from_server_to_df.DATA_COLUMN])
+    return df_server.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+def read_dataset(type_name:str) -> pd.DataFrame:
+    # Returns every stored record of type_name with the VIN as a string column, sorted so
+    # that datasets written in a different order can be compared
+    df = df_query(type_name)
+    if not isinstance(df, pd.DataFrame):
+        return df
+
+    df = df.reset_index()
+    df['VIN'] = df['VIN'].astype(str)
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
@@ -0,0 +1,37 @@
+import os
+import pandas as pd
+import from_server_to_df
+from conftest import make_server_df, read_dataset
+from backfill import backfill
+from from_server_to_df import from_server_to_parquet_batch, create_reassembly_buffers, load_pending_state, save_pending_state
+
+def test_backfill_keeps_the_pending_records_of_incremental_ingest(workdir, monkeypatch):
+    df_server = make_server_df()
+
+    os.makedirs('full')
+    monkeypatch.chdir(workdir / 'full')
+    from_server_to_parquet_batch(df_server)
+    df_trips = read_dataset('trip')
+    df_charges = read_dataset('charge')
+
+    # Part of the dump is ingested incrementally, its partial records are saved as pending
+    # records and completed by the replay of the rest of the dump
+    os.makedirs(workdir / 'incremental' / 'dumps')
+    monkeypatch.chdir(workdir / 'incremental')
+    monkeypatch.setattr(from_server_to_df, 'reassembly_buffers', create_reassembly_buffers())
+    split = df_server.shape[0] * 3 // 5
+    summary = from_server_to_parquet_batch(df_server.iloc[:split])
+    assert summary['trip']['pending'] > 0
+    save_pending_state()
+
+    df_server.iloc[split:].to_parquet('dumps/dump_000.parquet', index=False)
+    stats = backfill('dumps', chunk_rows=100)
+
+    assert stats['packets'] == df_server.shape[0] - split and stats['expired'] == 0
+    pd.testing.assert_frame_equal(read_dataset('trip'), df_trips)
+    pd.testing.assert_frame_equal(read_dataset('charge'), df_charges)
+
+    # Every record was completed, so no pending record is left in the saved state
+    buffers = create_reassembly_buffers()
+    load_pending_state(buffers)
+    assert all(len(buffer) == 0 for buffer in buffers.values())
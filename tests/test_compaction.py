@@ -0,0 +1,39 @@
+import os
+import pandas as pd
+import pytest
+from conftest import make_server_df, read_dataset
+from compaction import compact_dataset, delete_retired_parts
+from dataframe_storage import get_dataset_buckets, get_part_files, load_manifest
+from from_server_to_df import from_server_to_parquet_batch
+
+def get_all_part_files(type_name:str) -> list:
+    return [part_file for bucket_directory in get_dataset_buckets(type_name) for part_file in get_part_files(bucket_directory)]
+
+@pytest.mark.parametrize('target_file_rows', [1000000, 4])
+def test_compaction_merges_part_files_without_changing_the_data(workdir, target_file_rows):
+    # Every pull writes new part files in the buckets it touches
+    for seed in range(4):
+        from_server_to_parquet_batch(make_server_df(num_trips=6, start=1690000000 + seed*10, seed=seed))
+    df_trips = read_dataset('trip')
+    df_charges = read_dataset('charge')
+    part_files = get_all_part_files('trip') + get_all_part_files('charge')
+
+    stats = compact_dataset(target_file_rows=target_file_rows, row_group_rows=2, min_parts=2)
+    assert stats['parts'] > 0 and stats['buckets'] > 0
+    assert len(get_all_part_files('trip') + get_all_part_files('charge')) < len(part_files)
+    pd.testing.assert_frame_equal(read_dataset('trip'), df_trips)
+    pd.testing.assert_frame_equal(read_dataset('charge'), df_charges)
+
+    # Merged part files are kept until their grace period ends
+    bucket_directories = get_dataset_buckets('trip') + get_dataset_buckets('charge')
+    retired = [os.path.join(directory, filename) for directory in bucket_directories for filename, _ in load_manifest(directory)['retired']]
+    assert len(retired) == stats['parts'] and all(os.path.exists(file_path) for file_path in retired)
+    assert sum(delete_retired_parts(directory, grace_period=0) for directory in bucket_directories) == stats['parts']
+    assert not any(os.path.exists(file_path) for file_path in retired)
+
+def test_compaction_leaves_buckets_with_few_part_files(workdir):
+    from_server_to_parquet_batch(make_server_df())
+    part_files = get_all_part_files('trip')
+
+    assert compact_dataset() == {'buckets': 0, 'parts': 0}
+    assert get_all_part_files('trip') == part_files
@@ -0,0 +1,237 @@
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from conftest import make_server_df, read_dataset, trip_packets
+import dataframe_storage
+from dataframe_storage import (concat_part_tables, create_append_executor, df_append_data, df_generate_month_df, df_get_month_state, df_query, df_query_critical_data, df_read_month, df_load_month_state, df_rebuild_month_state, get_month_path, get_month_part_files, migrate_legacy_months, df_read_bucket_vins, df_read_vehicle, update_manifest, write_sorted_part_file, get_dataset_buckets, get_hot_path, get_month_index, get_vin_buckets, get_part_files, prune_hot_tier,
+                               DATASET_DIRECTORY, TIMESTAMP_COLUMNS, TRIP_STATE_SUMS, VIN_COLUMN as STORED_VIN_COLUMN, VIN_TYPE)
+from dataframe_treatment import df_filter_data
+from from_server_to_df import create_reassembly_buffers, df_assemble_batch, from_server_to_parquet_batch, VIN_COLUMN, DATA_COLUMN
+
+MONTH_BOUNDARY = 1690848000     # 2023-08-01T00:00:00Z
+
+def test_ingesting_the_same_dump_twice_stores_it_once(workdir):
+    df_server = make_server_df()
+    summary = from_server_to_parquet_batch(df_server)
+    assert summary['trip']['completed'] > 0 and summary['trip']['pending'] == 0
+
+    df_trips = read_dataset('trip')
+    df_charges = read_dataset('charge')
+    assert df_trips.shape[0] == 6*12 and df_charges.shape[0] > 0
+    df_critical = pd.read_parquet('df/critical_data.parquet')
+    df_vehicles = df_query_critical_data(vehicles=True)
+
+    # The records are completed again, but the key index drops them when appending
+    summary = from_server_to_parquet_batch(df_server)
+    assert summary['trip']['completed'] == df_trips.shape[0]
+
+    pd.testing.assert_frame_equal(read_dataset('trip'), df_trips)
+    pd.testing.assert_frame_equal(read_dataset('charge'), df_charges)
+    pd.testing.assert_frame_equal(pd.read_parquet('df/critical_data.parquet'), df_critical)
+    pd.testing.assert_frame_equal(df_query_critical_data(vehicles=True), df_vehicles)
+
+def test_records_are_bucketed_by_utc_month(workdir):
+    rng = np.random.default_rng(0)
+    rows = trip_packets('VIN0000', MONTH_BOUNDARY - 1, 1, 10000, rng) + trip_packets('VIN0001', MONTH_BOUNDARY, 1, 10000, rng)
+    from_server_to_parquet_batch(pd.DataFrame(rows, columns=[VIN_COLUMN, DATA_COLUMN]))
+
+    df_july = df_read_month(get_month_path(2023, 7, 'trip'))
+    df_august = df_read_month(get_month_path(2023, 8, 'trip'))
+    assert df_july[TIMESTAMP_COLUMNS['trip']].tolist() == [MONTH_BOUNDARY - 1]
+    assert df_august[TIMESTAMP_COLUMNS['trip']].tolist() == [MONTH_BOUNDARY]
+
+def test_vins_are_stored_dictionary_encoded_and_queried(workdir):
+    from_server_to_parquet_batch(make_server_df())
+    part_files = [part_file for bucket_directory in get_dataset_buckets('trip') for part_file in get_part_files(bucket_directory)]
+    assert all(pq.read_schema(part_file).field(STORED_VIN_COLUMN).type == VIN_TYPE for part_file in part_files)
+
+    df_trips = read_dataset('trip')
+    df = df_query('trip', vins=['VIN0001', 'VIN0004'])
+    assert sorted(df.index.unique().astype(str)) == ['VIN0001', 'VIN0004']
+    assert df.shape[0] == df_trips[STORED_VIN_COLUMN].isin(['VIN0001', 'VIN0004']).sum()
+
+def test_month_state_aggregates_the_exact_values_of_float32_columns():
+    rng = np.random.default_rng(0)
+    index = pd.Index(rng.choice(['VIN0000', 'VIN0001', 'VIN0002'], 500), name=STORED_VIN_COLUMN)
+    df_trip = pd.DataFrame({column: rng.integers(0, 15000, 500) / 10 for column in [*TRIP_STATE_SUMS, 'End odometer']}, index=index)
+    df_charge = pd.DataFrame({'uSoC I': rng.integers(0, 5000, 100) / 100, 'uSoC F': rng.integers(5000, 10000, 100) / 100,
+                              'Connector': rng.integers(0, 2, 100)}, index=index[:100])
+
+    df_state = df_get_month_state(df_trip, df_charge)
+    df_state_float32 = df_get_month_state(df_trip.astype(np.float32), df_charge.astype({'uSoC I': np.float32, 'uSoC F': np.float32}))
+    pd.testing.assert_frame_equal(df_state_float32, df_state, check_exact=True)
+
+def test_critical_data_has_no_float32_artifacts(workdir):
+    from_server_to_parquet_batch(make_server_df())
+    df_critical = df_query_critical_data()
+
+    # Distances have a decimal
+    distances = df_critical['Max km in month VIN'].to_numpy()
+    assert np.abs(distances - np.round(distances, 1)).max() < 1e-9
+
+def test_months_appended_by_the_pool_are_the_same(workdir, monkeypatch):
+    completed = df_assemble_batch(make_server_df(num_trips=24), create_reassembly_buffers())
+    df_trips = df_filter_data(completed['trip'], 'trip')
+    assert create_append_executor(1) is None
+
+    os.makedirs('sequential')
+    monkeypatch.chdir(workdir / 'sequential')
+    df_append_data(df_trips.copy(), 'trip')
+    df_sequential = read_dataset('trip')
+
+    os.makedirs(workdir / 'parallel')
+    monkeypatch.chdir(workdir / 'parallel')
+    monkeypatch.setattr(dataframe_storage, 'PARALLEL_APPEND_MIN_ROWS', 0)
+    with create_append_executor(2) as executor:
+        df_append_data(df_trips.copy(), 'trip', executor)
+        assert len(executor._processes) > 0
+
+    pd.testing.assert_frame_equal(read_dataset('trip'), df_sequential)
+    assert len(os.listdir('df/vehicle_critical_data')) >= dataframe_storage.PARALLEL_APPEND_MIN_MONTHS
+
+def test_concat_part_tables_promotes_types_and_fills_missing_columns():
+    table_compact = pa.table({'x': pa.array([1], pa.int16()), 'y': [1.5]})
+    table_wide = pa.table({'x': [2.5], 'z': ['a']})
+
+    table = concat_part_tables([table_compact, table_wide])
+    assert table.schema.field('x').type == pa.float64()
+    assert table.to_pydict() == {'x': [1.0, 2.5], 'y': [1.5, None], 'z': [None, 'a']}
+    assert concat_part_tables([table_compact, table_compact]).schema == table_compact.schema
+
+def test_recent_months_are_read_from_the_hot_tier(workdir, monkeypatch):
+    # The trips of the last month are in the hot tier, the ones of 2023 are not
+    from_server_to_parquet_batch(make_server_df(num_trips=6, start=int(time.time()) - 30*86400))
+    from_server_to_parquet_batch(make_server_df(num_trips=3, seed=1))
+    part_files = [part_file for type_name in ['trip', 'charge'] for bucket_directory in get_dataset_buckets(type_name)
+                  for part_file in get_part_files(bucket_directory)]
+    hot_part_files = [part_file for part_file in part_files if os.path.exists(get_hot_path(part_file))]
+    assert 0 < len(hot_part_files) < len(part_files)
+    assert all('year=2023' not in part_file for part_file in hot_part_files)
+
+    df_trips = read_dataset('trip')
+    df_charges = read_dataset('charge')
+    for part_file in hot_part_files:
+        pd.testing.assert_frame_equal(pd.read_feather(get_hot_path(part_file)), pd.read_parquet(part_file))
+
+    # Once the months leave the hot tier, their twins are deleted and they are read from parquet
+    monkeypatch.setattr(dataframe_storage, 'HOT_TIER_MONTHS', 0)
+    assert prune_hot_tier() == len(hot_part_files)
+    assert not any(os.path.exists(get_hot_path(part_file)) for part_file in part_files)
+    pd.testing.assert_frame_equal(read_dataset('trip'), df_trips)
+    pd.testing.assert_frame_equal(read_dataset('charge'), df_charges)
+
+def test_vehicle_critical_data_matches_the_kpis_of_every_vin(workdir):
+    from_server_to_parquet_batch(make_server_df())
+    df_vehicles = df_query_critical_data(vehicles=True)
+    df_trips = read_dataset('trip')
+    months = pd.to_datetime(df_trips[TIMESTAMP_COLUMNS['trip']], unit='s').dt.to_period('M')
+    trips = df_trips.groupby([df_trips[STORED_VIN_COLUMN], months]).size()
+    assert df_vehicles['Trips'].sum() == df_trips.shape[0]
+
+    # Same KPIs as the critical data of a single VIN
+    for _, row in df_vehicles[(df_vehicles['Trips'] > 0) & (df_vehicles['Charges'] > 0)].iterrows():
+        vin, date = row[STORED_VIN_COLUMN], row['Date']
+        assert row['Trips'] == trips[(vin, date.to_period('M'))]
+        df_month = df_generate_month_df(get_month_path(date.year, date.month, 'trip'), get_month_path(date.year, date.month, 'charge'),
+                                        date.year, date.month, key_user=vin)
+        for column in ['Total distance', 'City percentage', 'Sport percentage', 'Average trip distance', 'Average consumption',
+                       'Average range', 'Average charged SoC', 'Average final charging SoC', 'Shucko', 'Trips between charges']:
+            assert row[column] == df_month[column].iloc[0], column
+
+def test_critical_data_queries_select_months_columns_and_vins(workdir):
+    assert df_query_critical_data() == -1 and df_query_critical_data(vehicles=True) == -1
+    from_server_to_parquet_batch(make_server_df())
+
+    df_critical = df_query_critical_data()
+    assert len(df_critical['Date'].unique()) >= 3
+    df = df_query_critical_data(start='2023-08', end='2023-08', columns=['Total distance'])
+    pd.testing.assert_frame_equal(df, df_critical.loc[df_critical['Date'] == '2023-08-01', ['Date', 'Total distance']].reset_index(drop=True))
+
+    df_vehicles = df_query_critical_data(vehicles=True)
+    df = df_query_critical_data(start='2023-08', vins=['VIN0002', 'VIN0005'], columns=['Trips'])
+    selected = (df_vehicles['Date'] >= '2023-08-01') & df_vehicles[STORED_VIN_COLUMN].isin(['VIN0002', 'VIN0005'])
+    assert df.shape[0] > 0
+    pd.testing.assert_frame_equal(df, df_vehicles.loc[selected, ['Date', STORED_VIN_COLUMN, 'Trips']].reset_index(drop=True))
+
+def test_appends_add_part_files_without_rewriting_the_month(workdir):
+    from_server_to_parquet_batch(make_server_df(num_vins=3, num_trips=3))
+    month_path = get_month_path(2023, 7, 'trip')
+    part_files = {part_file: os.stat(part_file).st_mtime_ns for part_file in get_month_part_files(month_path)}
+    assert df_read_month(month_path).shape[0] == 9
+
+    from_server_to_parquet_batch(make_server_df(num_vins=3, num_trips=3, start=1690000100))
+    new_part_files = get_month_part_files(month_path)
+    assert set(part_files) < set(new_part_files)
+    assert all(os.stat(part_file).st_mtime_ns == modified for part_file, modified in part_files.items())
+    assert df_read_month(month_path).shape[0] == 18
+
+def test_months_of_the_old_layout_are_migrated(workdir):
+    from_server_to_parquet_batch(make_server_df(num_vins=3, num_trips=3))
+    df_july = read_dataset('trip')
+    df_read_month(get_month_path(2023, 7, 'trip')).to_parquet('df/2023_07_trip.parquet')
+    shutil.rmtree(get_month_path(2023, 7, 'trip'))
+
+    assert migrate_legacy_months() == 1
+    assert not os.path.exists('df/2023_07_trip.parquet')
+    pd.testing.assert_frame_equal(read_dataset('trip'), df_july)
+
+def test_queries_only_open_the_partitions_of_their_filters(workdir):
+    from_server_to_parquet_batch(make_server_df())
+    start, end = MONTH_BOUNDARY, MONTH_BOUNDARY + 20*86400
+    buckets = np.unique(get_vin_buckets(['VIN0003'])).tolist()
+
+    bucket_directories = get_dataset_buckets('trip', get_month_index(start), get_month_index(end), buckets)
+    assert bucket_directories == [f'{DATASET_DIRECTORY}/type=trip/year=2023/month=08/vin_bucket={buckets[0]:02}']
+
+    df_trips = read_dataset('trip')
+    timestamps = df_trips[TIMESTAMP_COLUMNS['trip']]
+    expected = df_trips[(df_trips[STORED_VIN_COLUMN] == 'VIN0003') & (timestamps >= start) & (timestamps < end)]
+    df = df_query('trip', vins=['VIN0003'], start=start, end=end, columns=[TIMESTAMP_COLUMNS['trip'], 'Total distance'])
+    assert list(df.columns) == [TIMESTAMP_COLUMNS['trip'], 'Total distance'] and df.shape[0] > 0
+    assert sorted(df[TIMESTAMP_COLUMNS['trip']]) == sorted(expected[TIMESTAMP_COLUMNS['trip']])
+
+def test_incremental_month_state_is_the_state_of_the_stored_rows(workdir):
+    # Three pulls, each one adds rows to months that already have a state
+    for seed, start in enumerate([1690000000, 1690000100, 1690000200]):
+        from_server_to_parquet_batch(make_server_df(num_trips=6, start=start, seed=seed))
+    df_critical = df_query_critical_data()
+
+    for year, month in [(2023, 7), (2023, 8)]:
+        df_state = df_load_month_state(year, month)
+        # Sums are added in a different order
+        pd.testing.assert_frame_equal(df_state, df_rebuild_month_state(year, month), check_exact=False, rtol=1e-12)
+        assert df_state['Trips'].sum() == df_read_month(get_month_path(year, month, 'trip')).shape[0]
+    assert df_critical['Connected vehicles'].tolist()[:2] == [6, 6]
+
+def test_vehicle_reads_only_the_row_groups_of_its_vin(workdir, monkeypatch):
+    completed = df_assemble_batch(make_server_df(num_trips=3), create_reassembly_buffers())
+    df_trips = df_filter_data(completed['trip'], 'trip')
+    bucket_path = os.path.join(get_month_path(2023, 7, 'trip'), 'vin_bucket=00')
+    part_file, vin_row_groups = write_sorted_part_file(bucket_path, df_trips, row_group_rows=2)
+    update_manifest(bucket_path, added=[part_file], vin_row_groups=[vin_row_groups])
+
+    # 3 trips per VIN in row groups of 2 rows
+    assert vin_row_groups['VIN0000'] == [0, 1] and vin_row_groups['VIN0001'] == [1, 2]
+    row_groups_read = []
+    read_part_table = dataframe_storage.read_part_table
+    monkeypatch.setattr(dataframe_storage, 'read_part_table', lambda file_path, columns=None, row_groups=None, filters=None:
+                        row_groups_read.append(row_groups) or read_part_table(file_path, columns, row_groups, filters))
+
+    df_vin = pd.concat(df_read_bucket_vins(bucket_path, ['VIN0004']))
+    assert row_groups_read == [[6, 7]]
+    assert df_vin.shape[0] == 3 and set(df_vin.index.astype(str)) == {'VIN0004'}
+
+def test_vehicle_reads_match_the_fleet_query(workdir):
+    from_server_to_parquet_batch(make_server_df())
+    start, end = MONTH_BOUNDARY - 86400, MONTH_BOUNDARY + 30*86400
+
+    for vin in ['VIN0000', 'VIN0003']:
+        df = df_read_vehicle(vin, 'trip', start, end)
+        pd.testing.assert_frame_equal(df.sort_values(TIMESTAMP_COLUMNS['trip']),
+                                      df_query('trip', vins=[vin], start=start, end=end).sort_values(TIMESTAMP_COLUMNS['trip']),
+                                      check_categorical=False)
+    assert df_read_vehicle('VIN9999', 'trip') == -1
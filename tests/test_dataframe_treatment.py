@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from conftest import make_server_df
+from dataframe_treatment import add_columns, apply_resolution, df_filter_data, df_filter_data_stream, sort_columns, validate_values, verify_values
+from dead_letter import DeadLetterStore
+from from_server_to_df import create_reassembly_buffers, df_assemble_batch
+
+@pytest.fixture
+def completed(workdir):
+    # Completed records of every type, with a few invalid ones: a field of a charge is missing
+    # (NaN), a trip has an out of bounds value and another one a null energy (Regen is NaN)
+    completed = df_assemble_batch(make_server_df(num_trips=30), create_reassembly_buffers(), DeadLetterStore())
+    completed['trip'].iloc[3, completed['trip'].columns.get_loc('Start SoC')] = 10**9
+    completed['trip'].iloc[[5, 6], [completed['trip'].columns.get_loc(column) for column in ['City energy', 'Sport energy', 'Flow energy']]] = 0
+    completed['charge'] = completed['charge'].astype({'uSoC F': np.float64})
+    completed['charge'].iloc[2, completed['charge'].columns.get_loc('uSoC F')] = np.nan
+
+    return completed
+
+def filter_by_steps(df:pd.DataFrame, type_name:str, violations:dict) -> pd.DataFrame:
+    # Steps 2 to 5 of df_filter_data, one after the other
+    if 'Start odometer' in df.columns:
+        del df['Start odometer']
+    df = sort_columns(add_columns(df, type_name), type_name)
+    return apply_resolution(verify_values(df, violations).copy())
+
+@pytest.mark.parametrize('type_name', ['trip', 'charge'])
+def test_filter_gives_the_result_of_the_steps(completed, type_name):
+    violations, violations_by_steps = {}, {}
+    df_filtered = df_filter_data(completed[type_name].copy(), type_name, violations=violations)
+    df_by_steps = filter_by_steps(completed[type_name].copy(), type_name, violations_by_steps)
+
+    assert 0 < df_filtered.shape[0] < completed[type_name].shape[0]
+    pd.testing.assert_frame_equal(df_filtered, df_by_steps, check_exact=True)
+    assert violations == violations_by_steps
+
+def test_streaming_filter_gives_the_result_of_the_whole_frame(completed):
+    df_filtered = df_filter_data(completed['trip'].copy(), 'trip')
+    counters = {}
+    chunks = [completed['trip'].iloc[start:start + 50] for start in range(0, completed['trip'].shape[0], 50)]
+    df_streamed = pd.concat(df_filter_data_stream(chunks, 'trip', counters=counters))
+
+    pd.testing.assert_frame_equal(df_streamed, df_filtered, check_exact=True)
+    assert counters['records'] == completed['trip'].shape[0]
+    assert counters['accepted'] == df_filtered.shape[0]
+    assert counters['rejected'] == counters['records'] - counters['accepted']
+    assert counters['violations']['Start SoC'] == 1
+
+def test_streaming_filter_accepts_arrow_batches(completed):
+    df_filtered = df_filter_data(completed['charge'].copy(), 'charge')
+    batches = pa.Table.from_pandas(completed['charge']).to_batches(max_chunksize=7)
+    df_streamed = pd.concat(df_filter_data_stream(batches, 'charge'))
+
+    pd.testing.assert_frame_equal(df_streamed, df_filtered, check_exact=True)
+
+def test_validation_reports_the_rows_out_of_bounds_of_every_column(completed):
+    df = sort_columns(add_columns(completed['trip'].copy(), 'trip'), 'trip').reset_index(drop=True)
+    keep, violations, rows = validate_values(df, row_ids=True)
+
+    assert list(np.flatnonzero(~keep)) == [3, 5, 6]
+    assert violations['Start SoC'] == 1 and list(rows['Start SoC']) == [3]
+    assert set(rows) == set(violations[violations > 0].index)
+    assert all(violations[column] == len(index) for column, index in rows.items())
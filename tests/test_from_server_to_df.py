@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import from_server_to_df
+from dead_letter import REASON_EXPIRED, REASON_INVALID_FIELD, REASON_MALFORMED, REASON_MISSING_KEY, REASON_UNKNOWN_TYPE, df_read_dead_letters
+from conftest import make_server_df, read_dataset, trip_packets
+from from_server_to_df import df_decode_batch, from_server_to_parquet, from_server_to_parquet_batch, VIN_COLUMN, DATA_COLUMN
+
+def test_empty_pull_is_a_no_op(workdir):
+    assert df_decode_batch(pd.Series([], dtype=object), pd.Series([], dtype=object)) == {}
+
+    summary = from_server_to_parquet_batch(pd.DataFrame(columns=[VIN_COLUMN, DATA_COLUMN]))
+    for type_name in ['trip', 'charge']:
+        assert summary[type_name] == {'completed': 0, 'rejected': 0, 'expired': 0, 'pending': 0}
+    assert summary['dead_letter'] == {}
+
+def test_legacy_ingest_nulls_values_out_of_range(workdir):
+    df_server = pd.DataFrame({VIN_COLUMN: ['VIN0000', 'VIN0001'],
+                              DATA_COLUMN: ['#G1:1690000000,99999999999999999999,3,4,5,#&', '#G1:99999999999999999999,2,3,4,5']})
+    assert from_server_to_parquet(df_server) is None
+
+    # The packet whose timestamp (part of the key) is out of range can't be stored
+    assert from_server_to_df.dead_letter_store.get_counters() == {REASON_INVALID_FIELD: 1, REASON_MISSING_KEY: 1}
+    assert len(from_server_to_df.reassembly_buffers['trip']) == 1
+
+def test_legacy_ingest_evicts_pending_records(workdir):
+    from_server_to_df.reassembly_buffers['trip'].max_entries = 1
+    rng = np.random.default_rng(0)
+    rows = [trip_packets(f'VIN{vin:04d}', 1690000000, 1, 10000, rng)[0] for vin in range(3)]
+    assert from_server_to_parquet(pd.DataFrame(rows, columns=[VIN_COLUMN, DATA_COLUMN])) is None
+
+    assert len(from_server_to_df.reassembly_buffers['trip']) == 1
+    assert from_server_to_df.dead_letter_store.get_counters() == {REASON_EXPIRED: 2}
+
+def test_batch_ingest_filters_and_appends_every_type_once(workdir, monkeypatch):
+    appended = []
+    df_append_data = from_server_to_df.df_append_data
+    monkeypatch.setattr(from_server_to_df, 'df_append_data', lambda df, type_name: appended.append(type_name) or df_append_data(df, type_name))
+
+    # A trip is missing a packet and another one has a speed out of bounds
+    df_server = make_server_df(num_trips=6)
+    df_server = df_server[df_server[DATA_COLUMN] != '#B4:1690000000,100,300,2500,200,100,100,0,#&']
+    is_speeding = df_server[DATA_COLUMN].str.startswith('#G2:1690000007,')
+    df_server.loc[is_speeding, DATA_COLUMN] = df_server.loc[is_speeding, DATA_COLUMN].str.replace(r'^(#G2:\d+,\d+),\d+', r'\1,200', regex=True)
+
+    summary = from_server_to_parquet_batch(df_server)
+    assert appended == ['trip', 'charge']
+    assert summary['trip'] == {'completed': 35, 'rejected': 1, 'expired': 0, 'pending': 1}
+    assert summary['charge'] == {'completed': 12, 'rejected': 0, 'expired': 0, 'pending': 0}
+    assert read_dataset('trip').shape[0] == 34
+
+def test_batch_ingest_routes_unusable_packets_to_the_dead_letter_store(workdir):
+    rows = [('VIN0000', '#G1'), ('VIN0001', '#Z9:1690000000,1,#&'), ('VIN0002', '#G2:1690000000,x,10,1,#&'),
+            ('VIN0003', '#G2:,10000,10,1,#&')]
+    summary = from_server_to_parquet_batch(pd.DataFrame(rows, columns=[VIN_COLUMN, DATA_COLUMN]))
+
+    assert summary['dead_letter'] == {REASON_MALFORMED: 1, REASON_UNKNOWN_TYPE: 1, REASON_INVALID_FIELD: 2, REASON_MISSING_KEY: 1}
+    df_dead_letters = df_read_dead_letters()
+    assert sorted(zip(df_dead_letters['DeviceId'], df_dead_letters['Reason'])) == [
+        ('VIN0000', REASON_MALFORMED), ('VIN0001', REASON_UNKNOWN_TYPE), ('VIN0002', REASON_INVALID_FIELD),
+        ('VIN0003', REASON_INVALID_FIELD), ('VIN0003', REASON_MISSING_KEY)]
+    assert summary['trip']['pending'] == 1
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import pytest
+import from_server_to_df
+import ingest_service
+from conftest import make_server_df, read_dataset
+from dead_letter import REASON_INGEST_ERROR, REASON_WRITE_ERROR
+from ingest_service import IngestService
+
+@pytest.fixture
+def service_workdir(workdir, monkeypatch):
+    # The service routes errors to the dead letter store of the ingest functions
+    monkeypatch.setattr(ingest_service, 'dead_letter_store', from_server_to_df.dead_letter_store)
+    return workdir
+
+def write_dumps(df_server, directory:str='dumps'):
+    # Writes the server dataframe as a .csv and a .parquet dump file
+    os.makedirs(directory)
+    split = df_server.shape[0] // 2
+    df_server.iloc[:split].to_csv(os.path.join(directory, 'a.csv'), index=False)
+    df_server.iloc[split:].to_parquet(os.path.join(directory, 'b.parquet'), index=False)
+
+async def ingest_directory(service:IngestService, directory:str='dumps'):
+    await service.start()
+    await service.ingest_directory(directory, chunk_rows=100)
+    await service.stop()
+    return service.stats()
+
+def test_service_ingests_a_directory_of_dump_files(service_workdir):
+    df_server = make_server_df()
+    write_dumps(df_server)
+
+    stats = asyncio.run(ingest_directory(IngestService(write_batch_rows=50)))
+    assert stats['packets'] == df_server.shape[0] and stats['errors'] == 0
+    assert stats['completed'] == 6*12 + 6*4 and stats['written'] == stats['completed'] - stats['rejected']
+    assert stats['packet_queue'] == 0 and stats['write_queue'] == 0
+    assert read_dataset('trip').shape[0] + read_dataset('charge').shape[0] == stats['written']
+
+def test_failing_chunks_and_writes_are_dead_lettered(service_workdir, monkeypatch):
+    df_server = make_server_df()
+    write_dumps(df_server)
+
+    # The first chunk can't be assembled and the first write fails
+    failures = {'assemble': 1, 'append': 1}
+    def fail_first(name, function):
+        def wrapper(*args):
+            if failures[name] > 0:
+                failures[name] -= 1
+                raise RuntimeError(name)
+            return function(*args)
+        return wrapper
+    monkeypatch.setattr(ingest_service, 'df_assemble_batch', fail_first('assemble', ingest_service.df_assemble_batch))
+    monkeypatch.setattr(ingest_service, 'df_append_data', fail_first('append', ingest_service.df_append_data))
+
+    stats = asyncio.run(ingest_directory(IngestService(write_batch_rows=50)))
+    assert stats['errors'] == 2 and stats['packets'] == df_server.shape[0]
+    assert stats['dead_letter'][REASON_INGEST_ERROR] == 100
+    assert stats['dead_letter'][REASON_WRITE_ERROR] + stats['written'] == stats['completed'] - stats['rejected']
+    assert stats['written'] > 0
+
+def test_full_queue_makes_sources_wait(service_workdir):
+    async def submit_chunks():
+        service = IngestService(queue_size=1)
+        chunk = make_server_df(num_vins=1, num_trips=1)
+        await service.submit(chunk)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(service.submit(chunk), timeout=0.1)
+        return service.stats()['packet_queue']
+
+    assert asyncio.run(submit_chunks()) == 1
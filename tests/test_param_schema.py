@@ -0,0 +1,34 @@
+import os
+import json
+import numpy as np
+import param_schema
+from param_schema import PARAM_FILE_PATH, get_column_vectors, get_type_schema
+
+def test_schema_is_compiled_once_until_the_file_changes(workdir, monkeypatch):
+    loads = []
+    monkeypatch.setattr(param_schema.json, 'load', lambda file: loads.append(file.name) or json.loads(file.read()))
+
+    trip = get_type_schema('trip')
+    assert get_type_schema('trip') is trip and get_type_schema('charge') is not trip
+    assert len(loads) == 1
+
+    with open(PARAM_FILE_PATH) as file:
+        parameters = json.loads(file.read())
+    parameters['Start SoC']['Value_MAX'] = 50
+    with open(PARAM_FILE_PATH, 'w') as file:
+        json.dump(parameters, file)
+    os.utime(PARAM_FILE_PATH, ns=(0, os.stat(PARAM_FILE_PATH).st_mtime_ns + 10**9))
+
+    trip = get_type_schema('trip')
+    assert len(loads) == 2
+    assert trip.value_max[trip.positions['Start SoC']] == 50
+
+def test_vectors_are_aligned_with_the_columns(workdir):
+    trip = get_type_schema('trip')
+    columns = list(reversed(trip.columns))
+    value_min, value_max, resolution = get_column_vectors(columns)
+
+    np.testing.assert_array_equal(value_min, trip.value_min[::-1])
+    np.testing.assert_array_equal(value_max, trip.value_max[::-1])
+    np.testing.assert_array_equal(resolution, trip.resolution[::-1])
+    assert get_type_schema('unknown') == -1
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+from conftest import charge_packets, trip_packets
+from from_server_to_df import df_decode_batch, df_from_string_to_df
+from param_schema import get_parameters
+from protocol_registry import PROTOCOL_REGISTRY, STORAGE_DTYPES, TYPE_MESSAGES, narrowest_int_dtype, protocol_dict
+
+def test_registry_dtypes_hold_the_bounds_of_every_field(workdir):
+    parameters = get_parameters()
+    for type_name, message_types in TYPE_MESSAGES.items():
+        assert sum(PROTOCOL_REGISTRY[message_type].bit for message_type in message_types) == 2**len(message_types) - 1
+        for message_type in message_types:
+            spec = PROTOCOL_REGISTRY[message_type]
+            assert spec.type_name == type_name and spec.fields == tuple(protocol_dict[message_type])
+            for field, dtype in zip(spec.fields, spec.dtypes):
+                if field in spec.key_fields or field not in parameters:
+                    assert dtype == np.int64
+                else:
+                    info = np.iinfo(dtype)
+                    assert info.min <= parameters[field]["Value_MIN"] and parameters[field]["Value_MAX"] <= info.max
+
+    assert narrowest_int_dtype(0, 255) == np.uint8 and narrowest_int_dtype(-1, 255) == np.int16
+    assert narrowest_int_dtype(0, 2**40) == np.int64
+
+def test_storage_dtypes_keep_the_stored_values(workdir):
+    parameters = get_parameters()
+    for type_name, dtypes in STORAGE_DTYPES.items():
+        for column, dtype in dtypes.items():
+            resolution = parameters[column]["Resolution"]
+            bounds = np.array([parameters[column]["Value_MIN"], parameters[column]["Value_MAX"]]) * resolution
+            if np.issubdtype(dtype, np.integer):
+                assert np.iinfo(dtype).min < 0 and np.iinfo(dtype).min <= bounds[0] and bounds[1] <= np.iinfo(dtype).max
+            elif dtype == np.float32:
+                # Every resolution step up to the bounds is exact
+                steps = np.abs(bounds / resolution)
+                assert steps.max() < 2**24
+
+def test_batch_decoder_gives_the_fields_of_the_packet_decoder(workdir):
+    rng = np.random.default_rng(0)
+    packets = trip_packets('VIN0000', 1690000000, 1, 10000, rng) + charge_packets('VIN0000', 1690000000, rng)
+    messages = [message for _, message in packets]
+    # Invalid fields: not an integer, out of the dtype of the field (Max speed is uint8), missing
+    messages += ['#G2:1690000000,x,10,1,#&', '#G2:1690000000,10000,256,1,#&', '#H8:1690000000,1000,9000']
+
+    blocks = df_decode_batch(pd.Series(messages))
+    for position, message in enumerate(messages):
+        df_packet, type_name = df_from_string_to_df(message)
+        spec = PROTOCOL_REGISTRY[message[1:3]]
+        block = blocks[spec.message_type]
+        assert type_name == spec.type_name
+        assert [block[field].dtype.numpy_dtype for field in spec.fields] == list(spec.dtypes)
+        for field in spec.fields:
+            value = df_packet.at[0, field] if field in df_packet.columns else None
+            decoded = block.at[position, field]
+            assert (pd.isna(decoded) and pd.isna(value)) or decoded == value, (message, field)
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+import pytest
+from reassembly_buffer import ReassemblyBuffer
+
+PARAM_ORDERS = {'A': ['Timestamp', 'x', 'Id'], 'B': ['Timestamp', 'y', 'Id']}
+KEY_COLUMNS = ['Timestamp', 'Id']
+
+def make_buffer(**kwargs) -> ReassemblyBuffer:
+    return ReassemblyBuffer(PARAM_ORDERS, KEY_COLUMNS, **kwargs)
+
+def make_block(vins, timestamps, values, column, ids=None) -> pd.DataFrame:
+    ids = [1] * len(vins) if ids is None else ids
+    return pd.DataFrame({'VIN': vins, 'Timestamp': timestamps, column: pd.array(values, dtype='Int64'), 'Id': ids})
+
+def test_record_completes_when_every_message_type_arrived():
+    buffer = make_buffer()
+
+    assert buffer.add_block('A', make_block(['V1', 'V2'], [10, 20], [1, 2], 'x')) == 0
+    assert len(buffer) == 2
+    assert buffer.add_block('B', make_block(['V1'], [10], [3], 'y')) == 1
+
+    df_completed = buffer.drain()
+    assert df_completed.index.tolist() == ['V1']
+    assert df_completed[['x', 'y']].iloc[0].tolist() == [1, 3]
+    assert len(buffer) == 1
+    assert buffer.drain().empty
+
+def test_null_fields_complete_as_nan():
+    buffer = make_buffer()
+    buffer.add_block('A', make_block(['V1'], [10], [None], 'x'))
+    buffer.add_block('B', make_block(['V1'], [10], [3], 'y'))
+
+    df_completed = buffer.drain()
+    assert np.isnan(df_completed['x'].iloc[0])
+    assert df_completed['y'].iloc[0] == 3
+
+def test_rejected_packets_are_reported():
+    buffer = make_buffer()
+    rejected = {}
+    buffer.add_block('A', make_block(['V1', None, 'V1'], [10, 10, 10], [1, 2, 3], 'x'), rejected)
+
+    assert [list(index) for index in rejected['missing_key']] == [[1]]
+    assert [list(index) for index in rejected['out_of_order']] == [[2]]
+    assert buffer.add_block('C', make_block(['V1'], [10], [1], 'x')) == -1
+
+def test_add_packet_reports_unmatched_columns():
+    buffer = make_buffer()
+    rejected = {}
+
+    assert buffer.add_packet('V1', pd.DataFrame({'Timestamp': [10], 'x': [1]}), rejected) == -1
+    assert 'unmatched' in rejected
+    assert buffer.add_packet('V1', pd.DataFrame({'Timestamp': [10], 'x': [1], 'Id': [1]}), rejected) == 0
+    assert len(buffer) == 1
+
+def test_evict_by_age_and_entries():
+    buffer = make_buffer(max_age=100, max_entries=1)
+    buffer.add_block('A', make_block(['V1', 'V2', 'V3'], [10, 20, 30], [1, 2, 3], 'x'))
+    buffer.created[buffer.slots[('V1', 10, 1)]] -= 1000
+
+    # V1 is too old, then the oldest of the rest is evicted to keep max_entries
+    buffer.created[buffer.slots[('V2', 20, 1)]] -= 1
+    df_expired = buffer.evict()
+
+    assert sorted(df_expired.index) == ['V1', 'V2']
+    assert df_expired['Missing'].tolist() == ['B', 'B']
+    assert df_expired['y'].isna().all()
+    assert list(buffer.slots) == [('V3', 30, 1)]
+
+def test_save_and_load_round_trip(tmp_path):
+    file_path = str(tmp_path / 'pending.npz')
+    buffer = make_buffer()
+    buffer.add_block('A', make_block(['V1', 'V2'], [10, 20], [1, None], 'x'))
+    buffer.add_block('B', make_block(['V1'], [10], [3], 'y'))
+    buffer.save(file_path)
+
+    loaded = make_buffer(capacity=1)
+    assert loaded.load(file_path) == 2
+    assert len(loaded) == 1
+
+    # The completed record was not drained before saving
+    df_completed = loaded.drain()
+    assert df_completed.index.tolist() == ['V1']
+    assert df_completed[['x', 'y']].iloc[0].tolist() == [1, 3]
+
+    # The pending record keeps its null field and completes after the restart
+    loaded.add_block('B', make_block(['V2'], [20], [4], 'y'))
+    df_completed = loaded.drain()
+    assert np.isnan(df_completed['x'].iloc[0]) and df_completed['y'].iloc[0] == 4
+
+def test_load_skips_stored_records_and_filters_vins(tmp_path):
+    file_path = str(tmp_path / 'pending.npz')
+    buffer = make_buffer()
+    buffer.add_block('A', make_block(['V1', 'V2'], [10, 20], [1, 2], 'x'))
+    buffer.save(file_path)
+
+    loaded = make_buffer()
+    assert loaded.load(file_path, vin_filter=lambda vins: vins == 'V1') == 1
+    assert loaded.load(file_path) == 1
+    assert loaded.load(file_path) == 0
+    assert sorted(loaded.slots) == [('V1', 10, 1), ('V2', 20, 1)]
+    assert make_buffer().load(str(tmp_path / 'missing.npz')) == -1
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        make_buffer(capacity=0)
+
+    # The smallest buffer grows when needed
+    buffer = make_buffer(capacity=1)
+    buffer.add_block('A', make_block(['V1', 'V2', 'V3'], [10, 20, 30], [1, 2, 3], 'x'))
+    assert len(buffer) == 3 and buffer.capacity >= 3
+
+def test_vins_that_are_not_strings_match_after_a_restart(tmp_path):
+    file_path = str(tmp_path / 'pending.npz')
+    buffer = make_buffer()
+    buffer.add_block('A', make_block([123], [10], [1], 'x'))
+    buffer.save(file_path)
+
+    loaded = make_buffer()
+    loaded.load(file_path)
+    assert loaded.add_block('B', make_block([123], [10], [3], 'y')) == 1
+    assert loaded.drain().index.tolist() == ['123']
@@ -0,0 +1,38 @@
+import os
+import pandas as pd
+from conftest import make_server_df, read_dataset
+from from_server_to_df import from_server_to_parquet_batch
+from sharded_ingest import ShardedIngest
+
+def test_sharded_ingest_stores_the_same_data_as_batch_ingest(workdir, monkeypatch):
+    df_server = make_server_df()
+
+    os.makedirs('batch')
+    monkeypatch.chdir(workdir / 'batch')
+    summary_batch = from_server_to_parquet_batch(df_server)
+    df_trips = read_dataset('trip')
+    df_charges = read_dataset('charge')
+
+    # The dump is sent in two chunks, so records are also completed from the pending records
+    # of the workers
+    os.makedirs(workdir / 'sharded')
+    monkeypatch.chdir(workdir / 'sharded')
+    split = df_server.shape[0] // 2
+    with ShardedIngest(num_shards=2, timeout=60) as ingest:
+        summaries = [ingest.ingest(df_server.iloc[:split]), ingest.ingest(df_server.iloc[split:])]
+
+    for type_name in ['trip', 'charge']:
+        assert sum(summary[type_name]['completed'] for summary in summaries) == summary_batch[type_name]['completed']
+        assert summaries[0][type_name]['pending'] > 0 and summaries[-1][type_name]['pending'] == 0
+
+    pd.testing.assert_frame_equal(read_dataset('trip'), df_trips)
+    pd.testing.assert_frame_equal(read_dataset('charge'), df_charges)
+
+def test_shards_without_packets_reply(workdir):
+    df_server = make_server_df(num_vins=1, num_trips=3)
+
+    with ShardedIngest(num_shards=4, timeout=60) as ingest:
+        summary = ingest.ingest(df_server)
+
+    assert summary['trip']['completed'] == 3 and summary['trip']['pending'] == 0
+    assert read_dataset('trip').shape[0] == 3
@@ -0,0 +1,43 @@
+import os
+import time
+import threading
+import pytest
+from storage_io import atomic_write, file_lock
+
+def test_failed_write_leaves_the_previous_file(tmp_path):
+    file_path = tmp_path / 'file.txt'
+    with atomic_write(str(file_path), 'w') as file:
+        file.write('first')
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(str(file_path), 'w') as file:
+            file.write('partial')
+            raise RuntimeError
+
+    assert file_path.read_text() == 'first'
+    assert os.listdir(tmp_path) == ['file.txt']
+
+def test_lock_serialises_read_modify_writes(tmp_path):
+    # Every thread reads the counter, waits and writes it back incremented. Without the lock
+    # increments would be lost
+    counter_path, lock_path = str(tmp_path / 'counter'), str(tmp_path / 'locks' / 'counter.lock')
+    with atomic_write(counter_path, 'w') as file:
+        file.write('0')
+
+    def increment():
+        for _ in range(5):
+            with file_lock(lock_path):
+                with open(counter_path) as file:
+                    value = int(file.read())
+                time.sleep(0.001)
+                with atomic_write(counter_path, 'w') as file:
+                    file.write(str(value + 1))
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(counter_path) as file:
+        assert int(file.read()) == 20